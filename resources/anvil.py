@@ -0,0 +1,140 @@
+"""
+Anvil region file (.mca) helpers.
+
+A region file starts with an 8 KiB header: 1024 big-endian location entries
+(3-byte sector offset + 1-byte sector count) followed by 1024 big-endian
+32-bit timestamps of the last time each chunk was saved. Chunk payloads live
+in 4 KiB sectors after the header as a 4-byte length, a compression type byte
+and the compressed NBT.
+"""
+
+import re
+import struct
+
+SECTOR_SIZE = 4096
+HEADER_SIZE = 2 * SECTOR_SIZE
+CHUNKS_PER_REGION = 1024
+REGION_NAME = re.compile(r'^r\.(-?\d+)\.(-?\d+)\.mca$')
+
+_TABLE = struct.Struct('>1024I')
+
+
+class RegionError(Exception):
+    pass
+
+
+def is_region_file(name):
+    return REGION_NAME.match(name) is not None
+
+
+def region_coords(name):
+    match = REGION_NAME.match(name)
+    if not match:
+        raise RegionError(f'not a region file name: {name}')
+    return int(match.group(1)), int(match.group(2))
+
+
+def chunk_index(x, z):
+    return (x & 31) + (z & 31) * 32
+
+
+def chunk_coords(index, region_x=0, region_z=0):
+    return region_x * 32 + index % 32, region_z * 32 + index // 32
+
+
+def read_header(f):
+    """Return (locations, timestamps); locations are (sector, count) pairs."""
+    f.seek(0)
+    header = f.read(HEADER_SIZE)
+    if not header:
+        # The server creates empty region files before the first chunk save.
+        return [(0, 0)] * CHUNKS_PER_REGION, [0] * CHUNKS_PER_REGION
+    if len(header) < HEADER_SIZE:
+        raise RegionError(f'truncated region header ({len(header)} bytes)')
+    locations = [(loc >> 8, loc & 0xFF) for loc in _TABLE.unpack_from(header, 0)]
+    timestamps = list(_TABLE.unpack_from(header, SECTOR_SIZE))
+    return locations, timestamps
+
+
+def effective_timestamps(locations, timestamps):
+    """Timestamps with 0 for chunks that are not present in the region."""
+    return [ts if loc[0] else 0 for loc, ts in zip(locations, timestamps)]
+
+
+def pack_table(values):
+    return _TABLE.pack(*values)
+
+
+def unpack_table(data):
+    return list(_TABLE.unpack(data))
+
+
+def read_chunk(f, location):
+    """Return the chunk payload (compression type byte + data) or None."""
+    offset, count = location
+    if not offset:
+        return None
+    f.seek(offset * SECTOR_SIZE)
+    prefix = f.read(4)
+    if len(prefix) < 4:
+        raise RegionError(f'chunk at sector {offset} is past the end of file')
+    length, = struct.unpack('>I', prefix)
+    if length == 0 or length > count * SECTOR_SIZE - 4:
+        raise RegionError(f'chunk at sector {offset} has bad length {length}')
+    payload = f.read(length)
+    if len(payload) < length:
+        raise RegionError(f'chunk at sector {offset} is truncated')
+    return payload
+
+
+def write_region(f, timestamps, payloads, locations=None):
+    """
+    Write a region file from chunk payloads keyed by chunk index.
+
+    Chunks are packed one after another in index order, each starting on a
+    sector boundary, the same layout the server produces for a fresh region.
+    If locations (sector, count) are given and every payload still fits in
+    its sectors, that layout is reproduced instead.
+    """
+    keep_layout = locations is not None and _fits(payloads, locations)
+    table_locations = [0] * CHUNKS_PER_REGION
+    table = [0] * CHUNKS_PER_REGION
+    sector = HEADER_SIZE // SECTOR_SIZE
+    end = HEADER_SIZE
+    for index in sorted(payloads):
+        if keep_layout:
+            sector, count = locations[index]
+            write_chunk(f, sector, payloads[index], count)
+        else:
+            count = write_chunk(f, sector, payloads[index])
+        table_locations[index] = sector << 8 | count
+        table[index] = timestamps[index]
+        sector += count
+        end = max(end, sector * SECTOR_SIZE)
+    f.seek(end)
+    f.truncate()
+    f.seek(0)
+    f.write(pack_table(table_locations) + pack_table(table))
+
+
+def write_chunk(f, sector, payload, count=None):
+    """
+    Write a chunk payload at sector, padded to count sectors (as many as it
+    needs by default); return the number of sectors.
+    """
+    data = struct.pack('>I', len(payload)) + payload
+    needed = -(-len(data) // SECTOR_SIZE)
+    if needed > 255:
+        raise RegionError(f'chunk is too large for a region ({len(data)} bytes)')
+    count = count or needed
+    f.seek(sector * SECTOR_SIZE)
+    f.write(data + b'\0' * (count * SECTOR_SIZE - len(data)))
+    return count
+
+
+def _fits(payloads, locations):
+    for index, payload in payloads.items():
+        sector, count = locations[index]
+        if not sector or len(payload) + 4 > count * SECTOR_SIZE:
+            return False
+    return True
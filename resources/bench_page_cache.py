@@ -0,0 +1,207 @@
+"""
+Benchmark: does a backup pass push the server's hot regions out of the page cache?
+
+The most recently modified region files stand in for the chunks the server is
+working with. They are read into the cache, then a probe thread keeps reading
+random chunks from them (the disk side of a chunk load) while a full backup
+read pass runs over the data directory, once with plain buffered reads and
+once through the fadvise reader used by the backups. For every mode the
+script reports chunk read latency during and after the pass, how much of the
+hot set is still cached afterwards and how much of the rest of the world the
+pass left in the cache.
+
+The effect only shows when the world does not fit in free memory; on a small
+test world both modes keep everything cached. Run it next to the server, e.g.
+
+    python resources/bench_page_cache.py --data-dir /data --hot-regions 64
+"""
+
+import argparse
+import json
+import os
+import random
+import threading
+import time
+from pathlib import Path
+
+import anvil
+import incremental
+import reader
+
+
+def hot_regions(data_dir, count):
+    """The count most recently written region files."""
+    regions = [data_dir / rel for rel, _ in incremental.iter_tree(data_dir)
+               if incremental.is_region_path(rel)]
+    regions.sort(key=lambda path: path.stat().st_mtime, reverse=True)
+    return regions[:count]
+
+
+def chunk_extents(path):
+    with open(path, 'rb') as f:
+        locations, _ = anvil.read_header(f)
+    return [(sector * anvil.SECTOR_SIZE, count * anvil.SECTOR_SIZE)
+            for sector, count in locations if sector]
+
+
+def evict(path):
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_DONTNEED)
+    finally:
+        os.close(fd)
+
+
+def warm(path):
+    with open(path, 'rb') as f:
+        while f.read(reader.READ_SIZE):
+            pass
+
+
+def cached_bytes(paths):
+    """(cached, total) bytes of paths according to mincore."""
+    cached = total = 0
+    for path in paths:
+        fd = os.open(path, os.O_RDONLY)
+        try:
+            size = os.fstat(fd).st_size
+            pages = reader.resident_pages(fd, size)
+        finally:
+            os.close(fd)
+        total += size
+        if pages:
+            cached += min(size, pages.count(1) * reader.PAGE_SIZE)
+    return cached, total
+
+
+class ChunkProbe:
+    """Thread reading random chunks from the hot regions and timing every read."""
+
+    def __init__(self, regions, interval):
+        self.targets = [(path, extent) for path in regions for extent in chunk_extents(path)]
+        self.interval = interval
+        self.latencies = []
+        self._stop = threading.Event()
+        self._thread = None
+
+    def _run(self):
+        fds = {}
+        try:
+            while not self._stop.is_set():
+                path, (offset, length) = random.choice(self.targets)
+                if path not in fds:
+                    fds[path] = os.open(path, os.O_RDONLY)
+                started = time.perf_counter()
+                os.pread(fds[path], length, offset)
+                self.latencies.append(time.perf_counter() - started)
+                self._stop.wait(self.interval)
+        finally:
+            for fd in fds.values():
+                os.close(fd)
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name='chunk-probe', daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+        return self.latencies
+
+
+def summarize(latencies):
+    if not latencies:
+        return {}
+    ordered = sorted(latencies)
+
+    def pick(q):
+        return round(ordered[min(len(ordered) - 1, int(q * len(ordered)))] * 1000, 3)
+
+    return {'samples': len(ordered), 'p50_ms': pick(0.5), 'p99_ms': pick(0.99),
+            'max_ms': round(ordered[-1] * 1000, 3)}
+
+
+def backup_pass(files, cache_friendly):
+    started = time.monotonic()
+    total = 0
+    for path in files:
+        with reader.open_source(path, cache_friendly=cache_friendly) as f:
+            while True:
+                data = f.read(reader.READ_SIZE)
+                if not data:
+                    break
+                total += len(data)
+    return total, time.monotonic() - started
+
+
+def run_mode(files, hot, cache_friendly, interval, settle):
+    hot_set = set(hot)
+    cold = [path for path in files if path not in hot_set]
+    for path in files:
+        evict(path)
+    for path in hot:
+        warm(path)
+    hot_before = cached_bytes(hot)
+
+    probe = ChunkProbe(hot, interval).start()
+    size, seconds = backup_pass(files, cache_friendly)
+    during = probe.stop()
+
+    hot_after = cached_bytes(hot)
+    cold_after = cached_bytes(cold)
+    probe = ChunkProbe(hot, interval).start()
+    time.sleep(settle)
+    after = probe.stop()
+    return {
+        'mode': 'fadvise' if cache_friendly else 'plain',
+        'bytes_read': size,
+        'seconds': round(seconds, 2),
+        'hot_cached_before': hot_before[0],
+        'hot_cached_after': hot_after[0],
+        'hot_bytes': hot_after[1],
+        'cold_cached_after': cold_after[0],
+        'cold_bytes': cold_after[1],
+        'chunk_read_during': summarize(during),
+        'chunk_read_after': summarize(after),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--data-dir', type=Path, default=Path(os.getenv('MC_DATA_DIR', '/data')))
+    parser.add_argument('--hot-regions', type=int, default=32)
+    parser.add_argument('--mode', choices=('plain', 'fadvise', 'both'), default='both')
+    parser.add_argument('--probe-interval', type=float, default=0.005)
+    parser.add_argument('--settle', type=float, default=5.0,
+                        help='seconds to keep probing after the pass')
+    parser.add_argument('--json', action='store_true')
+    args = parser.parse_args()
+
+    exclude = {p.strip() for p in os.getenv('BACKUP_EXCLUDE', 'logs,crash-reports').split(',') if p.strip()}
+    files = [args.data_dir / rel for rel, _ in incremental.iter_tree(args.data_dir, exclude)]
+    hot = hot_regions(args.data_dir, args.hot_regions)
+    if not hot:
+        parser.error(f'no region files under {args.data_dir}')
+
+    modes = {'plain': [False], 'fadvise': [True], 'both': [False, True]}[args.mode]
+    for cache_friendly in modes:
+        result = run_mode(files, hot, cache_friendly, args.probe_interval, args.settle)
+        if args.json:
+            print(json.dumps(result))
+            continue
+        mib = 2**20
+        print(f"{result['mode']}: read {result['bytes_read'] / mib:.0f} MiB in {result['seconds']} s")
+        print(f"  hot set cached: {result['hot_cached_before'] / mib:.1f} -> "
+              f"{result['hot_cached_after'] / mib:.1f} of {result['hot_bytes'] / mib:.1f} MiB")
+        print(f"  rest of world left in cache: {result['cold_cached_after'] / mib:.1f} of "
+              f"{result['cold_bytes'] / mib:.1f} MiB")
+        for phase in ('during', 'after'):
+            stats = result[f'chunk_read_{phase}']
+            if stats:
+                print(f"  chunk reads {phase}: p50 {stats['p50_ms']} ms, p99 {stats['p99_ms']} ms, "
+                      f"max {stats['max_ms']} ms ({stats['samples']} reads)")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,385 @@
+"""
+Catalog of all backups in BACKUP_DIR/catalog.db (SQLite in WAL mode).
+
+The manifests next to the archives stay the source of truth; the catalog
+indexes them, so listings, 'what changed since X' and the history of a file
+or chunk are index lookups instead of reading manifests and archives. It has
+one row per version of every file and every chunk, with the snapshots that
+version is valid for: 'since' is the snapshot that stored it and 'until' the
+one that replaced or removed it (NULL while it is current). Snapshot ids
+sort by time, so the state at snapshot S is since <= S AND (until IS NULL OR
+until > S).
+
+File rows carry size, mtime, inode (only for versions recorded right after
+the backup that made them) and a hash: in store mode the object ids of the
+file's blocks, or of the region table for region files; in incremental mode
+the SHA-256 of the file from the manifest of the archive that stored it, or
+of the region's timestamp table for region files. The chunks of region files have rows with absolute
+chunk coordinates, the chunk timestamp and the object holding it (the
+chunk's object id in store mode, the archive that first stored it in
+incremental mode).
+
+Sources are 'chain' (incremental.py), 'store' (objstore.py) and 'full'
+(plain archives, listed without contents). sync() records the snapshots the
+catalog does not know yet and forgets the ones whose manifests are gone, so
+a deleted or stale catalog.db is rebuilt by the next sync.
+"""
+
+import argparse
+import base64
+import hashlib
+import logging
+import os
+import sqlite3
+from pathlib import Path
+
+import anvil
+import incremental
+import objstore
+import seekable
+
+logger = logging.getLogger(__name__)
+
+CATALOG_FILE = 'catalog.db'
+SCHEMA_VERSION = 1
+SOURCES = ('chain', 'store', 'full')
+
+_SCHEMA = '''
+    CREATE TABLE IF NOT EXISTS snapshots (
+        source TEXT NOT NULL,
+        id TEXT NOT NULL,
+        kind TEXT NOT NULL,
+        created TEXT,
+        location TEXT,
+        PRIMARY KEY (source, id, kind)
+    );
+    CREATE TABLE IF NOT EXISTS files (
+        source TEXT NOT NULL,
+        path TEXT NOT NULL,
+        size INTEGER NOT NULL,
+        mtime_ns INTEGER NOT NULL,
+        inode INTEGER,
+        hash TEXT,
+        since TEXT NOT NULL,
+        until TEXT
+    );
+    CREATE INDEX IF NOT EXISTS files_current ON files (source, path, until);
+    CREATE INDEX IF NOT EXISTS files_since ON files (source, since);
+    CREATE INDEX IF NOT EXISTS files_until ON files (source, until);
+    CREATE TABLE IF NOT EXISTS chunks (
+        source TEXT NOT NULL,
+        region TEXT NOT NULL,
+        x INTEGER NOT NULL,
+        z INTEGER NOT NULL,
+        timestamp INTEGER NOT NULL,
+        object TEXT,
+        since TEXT NOT NULL,
+        until TEXT
+    );
+    CREATE INDEX IF NOT EXISTS chunks_current ON chunks (source, region, until);
+    CREATE INDEX IF NOT EXISTS chunks_position ON chunks (source, x, z);
+    CREATE INDEX IF NOT EXISTS chunks_since ON chunks (source, since);
+    CREATE INDEX IF NOT EXISTS chunks_until ON chunks (source, until);
+'''
+
+
+class CatalogError(Exception):
+    pass
+
+
+class Catalog:
+    def __init__(self, path):
+        self.path = Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self.db = sqlite3.connect(str(self.path), timeout=30)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('PRAGMA synchronous=NORMAL')
+        version, = self.db.execute('PRAGMA user_version').fetchone()
+        if version not in (0, SCHEMA_VERSION):
+            raise CatalogError(f'{path} has schema version {version}, expected {SCHEMA_VERSION}')
+        self.db.executescript(_SCHEMA)
+        self.db.execute(f'PRAGMA user_version={SCHEMA_VERSION}')
+
+    def close(self):
+        self.db.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    # Recording
+
+    def sync(self, backup_dir, source_dir=None):
+        """
+        Bring the catalog up to date with the manifests under backup_dir.
+        source_dir, the live data directory, supplies inodes for the newest
+        snapshot when it is recorded right after the backup.
+        """
+        backup_dir = Path(backup_dir)
+        recorded = self._sync_chain(backup_dir / 'chain', source_dir)
+        recorded += self._sync_store(backup_dir / 'store', source_dir)
+        recorded += self._sync_full(backup_dir / 'full')
+        return recorded
+
+    def _known(self, source):
+        return {(row[0], row[1]) for row in self.db.execute(
+            'SELECT id, kind FROM snapshots WHERE source = ?', (source,))}
+
+    def _pending(self, source, present):
+        """Snapshots to record, oldest first; rebuilds the source if one predates the newest recorded."""
+        known = self._known(source)
+        self._forget(source, known - set(present))
+        new = sorted(set(present) - known)
+        newest = self.latest(source)
+        if new and newest is not None and new[0][0] < newest:
+            logger.warning('Catalog of %s is out of order, rebuilding it', source)
+            self._forget(source, known)
+            new = sorted(present)
+        return new
+
+    def _sync_chain(self, archive_dir, source_dir):
+        manifests = {incremental.parse_manifest_name(path.name): path
+                     for path in incremental.list_manifests(archive_dir)}
+        new = self._pending('chain', manifests)
+        for position, key in enumerate(new):
+            manifest = incremental.load_manifest(manifests[key])
+            with self.db:
+                self._insert_snapshot('chain', manifest['id'], manifest['kind'], manifest['created'],
+                                      manifest['archive'])
+                # A synthetic backup has the state of the incremental with its id.
+                if manifest['kind'] != 'synthetic':
+                    live = source_dir if position == len(new) - 1 else None
+                    self._record_state('chain', manifest, live)
+        return len(new)
+
+    def _sync_store(self, store_dir, source_dir):
+        if not (store_dir / 'refs.db').exists():
+            self._forget('store', self._known('store'))
+            return 0
+        store = objstore.ObjectStore(store_dir)
+        try:
+            ids = store.snapshot_ids()
+            new = self._pending('store', [(snapshot_id, 'store') for snapshot_id in ids])
+            for position, (snapshot_id, _) in enumerate(new):
+                manifest = store.load_snapshot(snapshot_id)
+                with self.db:
+                    self._insert_snapshot('store', snapshot_id, 'store', manifest['created'],
+                                          f'snapshots/{snapshot_id}.json.gz')
+                    live = source_dir if position == len(new) - 1 else None
+                    self._record_state('store', manifest, live, store)
+        finally:
+            store.close()
+        return len(new)
+
+    def _sync_full(self, full_dir):
+        archives = {}
+        for path in sorted(full_dir.glob('world-*')):
+            for suffix in ('.tar.gz', seekable.SUFFIX):
+                if path.name.endswith(suffix):
+                    archives[(path.name[len('world-'):-len(suffix)], 'full')] = path.name
+        new = self._pending('full', archives)
+        with self.db:
+            for key in new:
+                self._insert_snapshot('full', key[0], 'full', None, archives[key])
+        return len(new)
+
+    def _insert_snapshot(self, source, snapshot_id, kind, created, location):
+        self.db.execute('INSERT INTO snapshots (source, id, kind, created, location) VALUES (?, ?, ?, ?, ?)',
+                        (source, snapshot_id, kind, created, location))
+
+    def _record_state(self, source, manifest, source_dir, store=None):
+        """Close and open version rows so the current rows match the complete state in manifest."""
+        snapshot_id = manifest['id']
+        if store is not None:
+            entries = {rel: (entry[0], entry[1], ','.join(entry[2])) for rel, entry in manifest['files'].items()}
+            for rel, entry in manifest['regions'].items():
+                entries[rel] = (entry[0], entry[1], entry[2])
+        else:
+            # Files carried over unchanged have no hash in this manifest.
+            hashes = manifest.get('hashes', {})
+            entries = {rel: (entry[0], entry[1], hashes.get(rel)) for rel, entry in manifest['files'].items()}
+            for rel, entry in manifest['regions'].items():
+                entries[rel] = (entry[0], entry[1], hashlib.sha256(base64.b64decode(entry[2])).hexdigest())
+        current = {row[0]: row[1:] for row in self.db.execute(
+            'SELECT path, rowid, size, mtime_ns, hash FROM files WHERE source = ? AND until IS NULL',
+            (source,))}
+        for rel in set(current) - set(entries):
+            self._close('files', current[rel][0], snapshot_id)
+            if incremental.is_region_path(rel):
+                self._update_chunks(source, snapshot_id, rel, None, None)
+        for rel, (size, mtime_ns, digest) in entries.items():
+            row = current.get(rel)
+            if row is not None and tuple(row[1:3]) == (size, mtime_ns) and digest in (None, row[3]):
+                continue
+            if row is not None:
+                self._close('files', row[0], snapshot_id)
+            self.db.execute(
+                'INSERT INTO files (source, path, size, mtime_ns, inode, hash, since) VALUES (?, ?, ?, ?, ?, ?, ?)',
+                (source, rel, size, mtime_ns, _inode(source_dir, rel, size, mtime_ns), digest, snapshot_id))
+            if rel in manifest['regions']:
+                if store is not None:
+                    timestamps, hashes = store.read_table(digest)
+                    objects = hashes.get
+                else:
+                    timestamps = anvil.unpack_table(base64.b64decode(manifest['regions'][rel][2]))
+                    archive = manifest['archive']
+                    objects = lambda index: archive
+                self._update_chunks(source, snapshot_id, rel, timestamps, objects)
+
+    def _update_chunks(self, source, snapshot_id, region, timestamps, objects):
+        current = {(row[1], row[2]): (row[0], row[3], row[4]) for row in self.db.execute(
+            'SELECT rowid, x, z, timestamp, object FROM chunks WHERE source = ? AND region = ? AND until IS NULL',
+            (source, region))}
+        if timestamps is not None:
+            region_x, region_z = anvil.region_coords(region.rsplit('/', 1)[-1])
+            for index, timestamp in enumerate(timestamps):
+                if not timestamp:
+                    continue
+                x, z = anvil.chunk_coords(index, region_x, region_z)
+                obj = objects(index)
+                row = current.pop((x, z), None)
+                if row is not None and row[1] == timestamp and (source == 'chain' or row[2] == obj):
+                    continue
+                if row is not None:
+                    self._close('chunks', row[0], snapshot_id)
+                self.db.execute(
+                    'INSERT INTO chunks (source, region, x, z, timestamp, object, since) VALUES (?, ?, ?, ?, ?, ?, ?)',
+                    (source, region, x, z, timestamp, obj, snapshot_id))
+        for rowid, _, _ in current.values():
+            self._close('chunks', rowid, snapshot_id)
+
+    def _close(self, table, rowid, snapshot_id):
+        self.db.execute(f'UPDATE {table} SET until = ? WHERE rowid = ?', (snapshot_id, rowid))
+
+    def _forget(self, source, snapshots):
+        """Drop snapshots and the versions no remaining snapshot of source can see."""
+        if not snapshots:
+            return
+        with self.db:
+            for snapshot_id, kind in snapshots:
+                self.db.execute('DELETE FROM snapshots WHERE source = ? AND id = ? AND kind = ?',
+                                (source, snapshot_id, kind))
+            for table in ('files', 'chunks'):
+                self.db.execute(f'''
+                    DELETE FROM {table} WHERE source = ? AND NOT EXISTS (
+                        SELECT 1 FROM snapshots s WHERE s.source = {table}.source AND s.id >= {table}.since
+                        AND ({table}.until IS NULL OR s.id < {table}.until))''', (source,))
+        logger.info('Catalog: forgot %d %s snapshots', len(snapshots), source)
+
+    # Queries
+
+    def snapshots(self, source=None):
+        """[(source, id, kind, created, location)], oldest first."""
+        query = 'SELECT source, id, kind, created, location FROM snapshots'
+        if source is not None:
+            return self.db.execute(query + ' WHERE source = ? ORDER BY id, kind', (source,)).fetchall()
+        return self.db.execute(query + ' ORDER BY id, source, kind').fetchall()
+
+    def latest(self, source):
+        row = self.db.execute('SELECT MAX(id) FROM snapshots WHERE source = ?', (source,)).fetchone()
+        return row[0]
+
+    def files_at(self, source, snapshot_id):
+        """{path: (size, mtime_ns)} as of a snapshot."""
+        return {row[0]: row[1:] for row in self.db.execute(
+            'SELECT path, size, mtime_ns FROM files WHERE source = ? AND since <= ? '
+            'AND (until IS NULL OR until > ?)', (source, snapshot_id, snapshot_id))}
+
+    def changes(self, source, since, until=None):
+        """
+        What changed after snapshot since up to snapshot until (the newest by
+        default): {'files': [...], 'removed': [...], 'chunks': {region: [(x, z)]}}.
+        """
+        until = until or self.latest(source)
+        if until is None:
+            return {'files': [], 'removed': [], 'chunks': {}}
+        window = (source, since, until)
+        files = [row[0] for row in self.db.execute(
+            'SELECT DISTINCT path FROM files WHERE source = ? AND since > ? AND since <= ? ORDER BY path', window)]
+        removed = [row[0] for row in self.db.execute(
+            'SELECT DISTINCT path FROM files f WHERE source = ? AND until > ? AND until <= ? AND NOT EXISTS ('
+            'SELECT 1 FROM files g WHERE g.source = f.source AND g.path = f.path AND g.since <= ? '
+            'AND (g.until IS NULL OR g.until > ?)) ORDER BY path', window + (until, until))]
+        chunks = {}
+        for region, x, z in self.db.execute(
+                'SELECT DISTINCT region, x, z FROM chunks WHERE source = ? AND '
+                '((since > ? AND since <= ?) OR (until > ? AND until <= ?)) ORDER BY region, z, x',
+                window + (since, until)):
+            chunks.setdefault(region, []).append((x, z))
+        return {'files': files, 'removed': removed, 'chunks': chunks}
+
+    def file_history(self, source, rel):
+        """[(since, until, size, mtime_ns, hash)] of a file, oldest first."""
+        return self.db.execute(
+            'SELECT since, until, size, mtime_ns, hash FROM files WHERE source = ? AND path = ? ORDER BY since',
+            (source, rel)).fetchall()
+
+    def chunk_history(self, source, x, z, region_dir=None):
+        """
+        [(region, since, until, timestamp, object)] of the chunk at x, z,
+        oldest first; region_dir ('world/DIM-1/region') picks one dimension.
+        """
+        rows = self.db.execute(
+            'SELECT region, since, until, timestamp, object FROM chunks WHERE source = ? AND x = ? AND z = ? '
+            'ORDER BY since', (source, x, z)).fetchall()
+        if region_dir is not None:
+            rows = [row for row in rows if row[0].rsplit('/', 1)[0] == region_dir.strip('/')]
+        return rows
+
+
+def _inode(source_dir, rel, size, mtime_ns):
+    """Inode of rel under source_dir if the file there is still the recorded version."""
+    if source_dir is None:
+        return None
+    try:
+        st = os.stat(os.path.join(source_dir, rel))
+    except OSError:
+        return None
+    return st.st_ino if (st.st_size, st.st_mtime_ns) == (size, mtime_ns) else None
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Query the backup catalog.')
+    parser.add_argument('backup_dir', type=Path, help='BACKUP_DIR holding catalog.db')
+    parser.add_argument('--source', choices=SOURCES, default='chain')
+    commands = parser.add_subparsers(dest='command', required=True)
+    commands.add_parser('sync', help='record new backups, forget deleted ones')
+    commands.add_parser('list', help='list snapshots')
+    changes_parser = commands.add_parser('changes', help='what changed after a snapshot')
+    changes_parser.add_argument('since')
+    changes_parser.add_argument('--until')
+    history = commands.add_parser('history', help='versions of a file')
+    history.add_argument('path', help="relative to the data directory, like 'world/level.dat'")
+    chunk = commands.add_parser('chunk', help='versions of a chunk')
+    chunk.add_argument('x', type=int)
+    chunk.add_argument('z', type=int)
+    chunk.add_argument('--region-dir', help="directory of the region files, like 'world/DIM-1/region'")
+    args = parser.parse_args()
+
+    with Catalog(args.backup_dir / CATALOG_FILE) as catalog:
+        if args.command == 'sync':
+            print(f'{catalog.sync(args.backup_dir)} snapshots recorded')
+        elif args.command == 'list':
+            for source, snapshot_id, kind, created, location in catalog.snapshots():
+                print(f'{snapshot_id}  {source:5}  {kind:11}  {location}')
+        elif args.command == 'changes':
+            found = catalog.changes(args.source, args.since, args.until)
+            for rel in found['files']:
+                print(f'M {rel}')
+            for rel in found['removed']:
+                print(f'D {rel}')
+            for region, positions in found['chunks'].items():
+                print(f'C {region}: {len(positions)} chunks')
+        elif args.command == 'history':
+            for since, until, size, mtime_ns, digest in catalog.file_history(args.source, args.path):
+                print(f'{since} .. {until or "now":15}  {size:>12}  {digest or ""}')
+        else:
+            for region, since, until, timestamp, obj in catalog.chunk_history(args.source, args.x, args.z,
+                                                                              args.region_dir):
+                print(f'{since} .. {until or "now":15}  {region}  {timestamp}  {obj or ""}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,214 @@
+"""
+Compression codecs and per-file codec selection.
+
+Region files are made of zlib-compressed chunks and jars are zip files, so
+compressing them again costs CPU and saves next to nothing, while JSON
+stats, advancements and mod configs shrink several times. CodecSelector
+decides per file: known-compressed extensions are stored as they are, other
+files get a short probe where a few samples are compressed with every
+candidate codec and the one with the lowest
+
+    compressed bytes + CPU seconds * cpu_cost
+
+wins, `store` included. The choice is remembered per extension after a few
+probes, so thousands of similar files are not probed one by one.
+
+Every codec has a one-byte tag for self-describing objects (objstore), and
+a gzip level for .tar.gz archives, which can only switch deflate levels
+between members. zstd and lz4 are used when the zstandard and lz4 packages
+are installed.
+"""
+
+import collections
+import logging
+import lzma
+import time
+import zlib
+from pathlib import PurePosixPath
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+try:
+    import lz4.frame as lz4frame
+except ImportError:
+    lz4frame = None
+
+logger = logging.getLogger(__name__)
+
+TAG_STORE = 0
+TAG_ZLIB = 1
+TAG_XZ = 2
+TAG_ZSTD = 3
+TAG_LZ4 = 4
+
+DEFAULT_CANDIDATES = ('lz4', 'zlib-1', 'zlib-6', 'zstd-3', 'zstd-9', 'xz-6')
+# How many bytes of output one CPU-second of compression has to save.
+DEFAULT_CPU_COST = 8 * 2**20
+SAMPLE_SIZE = 64 * 2**10
+SAMPLES = 3
+PROBES_PER_TYPE = 4
+INCOMPRESSIBLE_SUFFIXES = frozenset((
+    '.mca', '.mcr', '.jar', '.zip', '.gz', '.tgz', '.xz', '.zst', '.lz4', '.bz2', '.7z',
+    '.png', '.jpg', '.jpeg', '.ogg',
+))
+
+
+class CodecError(Exception):
+    pass
+
+
+class Codec:
+    def __init__(self, name, tag, compress, gzip_level=None):
+        self.name = name
+        self.tag = tag
+        self.gzip_level = gzip_level
+        self._compress = compress
+
+    def compress(self, data):
+        return self._compress(data)
+
+    def __repr__(self):
+        return f'Codec({self.name!r})'
+
+
+def _zstd_compress(level):
+    compressor = zstandard.ZstdCompressor(level=level)
+    return compressor.compress
+
+
+def _build_registry():
+    codecs = {'store': Codec('store', TAG_STORE, bytes, gzip_level=0)}
+    for level in (1, 6, 9):
+        codecs[f'zlib-{level}'] = Codec(f'zlib-{level}', TAG_ZLIB,
+                                        lambda data, level=level: zlib.compress(data, level),
+                                        gzip_level=level)
+    for preset in (1, 6, 9):
+        codecs[f'xz-{preset}'] = Codec(f'xz-{preset}', TAG_XZ,
+                                       lambda data, preset=preset: lzma.compress(data, preset=preset))
+    if zstandard is not None:
+        for level in (1, 3, 9, 19):
+            codecs[f'zstd-{level}'] = Codec(f'zstd-{level}', TAG_ZSTD, _zstd_compress(level))
+    if lz4frame is not None:
+        codecs['lz4'] = Codec('lz4', TAG_LZ4, lz4frame.compress)
+    return codecs
+
+
+CODECS = _build_registry()
+STORE = CODECS['store']
+
+
+def _zstd_decompress(data):
+    return zstandard.ZstdDecompressor().decompress(data)
+
+
+_DECODERS = {
+    TAG_STORE: bytes,
+    TAG_ZLIB: zlib.decompress,
+    TAG_XZ: lzma.decompress,
+    TAG_ZSTD: _zstd_decompress if zstandard is not None else None,
+    TAG_LZ4: lz4frame.decompress if lz4frame is not None else None,
+}
+
+
+def get(name):
+    try:
+        return CODECS[name]
+    except KeyError:
+        raise CodecError(f'codec {name!r} is unknown or its package is not installed') from None
+
+
+def decode(tag, data):
+    """Decompress data written by a codec with the given tag."""
+    decoder = _DECODERS.get(tag)
+    if decoder is None:
+        raise CodecError(f'no decoder for codec tag {tag}')
+    return decoder(data)
+
+
+def available(names):
+    """The codecs among names that can be used here, logging the ones that cannot."""
+    result = []
+    for name in names:
+        if name in CODECS:
+            result.append(CODECS[name])
+        else:
+            logger.debug('Codec %s is not available and will not be probed', name)
+    return result
+
+
+def gzip_compatible(codecs):
+    return [c for c in codecs if c.gzip_level is not None]
+
+
+def read_sample(f, size, sample_size=SAMPLE_SIZE, samples=SAMPLES):
+    """Read up to samples pieces spread over a seekable file, then rewind it."""
+    if size <= sample_size * samples:
+        data = f.read(size)
+    else:
+        step = (size - sample_size) // (samples - 1)
+        pieces = []
+        for i in range(samples):
+            f.seek(i * step)
+            pieces.append(f.read(sample_size))
+        data = b''.join(pieces)
+    f.seek(0)
+    return data
+
+
+class CodecSelector:
+    """Pick a codec per file by extension or by probing a sample."""
+
+    def __init__(self, candidates, cpu_cost=DEFAULT_CPU_COST, probes_per_type=PROBES_PER_TYPE):
+        self.candidates = [c for c in candidates if c is not STORE]
+        self.cpu_cost = cpu_cost
+        self.probes_per_type = probes_per_type
+        self.probes = 0
+        self.usage = collections.defaultdict(lambda: [0, 0])
+        self._votes = collections.defaultdict(collections.Counter)
+        self._decided = {}
+
+    def probe(self, sample):
+        """The codec with the lowest size + CPU cost for sample."""
+        self.probes += 1
+        best, best_cost = STORE, len(sample)
+        for codec in self.candidates:
+            started = time.thread_time()
+            size = len(codec.compress(sample))
+            cost = size + (time.thread_time() - started) * self.cpu_cost
+            if cost < best_cost:
+                best, best_cost = codec, cost
+        return best
+
+    def choose(self, rel, f=None, size=None):
+        """
+        Codec for the file rel. f is the open file (rewound after sampling)
+        and size its length; both are only used when a probe is needed.
+        """
+        suffix = PurePosixPath(rel).suffix.lower()
+        if suffix in INCOMPRESSIBLE_SUFFIXES or not self.candidates:
+            return self._use(STORE, size)
+        codec = self._decided.get(suffix)
+        if codec is None:
+            codec = self.probe(read_sample(f, size))
+            votes = self._votes[suffix]
+            votes[codec.name] += 1
+            if sum(votes.values()) >= self.probes_per_type:
+                self._decided[suffix] = CODECS[votes.most_common(1)[0][0]]
+                logger.debug('Files with suffix %r will use %s', suffix, self._decided[suffix].name)
+        return self._use(codec, size)
+
+    def _use(self, codec, size):
+        entry = self.usage[codec.name]
+        entry[0] += 1
+        entry[1] += size or 0
+        return codec
+
+    def stats(self):
+        return {
+            'codec_probes': self.probes,
+            'codecs': {name: {'files': files, 'bytes': nbytes}
+                       for name, (files, nbytes) in sorted(self.usage.items())},
+        }
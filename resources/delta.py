@@ -0,0 +1,422 @@
+"""
+rsync-style deltas for large files that change in place.
+
+A signature splits a file into blocks and keeps a weak checksum (Adler-32,
+which can be rolled one byte at a time) and a strong hash (BLAKE2b, 16
+bytes) of every block. A delta of a newer version against a signature is a
+list of instructions, 'copy blocks i..j of the old version' or 'insert these
+bytes': at every position the block starting there is looked up by its weak
+checksum and confirmed by its strong hash; without a match the window rolls
+forward byte by byte (for at most one block) and the bytes passed over
+become literal data. Unchanged, moved and shifted blocks cost a few bytes
+each, so a delta is about as large as the data that really changed.
+
+Block hashing for signatures runs on a thread pool (zlib and hashlib
+release the GIL on large buffers), fed as the file streams through.
+
+Delta layout: a header (magic, version, block size, old size, new size,
+SHA-256 of the new version), then instructions:
+
+    0, first block (4 bytes), block count (4 bytes)     copy
+    1, length (4 bytes), data                           literal
+    2                                                   end
+"""
+
+import argparse
+import hashlib
+import math
+import os
+import struct
+import sys
+import zlib
+from array import array
+from concurrent.futures import ThreadPoolExecutor
+
+MAGIC = b'MCDL'
+VERSION = 1
+SIGNATURE_MAGIC = b'MCSG'
+SIGNATURE_VERSION = 1
+STRONG_SIZE = 16
+MIN_BLOCK_SIZE = 2048
+MAX_BLOCK_SIZE = 64 * 1024
+# Blocks hashed per thread pool task.
+BLOCKS_PER_TASK = 64
+READ_SIZE = 4 * 2**20
+LITERAL_FLUSH = 2**20
+# After this many blocks in a row without a match the window only rolls
+# through every SPARSE_ROLL-th block; the others get the aligned check alone.
+# Rewritten stretches cost much less, shifted data still resynchronises.
+DENSE_MISSES = 8
+SPARSE_ROLL = 16
+_ADLER_MOD = 65521
+
+OP_COPY = 0
+OP_LITERAL = 1
+OP_END = 2
+
+_HEADER = struct.Struct('>4sBIQQ32s')
+_COPY = struct.Struct('>BII')
+_LITERAL = struct.Struct('>BI')
+_SIGNATURE_HEADER = struct.Struct('>4sB')
+_SIGNATURE_ENTRY = struct.Struct('>HQII')
+
+
+class DeltaError(Exception):
+    pass
+
+
+def block_size_for(size):
+    """About the square root of the size, like rsync, within MIN_BLOCK_SIZE..MAX_BLOCK_SIZE."""
+    block = 1 << max(0, math.isqrt(size) - 1).bit_length()
+    return max(MIN_BLOCK_SIZE, min(MAX_BLOCK_SIZE, block))
+
+
+def _strong(data):
+    return hashlib.blake2b(data, digest_size=STRONG_SIZE).digest()
+
+
+def _hash_blocks(data, block_size):
+    weak, strong = array('I'), []
+    for offset in range(0, len(data), block_size):
+        block = data[offset:offset + block_size]
+        weak.append(zlib.adler32(block))
+        strong.append(_strong(block))
+    return weak, b''.join(strong)
+
+
+class Signature:
+    def __init__(self, size, block_size, weak, strong):
+        self.size = size
+        self.block_size = block_size
+        self.weak = weak
+        self.strong = strong
+        self._lookup = None
+
+    def __len__(self):
+        return len(self.weak)
+
+    def block_length(self, index):
+        return min(self.block_size, self.size - index * self.block_size)
+
+    def strong_hash(self, index):
+        return self.strong[index * STRONG_SIZE:(index + 1) * STRONG_SIZE]
+
+    @property
+    def lookup(self):
+        """{weak checksum: [block indices]}"""
+        if self._lookup is None:
+            self._lookup = {}
+            for index, value in enumerate(self.weak):
+                self._lookup.setdefault(value, []).append(index)
+        return self._lookup
+
+    def find(self, weak, data, prefer=None):
+        """
+        Index of a block equal to data (with Adler-32 weak), or None. Of
+        several equal blocks, prefer (the one after the last copied block)
+        wins, so runs of repeated data still become one copy instruction.
+        """
+        candidates = self.lookup.get(weak)
+        if not candidates:
+            return None
+        if prefer is not None and prefer < len(self.weak) and self.weak[prefer] == weak:
+            candidates = [prefer] + candidates
+        strong = None
+        for index in candidates:
+            if self.block_length(index) != len(data):
+                continue
+            if strong is None:
+                strong = _strong(data)
+            if strong == self.strong_hash(index):
+                return index
+        return None
+
+
+class SignatureBuilder:
+    """Builds a Signature from data fed in order; blocks are hashed on executor if given."""
+
+    def __init__(self, block_size, executor=None):
+        self.block_size = block_size
+        self.executor = executor
+        self.size = 0
+        self._pending = bytearray()
+        self._parts = []
+
+    def feed(self, data):
+        self.size += len(data)
+        self._pending += data
+        task_size = self.block_size * BLOCKS_PER_TASK
+        if len(self._pending) >= task_size:
+            cut = len(self._pending) - len(self._pending) % task_size
+            self._submit(bytes(self._pending[:cut]))
+            del self._pending[:cut]
+
+    def _submit(self, data):
+        if self.executor is None:
+            self._parts.append(_hash_blocks(data, self.block_size))
+        else:
+            self._parts.append(self.executor.submit(_hash_blocks, data, self.block_size))
+
+    def finish(self):
+        if self._pending:
+            self._submit(bytes(self._pending))
+            self._pending = bytearray()
+        weak, strong = array('I'), []
+        for part in self._parts:
+            part_weak, part_strong = part.result() if hasattr(part, 'result') else part
+            weak.extend(part_weak)
+            strong.append(part_strong)
+        return Signature(self.size, self.block_size, weak, b''.join(strong))
+
+
+class HashingReader:
+    """Passes reads of f through to a SignatureBuilder, e.g. while tarfile copies the file."""
+
+    def __init__(self, f, builder):
+        self.f = f
+        self.builder = builder
+
+    def read(self, size=-1):
+        data = self.f.read(size)
+        self.builder.feed(data)
+        return data
+
+    def readinto(self, buffer):
+        n = self.f.readinto(buffer)
+        self.builder.feed(memoryview(buffer)[:n])
+        return n
+
+
+def signature_of(f, size, workers=None):
+    """Signature of a whole file object, hashed on a thread pool."""
+    with ThreadPoolExecutor(workers or os.cpu_count() or 1, thread_name_prefix='signature') as executor:
+        builder = SignatureBuilder(block_size_for(size), executor)
+        while True:
+            data = f.read(READ_SIZE)
+            if not data:
+                break
+            builder.feed(data)
+        return builder.finish()
+
+
+def save_signatures(path, signatures):
+    """Write {rel: Signature} to path atomically."""
+    tmp = f'{path}.partial'
+    with open(tmp, 'wb') as f:
+        f.write(_SIGNATURE_HEADER.pack(SIGNATURE_MAGIC, SIGNATURE_VERSION))
+        for rel, signature in sorted(signatures.items()):
+            name = rel.encode('utf-8')
+            f.write(_SIGNATURE_ENTRY.pack(len(name), signature.size, signature.block_size, len(signature)))
+            f.write(name)
+            weak = array('I', signature.weak)
+            if weak.itemsize != 4:
+                raise DeltaError('array of unsigned int is not 32-bit on this platform')
+            if sys.byteorder == 'little':
+                weak.byteswap()
+            f.write(weak.tobytes())
+            f.write(signature.strong)
+    os.replace(tmp, path)
+
+
+def load_signatures(path):
+    """{rel: Signature} from a file written by save_signatures."""
+    with open(path, 'rb') as f:
+        magic, version = _SIGNATURE_HEADER.unpack(f.read(_SIGNATURE_HEADER.size))
+        if magic != SIGNATURE_MAGIC or version != SIGNATURE_VERSION:
+            raise DeltaError(f'{path} is not a signature file')
+        signatures = {}
+        while True:
+            head = f.read(_SIGNATURE_ENTRY.size)
+            if not head:
+                break
+            name_length, size, block_size, count = _SIGNATURE_ENTRY.unpack(head)
+            rel = f.read(name_length).decode('utf-8')
+            weak = array('I')
+            weak.frombytes(f.read(4 * count))
+            if sys.byteorder == 'little':
+                weak.byteswap()
+            strong = f.read(STRONG_SIZE * count)
+            if len(weak) != count or len(strong) != STRONG_SIZE * count:
+                raise DeltaError(f'{path} is truncated')
+            signatures[rel] = Signature(size, block_size, weak, strong)
+    return signatures
+
+
+class _DeltaWriter:
+    def __init__(self, out):
+        self.out = out
+        self.copy_start = None
+        self.copy_count = 0
+        self.literal = bytearray()
+        self.copied = 0
+        self.literal_bytes = 0
+
+    def copy(self, index, length):
+        self._flush_literal()
+        if self.copy_start is not None and index == self.copy_start + self.copy_count:
+            self.copy_count += 1
+        else:
+            self._flush_copy()
+            self.copy_start, self.copy_count = index, 1
+        self.copied += length
+
+    @property
+    def next_block(self):
+        return None if self.copy_start is None else self.copy_start + self.copy_count
+
+    def add_literal(self, data):
+        self._flush_copy()
+        self.literal += data
+        self.literal_bytes += len(data)
+        if len(self.literal) >= LITERAL_FLUSH:
+            self._flush_literal()
+
+    def _flush_copy(self):
+        if self.copy_start is not None:
+            self.out.write(_COPY.pack(OP_COPY, self.copy_start, self.copy_count))
+            self.copy_start, self.copy_count = None, 0
+
+    def _flush_literal(self):
+        if self.literal:
+            self.out.write(_LITERAL.pack(OP_LITERAL, len(self.literal)))
+            self.out.write(self.literal)
+            self.literal = bytearray()
+
+    def finish(self):
+        self._flush_copy()
+        self._flush_literal()
+        self.out.write(bytes([OP_END]))
+
+
+def make_delta(signature, f, out, max_literal=None):
+    """
+    Write to out (seekable, at offset 0) the delta turning the version
+    described by signature into the contents of file object f. Return
+    {'copied', 'literal', 'size', 'sha256'} or None, with out left undefined,
+    as soon as more than max_literal bytes would have to be stored as they are.
+    """
+    block_size = signature.block_size
+    digest = hashlib.sha256()
+    out.write(b'\0' * _HEADER.size)
+    writer = _DeltaWriter(out)
+    buf = bytearray()
+    pos = 0
+    size = 0
+    eof = False
+    misses = 0
+
+    def fill(length):
+        nonlocal pos, size, eof
+        if pos > READ_SIZE:
+            del buf[:pos]
+            pos = 0
+        while len(buf) - pos < length and not eof:
+            data = f.read(READ_SIZE)
+            if not data:
+                eof = True
+                break
+            digest.update(data)
+            size += len(data)
+            buf.extend(data)
+
+    while True:
+        fill(2 * block_size)
+        available = len(buf) - pos
+        if not available:
+            break
+        window = bytes(buf[pos:pos + block_size])
+        weak = zlib.adler32(window)
+        index = signature.find(weak, window, writer.next_block)
+        if index is not None:
+            writer.copy(index, len(window))
+            pos += len(window)
+            misses = 0
+            continue
+        # Roll forward one byte at a time for at most one block.
+        found = None
+        length = len(window)
+        misses += 1
+        if available > length and (misses <= DENSE_MISSES or misses % SPARSE_ROLL == 0):
+            lookup = signature.lookup
+            a, b = weak & 0xFFFF, weak >> 16
+            for k in range(1, min(block_size, available - length) + 1):
+                out_byte = buf[pos + k - 1]
+                in_byte = buf[pos + k + length - 1]
+                a = (a - out_byte + in_byte) % _ADLER_MOD
+                b = (b - length * out_byte + a - 1) % _ADLER_MOD
+                rolled = b << 16 | a
+                if rolled in lookup and signature.find(rolled, bytes(buf[pos + k:pos + k + length])) is not None:
+                    found = k
+                    break
+        step = found if found is not None else min(block_size, available)
+        writer.add_literal(buf[pos:pos + step])
+        pos += step
+        if max_literal is not None and writer.literal_bytes > max_literal:
+            return None
+    writer.finish()
+    end = out.tell()
+    out.seek(0)
+    out.write(_HEADER.pack(MAGIC, VERSION, block_size, signature.size, size, digest.digest()))
+    out.seek(end)
+    return {'copied': writer.copied, 'literal': writer.literal_bytes, 'size': size,
+            'sha256': digest.hexdigest()}
+
+
+def _read_exact(f, length):
+    data = f.read(length)
+    if len(data) < length:
+        raise DeltaError('delta is truncated')
+    return data
+
+
+def apply_delta(base, delta, out):
+    """Write the new version to out from the old version (seekable file object) and a delta."""
+    magic, version, block_size, base_size, size, expected = _HEADER.unpack(_read_exact(delta, _HEADER.size))
+    if magic != MAGIC or version != VERSION:
+        raise DeltaError('not a delta')
+    digest = hashlib.sha256()
+    written = 0
+    while True:
+        op = _read_exact(delta, 1)[0]
+        if op == OP_END:
+            break
+        if op == OP_COPY:
+            first, count = struct.unpack('>II', _read_exact(delta, 8))
+            base.seek(first * block_size)
+            remaining = min(count * block_size, base_size - first * block_size)
+            while remaining > 0:
+                data = base.read(min(remaining, READ_SIZE))
+                if not data:
+                    raise DeltaError('base file is shorter than the delta expects')
+                digest.update(data)
+                out.write(data)
+                remaining -= len(data)
+                written += len(data)
+        elif op == OP_LITERAL:
+            length, = struct.unpack('>I', _read_exact(delta, 4))
+            data = _read_exact(delta, length)
+            digest.update(data)
+            out.write(data)
+            written += length
+        else:
+            raise DeltaError(f'unknown delta instruction {op}')
+    if written != size or digest.digest() != expected:
+        raise DeltaError('delta does not match its base file')
+    return written
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Rebuild a file from its base version and a delta.')
+    commands = parser.add_subparsers(dest='command', required=True)
+    apply = commands.add_parser('apply', help='apply a delta from an incremental archive (.deltas/...)')
+    apply.add_argument('base', help='the file from the full archive of the chain')
+    apply.add_argument('delta')
+    apply.add_argument('output')
+    args = parser.parse_args()
+
+    with open(args.base, 'rb') as base, open(args.delta, 'rb') as delta, open(args.output, 'wb') as out:
+        print(f'{args.output}: {apply_delta(base, delta, out)} bytes')
+
+
+if __name__ == '__main__':
+    main()
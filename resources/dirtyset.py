@@ -0,0 +1,232 @@
+"""
+Dirty-set tracking of the data directory with inotify.
+
+A watcher thread keeps an inotify watch on every directory under the data
+directory (region folders of all dimensions, playerdata, data, mod folders;
+excluded paths like logs are skipped) and collects the paths created,
+written, deleted or moved since the last backup. The next incremental or
+store backup then stats only those paths and takes everything else from the
+previous manifest (incremental.iter_dirty) instead of walking the tens of
+thousands of files of a modded world.
+
+Files are tracked by path; a directory that was created or deleted is
+tracked as a whole and walked by the backup. The set is handed to one backup
+at a time and merged back if that backup fails, so no change is lost between
+runs. Whenever the set may be incomplete the next backup walks the whole
+tree instead: after a start (nothing was watched before), when the kernel
+event queue overflowed, when a directory was moved (the watches below it
+no longer know their paths) or when a watch could not be added because of
+fs.inotify.max_user_watches.
+
+inotify is called through ctypes; where it is not available every backup
+walks the tree as before.
+"""
+
+import ctypes
+import ctypes.util
+import errno
+import logging
+import os
+import select
+import struct
+import threading
+from contextlib import contextmanager
+from pathlib import Path
+
+logger = logging.getLogger(__name__)
+
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_DONT_FOLLOW = 0x02000000
+IN_EXCL_UNLINK = 0x04000000
+IN_ISDIR = 0x40000000
+
+WATCH_MASK = (IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE
+              | IN_DELETE | IN_MOVE_SELF | IN_ONLYDIR | IN_DONT_FOLLOW | IN_EXCL_UNLINK)
+
+_EVENT = struct.Struct('iIII')
+READ_SIZE = 256 * 1024
+POLL_SECONDS = 1.0
+
+
+def _load_libc():
+    libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+    libc.inotify_init1.argtypes = [ctypes.c_int]
+    libc.inotify_add_watch.argtypes = [ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32]
+    return libc
+
+
+class DirtyTracker:
+    """Collects the paths (relative to root, '/'-separated) changed since the last backup."""
+
+    def __init__(self, root, exclude=()):
+        self.root = Path(root)
+        self.exclude = set(exclude)
+        self._lock = threading.Lock()
+        self._files = set()
+        self._dirs = set()
+        # Nothing is known until a backup has walked the tree once.
+        self._full_scan = True
+        self._incomplete = False
+        self._libc = None
+        self._fd = None
+        self._watches = {}
+        self._stop = threading.Event()
+        self._thread = None
+        self.stats = {'events': 0, 'overflows': 0, 'full_scans': 0}
+
+    def start(self):
+        """Watch the tree; False (every backup walks the tree) if inotify is not available."""
+        try:
+            self._libc = _load_libc()
+            fd = self._libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+            if fd < 0:
+                raise OSError(ctypes.get_errno(), os.strerror(ctypes.get_errno()))
+        except (OSError, AttributeError) as e:
+            logger.warning('inotify is not available (%s), every backup walks the whole tree', e)
+            return False
+        self._fd = fd
+        self._watch_tree('')
+        self._thread = threading.Thread(target=self._run, name='dirty-set', daemon=True)
+        self._thread.start()
+        logger.info('Watching %d directories under %s for changes', len(self._watches), self.root)
+        return True
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd = None
+
+    @contextmanager
+    def pending(self):
+        """
+        Hand the dirty set to one backup: yields (files, dirs), or None when
+        that backup has to walk the whole tree. If the backup fails, the set
+        is merged back into the next one.
+        """
+        with self._lock:
+            if self._full_scan or self._incomplete or self._fd is None:
+                taken = None
+                self.stats['full_scans'] += 1
+            else:
+                taken = (self._files, self._dirs)
+            self._files, self._dirs = set(), set()
+            self._full_scan = False
+        try:
+            yield taken
+        except BaseException:
+            with self._lock:
+                if taken is None:
+                    self._full_scan = True
+                else:
+                    self._files |= taken[0]
+                    self._dirs |= taken[1]
+            raise
+
+    # Watches
+
+    def _excluded(self, rel):
+        parts = rel.split('/')
+        return any('/'.join(parts[:i]) in self.exclude for i in range(1, len(parts) + 1))
+
+    def _watch_tree(self, rel):
+        top = self.root / rel if rel else self.root
+        for dirpath, dirnames, _ in os.walk(top):
+            base = os.path.relpath(dirpath, self.root)
+            base = '' if base == '.' else base.replace(os.sep, '/')
+            dirnames[:] = [d for d in dirnames
+                           if not self._excluded(f'{base}/{d}' if base else d)]
+            if not self._add_watch(base):
+                return
+
+    def _add_watch(self, rel):
+        path = self.root / rel if rel else self.root
+        wd = self._libc.inotify_add_watch(self._fd, os.fsencode(path), WATCH_MASK)
+        if wd >= 0:
+            self._watches[wd] = rel
+            return True
+        err = ctypes.get_errno()
+        if err in (errno.ENOENT, errno.ENOTDIR):
+            return True
+        logger.warning('Cannot watch %s (%s); backups will walk the whole tree until restart%s',
+                       path, os.strerror(err),
+                       ', raise fs.inotify.max_user_watches' if err == errno.ENOSPC else '')
+        with self._lock:
+            self._incomplete = True
+        return False
+
+    # Events
+
+    def _run(self):
+        while not self._stop.is_set():
+            ready, _, _ = select.select([self._fd], [], [], POLL_SECONDS)
+            if not ready:
+                continue
+            try:
+                data = os.read(self._fd, READ_SIZE)
+            except BlockingIOError:
+                continue
+            offset = 0
+            while offset < len(data):
+                wd, mask, _, length = _EVENT.unpack_from(data, offset)
+                offset += _EVENT.size
+                name = os.fsdecode(data[offset:offset + length].rstrip(b'\0'))
+                offset += length
+                self.stats['events'] += 1
+                try:
+                    self._handle(wd, mask, name)
+                except Exception:
+                    logger.exception('Dirty-set tracking failed, the next backup walks the whole tree')
+                    with self._lock:
+                        self._full_scan = True
+
+    def _handle(self, wd, mask, name):
+        if mask & IN_Q_OVERFLOW:
+            self.stats['overflows'] += 1
+            logger.warning('inotify queue overflowed, the next backup walks the whole tree')
+            with self._lock:
+                self._full_scan = True
+            return
+        if mask & IN_IGNORED:
+            self._watches.pop(wd, None)
+            return
+        parent = self._watches.get(wd)
+        if parent is None:
+            return
+        if mask & IN_MOVE_SELF:
+            self._rewatch()
+            return
+        if not name:
+            return
+        rel = f'{parent}/{name}' if parent else name
+        if rel in self.exclude:
+            return
+        if not mask & IN_ISDIR:
+            with self._lock:
+                self._files.add(rel)
+        elif mask & (IN_MOVED_FROM | IN_MOVED_TO):
+            self._rewatch()
+        elif mask & (IN_CREATE | IN_DELETE):
+            with self._lock:
+                self._dirs.add(rel)
+            if mask & IN_CREATE:
+                self._watch_tree(rel)
+
+    def _rewatch(self):
+        """A directory moved: watches below it have stale paths, so watch everything again."""
+        with self._lock:
+            self._full_scan = True
+        self._watches.clear()
+        self._watch_tree('')
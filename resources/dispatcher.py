@@ -0,0 +1,128 @@
+"""
+Priority dispatcher in front of the shared RCON connection.
+
+Every command belongs to a priority class. The dispatcher always sends the
+highest-priority eligible command first, applies a token-bucket rate limit
+per class and caps the number of commands handed to the connection. One
+in-flight slot is reserved for CRITICAL commands, so backup quiesce commands
+(save-off, save-all, save-on) never queue behind monitoring polls; the
+connection sends one command at a time, so keeping the cap low also bounds
+how many commands already handed over a CRITICAL one waits for.
+
+Time spent waiting in the queue is recorded per class in a histogram.
+"""
+
+import asyncio
+import collections
+import logging
+import time
+
+from ratelimit import TokenBucket
+from stats import Histogram
+
+logger = logging.getLogger(__name__)
+
+CRITICAL = 0
+NORMAL = 1
+MONITORING = 2
+PRIORITY_NAMES = {CRITICAL: 'critical', NORMAL: 'normal', MONITORING: 'monitoring'}
+
+
+class _Entry:
+    __slots__ = ('command', 'timeout', 'future', 'enqueued')
+
+    def __init__(self, command, timeout, future):
+        self.command = command
+        self.timeout = timeout
+        self.future = future
+        self.enqueued = time.monotonic()
+
+
+class RconDispatcher:
+    def __init__(self, client, max_in_flight=2, rates=None):
+        """
+        client is an RconClient; rates maps a priority class to commands per
+        second (None or missing means unlimited).
+        """
+        self.client = client
+        self.max_in_flight = max(2, max_in_flight)
+        rates = rates or {}
+        self._queues = {p: collections.deque() for p in PRIORITY_NAMES}
+        self._buckets = {p: TokenBucket(rates.get(p)) for p in PRIORITY_NAMES}
+        self.latency = {p: Histogram() for p in PRIORITY_NAMES}
+        self._in_flight = 0
+        self._wakeup = asyncio.Event()
+        self._task = None
+
+    def _limit(self, priority):
+        return self.max_in_flight if priority == CRITICAL else self.max_in_flight - 1
+
+    def _pick(self):
+        """
+        Return (priority, entry) to send now, or (None, seconds until a rate
+        limit allows the next command; None when only a wakeup can help).
+        """
+        wait = None
+        for priority in sorted(self._queues):
+            queue = self._queues[priority]
+            while queue and queue[0].future.done():
+                queue.popleft()  # cancelled or timed out while queued
+            if not queue or self._in_flight >= self._limit(priority):
+                continue
+            bucket = self._buckets[priority]
+            if bucket.try_acquire():
+                return priority, queue.popleft()
+            delay = bucket.delay()
+            wait = delay if wait is None else min(wait, delay)
+        return None, wait
+
+    async def _run(self):
+        while True:
+            priority, entry = self._pick()
+            if priority is None:
+                self._wakeup.clear()
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), timeout=entry)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            self.latency[priority].observe(time.monotonic() - entry.enqueued)
+            self._in_flight += 1
+            asyncio.ensure_future(self._execute(entry))
+
+    async def _execute(self, entry):
+        try:
+            result = await self.client.command(entry.command, entry.timeout)
+        except Exception as e:
+            if not entry.future.done():
+                entry.future.set_exception(e)
+        else:
+            if not entry.future.done():
+                entry.future.set_result(result)
+        finally:
+            self._in_flight -= 1
+            self._wakeup.set()
+
+    async def command(self, command, priority=NORMAL, timeout=None):
+        """Queue a command in its priority class and return the response."""
+        if self._task is None or self._task.done():
+            self._task = asyncio.ensure_future(self._run())
+        entry = _Entry(command, timeout, asyncio.get_running_loop().create_future())
+        self._queues[priority].append(entry)
+        self._wakeup.set()
+        try:
+            return await entry.future
+        finally:
+            if not entry.future.done():
+                entry.future.cancel()
+
+    def set_rate(self, priority, rate):
+        self._buckets[priority].set_rate(rate)
+        self._wakeup.set()
+
+    def latency_snapshot(self):
+        return {PRIORITY_NAMES[p]: h.snapshot() for p, h in self.latency.items()}
+
+    async def close(self):
+        if self._task is not None:
+            self._task.cancel()
@@ -0,0 +1,687 @@
+"""
+Full and incremental backup chains.
+
+A chain starts with a full archive of the data directory and continues with
+incremental archives that hold only the files whose size or mtime changed
+and, for region files, only the chunks whose timestamp in the region header
+moved since the previous run. Every archive has a manifest next to it with
+the complete state (file stats and per-region timestamp tables), so the next
+run only needs the newest manifest to find out what changed.
+
+With a CodecSelector every member is compressed at the gzip level of the
+codec chosen for it (stored for regions, chunks and jars), and the choices
+for the archive's files are listed in the manifest under 'codecs'. The
+SHA-256 of every file an archive stores (whole or as a delta) is listed under
+'hashes'; region files are described by their timestamp tables instead.
+
+A chain can also be restarted without reading the data directory: a
+synthetic full backup merges the chain's full archive with the incrementals
+after it into a full archive of the newest backup (kind 'synthetic', same
+id as that incremental), and the following incrementals build on it.
+
+Large files that change in place (databases, big mod data files) need not
+be stored whole every time: full and synthetic backups save rsync-style
+signatures of them next to the archive (see delta.py), and an incremental
+stores such a file as a delta against its version in the chain's full
+archive under '.deltas/<path>' and lists it under the changes' 'deltas'.
+Deltas are differential, so restoring any backup applies at most one.
+"""
+
+import base64
+import gzip
+import hashlib
+import io
+import json
+import logging
+import os
+import shutil
+import stat
+import tarfile
+import tempfile
+from collections.abc import Mapping
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+from pathlib import Path
+
+import anvil
+import codec
+import delta
+import parallel_gzip
+import pipeline
+import walker
+from throttle import compress_gate, open_source
+
+logger = logging.getLogger(__name__)
+
+MANIFEST_VERSION = 1
+ARCHIVE_SUFFIX = '.tar.gz'
+MANIFEST_SUFFIX = '.manifest.json.gz'
+SIGNATURES_SUFFIX = '.signatures'
+# Incremental archives keep changed chunks under this prefix as
+# '.chunks/<region path>/<chunk index>' with the raw chunk payload.
+CHUNK_DIR = '.chunks'
+# Delta-encoded files in incremental archives, as '.deltas/<path>'.
+DELTA_DIR = '.deltas'
+# A delta is only kept if it stores less than this share of the file.
+DELTA_MAX_RATIO = 0.5
+# Deltas are built in memory up to this size, then in a temporary file.
+DELTA_SPOOL_SIZE = 16 * 2**20
+# Kinds of backups that do not depend on earlier ones.
+FULL_KINDS = ('full', 'synthetic')
+
+
+def iter_tree(root, exclude=(), workers=None):
+    """
+    Yield (relative posix path, stat) for every regular file under root, in
+    no particular order; directories are walked in parallel (walker.py).
+    """
+    return walker.walk(root, exclude, workers)
+
+
+class RecordedStat:
+    """Size and mtime of a file as recorded in a manifest, standing in for os.stat_result."""
+
+    __slots__ = ('st_size', 'st_mtime_ns')
+
+    def __init__(self, size, mtime_ns):
+        self.st_size = size
+        self.st_mtime_ns = mtime_ns
+
+
+def iter_dirty(root, previous, files, dirs, exclude=()):
+    """
+    Yield (relative posix path, stat) like iter_tree, from the previous state
+    ({rel: [size, mtime_ns, ...]}) and the paths changed since (dirtyset.py):
+    only the files in files and the trees under dirs are looked at on disk,
+    every other path keeps its recorded size and mtime.
+    """
+    root = str(root)
+
+    def covered(rel, within):
+        parts = rel.split('/')
+        return any('/'.join(parts[:i]) in within for i in range(1, len(parts)))
+
+    found = {rel: RecordedStat(entry[0], entry[1]) for rel, entry in previous.items()
+             if rel not in files and not covered(rel, dirs)}
+    for rel in files:
+        if rel in exclude or covered(rel, exclude) or covered(rel, dirs):
+            continue
+        try:
+            st = os.lstat(os.path.join(root, rel))
+        except (FileNotFoundError, NotADirectoryError):
+            continue
+        if stat.S_ISREG(st.st_mode):
+            found[rel] = st
+    for top in dirs:
+        if top in exclude or covered(top, exclude) or covered(top, dirs):
+            continue
+        inner = {rel[len(top) + 1:] for rel in exclude if rel.startswith(top + '/')}
+        for rel, st in iter_tree(os.path.join(root, top), inner):
+            found[f'{top}/{rel}'] = st
+    for rel in sorted(found):
+        yield rel, found[rel]
+
+
+def is_region_path(rel):
+    return anvil.is_region_file(rel.rsplit('/', 1)[-1])
+
+
+def archive_name(backup_id, kind):
+    return f'{backup_id}-{kind}{ARCHIVE_SUFFIX}'
+
+
+def manifest_name(backup_id, kind):
+    return f'{backup_id}-{kind}{MANIFEST_SUFFIX}'
+
+
+def signatures_name(backup_id, kind):
+    return f'{backup_id}-{kind}{SIGNATURES_SUFFIX}'
+
+
+def parse_manifest_name(name):
+    """Return (backup_id, kind) for a manifest file name."""
+    stem = name[:-len(MANIFEST_SUFFIX)]
+    backup_id, _, kind = stem.rpartition('-')
+    return backup_id, kind
+
+
+def load_manifest(path):
+    with gzip.open(path, 'rt', encoding='utf-8') as f:
+        return json.load(f)
+
+
+def save_manifest(path, manifest):
+    path = Path(path)
+    tmp = path.with_name(path.name + '.partial')
+    with gzip.open(tmp, 'wt', encoding='utf-8') as f:
+        json.dump(manifest, f, separators=(',', ':'))
+    os.replace(tmp, path)
+
+
+def list_manifests(archive_dir):
+    """Manifest paths of all backups in archive_dir, oldest first."""
+    return sorted(Path(archive_dir).glob('*' + MANIFEST_SUFFIX))
+
+
+def incrementals_since_full(archive_dir):
+    """Number of incremental backups made after the newest full backup."""
+    count = 0
+    for path in reversed(list_manifests(archive_dir)):
+        if parse_manifest_name(path.name)[1] in FULL_KINDS:
+            return count
+        count += 1
+    return None
+
+
+def chain_signatures(archive_dir):
+    """Signatures saved with the newest full or synthetic backup, {} if there are none."""
+    for path in reversed(list_manifests(archive_dir)):
+        backup_id, kind = parse_manifest_name(path.name)
+        if kind in FULL_KINDS:
+            path = Path(archive_dir) / signatures_name(backup_id, kind)
+            if not path.exists():
+                return {}
+            try:
+                return delta.load_signatures(path)
+            except (OSError, delta.DeltaError) as e:
+                logger.warning('Ignoring signatures %s: %s', path.name, e)
+                return {}
+    return {}
+
+
+class _Signer:
+    """Builds signatures of the large files of a full archive while they are written."""
+
+    def __init__(self, min_size, workers=None):
+        self.min_size = min_size
+        self._builders = {}
+        self._executor = None
+        self._workers = workers
+
+    def wrap(self, rel, f, size):
+        if self.min_size is None or size < self.min_size or is_region_path(rel):
+            return f
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(self._workers or os.cpu_count() or 1,
+                                                thread_name_prefix='signature')
+        builder = delta.SignatureBuilder(delta.block_size_for(size), self._executor)
+        self._builders[rel] = builder
+        return delta.HashingReader(f, builder)
+
+    def save(self, path):
+        signatures = {rel: builder.finish() for rel, builder in self._builders.items()}
+        if self._executor is not None:
+            self._executor.shutdown()
+        if signatures:
+            delta.save_signatures(path, signatures)
+
+
+def _region_table(path):
+    with open_source(path) as f:
+        locations, timestamps = anvil.read_header(f)
+    return anvil.effective_timestamps(locations, timestamps)
+
+
+def _encode_table(table):
+    return base64.b64encode(anvil.pack_table(table)).decode('ascii')
+
+
+def _decode_table(text):
+    return anvil.unpack_table(base64.b64decode(text))
+
+
+class _Sha256:
+    """Hashes what a delta.HashingReader passes through."""
+
+    def __init__(self):
+        self.digest = hashlib.sha256()
+
+    def feed(self, data):
+        self.digest.update(data)
+
+
+def add_file(tar, path, rel, selector=None, codecs=None, signer=None, hashes=None):
+    """
+    Add one file to a tar from pipeline.open_tar. With a selector the
+    file is compressed at its codec's gzip level, recorded in codecs; its
+    SHA-256 goes to hashes if given.
+    """
+    info = tar.gettarinfo(str(path), arcname=rel)
+    with open_source(path) as f:
+        if selector is not None:
+            chosen = selector.choose(rel, f, info.size)
+            tar.fileobj.set_level(chosen.gzip_level)
+            if codecs is not None:
+                codecs[rel] = chosen.name
+        reader = signer.wrap(rel, f, info.size) if signer is not None else f
+        if hashes is not None:
+            sha = _Sha256()
+            reader = delta.HashingReader(reader, sha)
+        tar.addfile(info, reader)
+        if hashes is not None:
+            hashes[rel] = sha.digest.hexdigest()
+    return info.size
+
+
+def _add_delta(tar, path, rel, signature, selector=None, codecs=None, hashes=None):
+    """
+    Add the delta of one file against signature as '.deltas/<rel>' and return
+    its size, or None (nothing added) if it would not save enough. The
+    file's SHA-256 goes to hashes if given.
+    """
+    info = tar.gettarinfo(str(path), arcname=f'{DELTA_DIR}/{rel}')
+    with open_source(path) as f, tempfile.SpooledTemporaryFile(DELTA_SPOOL_SIZE) as out:
+        chosen = selector.choose(rel, f, info.size) if selector is not None else None
+        made = delta.make_delta(signature, f, out, int(info.size * DELTA_MAX_RATIO))
+        if made is None:
+            return None
+        info.size = out.tell()
+        out.seek(0)
+        if chosen is not None:
+            tar.fileobj.set_level(chosen.gzip_level)
+            if codecs is not None:
+                codecs[rel] = chosen.name
+        tar.addfile(info, out)
+    if hashes is not None:
+        hashes[rel] = made['sha256']
+    return info.size
+
+
+def _add_chunks(tar, path, rel, previous_table, changes, selector=None, forced=()):
+    """
+    Store the chunks of one region whose timestamps differ from the previous
+    run, plus the forced ones, and return (current timestamp table, stored bytes).
+    """
+    changed, deleted = [], []
+    size = 0
+    if selector is not None:
+        # Chunk payloads are compressed by the server already.
+        tar.fileobj.set_level(codec.STORE.gzip_level)
+    with open_source(path) as f:
+        locations, timestamps = anvil.read_header(f)
+        current = anvil.effective_timestamps(locations, timestamps)
+        for index in range(anvil.CHUNKS_PER_REGION):
+            if current[index] == previous_table[index] and index not in forced:
+                continue
+            if not current[index]:
+                deleted.append(index)
+                continue
+            payload = anvil.read_chunk(f, locations[index])
+            info = tarfile.TarInfo(f'{CHUNK_DIR}/{rel}/{index}')
+            info.size = len(payload)
+            info.mtime = current[index]
+            tar.addfile(info, io.BytesIO(payload))
+            changed.append(index)
+            size += len(payload)
+    if changed:
+        changes['chunks'][rel] = changed
+    if deleted:
+        changes['deleted_chunks'][rel] = deleted
+    return current, size
+
+
+def create_backup(source_dir, archive_dir, backup_id, previous=None, exclude=(),
+                  workers=None, level=parallel_gzip.DEFAULT_LEVEL, selector=None, forced=None,
+                  delta_min_size=None, dirty=None, metrics=None):
+    """
+    Archive source_dir into archive_dir and return the new manifest.
+
+    Without a previous manifest a full archive is written; otherwise only the
+    differences against it end up in the archive. workers and level are passed
+    to the parallel gzip compressor; selector, if given, overrides the level
+    per file. forced maps region paths to chunk indices that are stored
+    even if their timestamps did not move (see restore.py). Files of at
+    least delta_min_size bytes get signatures in a full backup and are
+    stored as deltas in an incremental one; None turns deltas off. dirty,
+    (files, dirs) from dirtyset.py, limits an incremental backup to looking
+    at the paths changed since the previous one. The stage report of the
+    archive writer goes to metrics['pipeline'] if metrics is given.
+    """
+    forced = forced or {}
+    source_dir = Path(source_dir)
+    archive_dir = Path(archive_dir)
+    archive_dir.mkdir(parents=True, exist_ok=True)
+    kind = 'full' if previous is None else 'incremental'
+    archive_path = archive_dir / archive_name(backup_id, kind)
+    tmp_path = archive_path.with_name(archive_path.name + '.partial')
+
+    prev_files = previous['files'] if previous else {}
+    prev_regions = previous['regions'] if previous else {}
+    files, regions = {}, {}
+    changes = {'files': [], 'chunks': {}, 'deleted_chunks': {}, 'removed': []}
+    codecs = {}
+    hashes = {}
+    stored = 0
+    deltas = []
+    signer = _Signer(delta_min_size, workers) if previous is None else None
+    signatures = chain_signatures(archive_dir) if previous is not None and delta_min_size is not None else {}
+
+    if previous is None or dirty is None:
+        entries = iter_tree(source_dir, exclude)
+    else:
+        entries = iter_dirty(source_dir, {**prev_files, **prev_regions}, *dirty, exclude)
+    try:
+        with pipeline.open_tar(tmp_path, workers, level, gate=compress_gate, metrics=metrics) as tar:
+            for rel, st in entries:
+                path = source_dir / rel
+                if is_region_path(rel):
+                    prev = prev_regions.get(rel)
+                    if prev and prev[0] == st.st_size and prev[1] == st.st_mtime_ns and rel not in forced:
+                        regions[rel] = prev
+                        continue
+                    if previous is None:
+                        table = _region_table(path)
+                        stored += add_file(tar, path, rel, selector, codecs, signer)
+                    else:
+                        previous_table = _decode_table(prev[2]) if prev else [0] * anvil.CHUNKS_PER_REGION
+                        table, size = _add_chunks(tar, path, rel, previous_table, changes, selector,
+                                                  set(forced.get(rel, ())))
+                        stored += size
+                    regions[rel] = [st.st_size, st.st_mtime_ns, _encode_table(table)]
+                else:
+                    files[rel] = [st.st_size, st.st_mtime_ns]
+                    if prev_files.get(rel) != files[rel]:
+                        size = None
+                        if rel in signatures and st.st_size >= delta_min_size:
+                            size = _add_delta(tar, path, rel, signatures[rel], selector, codecs, hashes)
+                        if size is None:
+                            size = add_file(tar, path, rel, selector, codecs, signer, hashes)
+                        else:
+                            deltas.append(rel)
+                        stored += size
+                        changes['files'].append(rel)
+    except BaseException:
+        tmp_path.unlink(missing_ok=True)
+        raise
+    os.replace(tmp_path, archive_path)
+    if signer is not None:
+        signer.save(archive_dir / signatures_name(backup_id, kind))
+    if deltas:
+        changes['deltas'] = deltas
+
+    changes['removed'] = sorted((set(prev_files) - set(files)) | (set(prev_regions) - set(regions)))
+    manifest = {
+        'version': MANIFEST_VERSION,
+        'id': backup_id,
+        'kind': kind,
+        'base': previous['id'] if previous else None,
+        'created': datetime.now().isoformat(timespec='seconds'),
+        'archive': archive_path.name,
+        'files': files,
+        'regions': regions,
+    }
+    if codecs:
+        manifest['codecs'] = codecs
+    if hashes:
+        manifest['hashes'] = hashes
+    if previous is not None:
+        manifest['changes'] = changes
+        logger.info(
+            'Incremental backup %s: %d files (%d as deltas), %d chunks changed, %d chunks deleted, '
+            '%d paths removed', backup_id, len(changes['files']), len(deltas),
+            sum(len(v) for v in changes['chunks'].values()),
+            sum(len(v) for v in changes['deleted_chunks'].values()),
+            len(changes['removed']))
+    logger.info('Stored %.1f MiB of data in %s', stored / 2**20, archive_path.name)
+    save_manifest(archive_dir / manifest_name(backup_id, kind), manifest)
+    return manifest
+
+
+def run_backup(source_dir, archive_dir, backup_id, full_every, exclude=(),
+               workers=None, level=parallel_gzip.DEFAULT_LEVEL, selector=None, forced=None,
+               synthetic=False, delta_min_size=None, dirty=None, metrics=None):
+    """
+    Make a full backup when the chain is empty or too long, otherwise an
+    incremental one. With synthetic, only an empty chain gets a full backup
+    from source_dir; long chains are restarted by synthesize_full() instead.
+    """
+    manifests = list_manifests(archive_dir)
+    since_full = incrementals_since_full(archive_dir)
+    previous = None
+    if manifests and since_full is not None and (synthetic or since_full < full_every):
+        previous = load_manifest(manifests[-1])
+    return create_backup(source_dir, archive_dir, backup_id, previous, exclude, workers, level,
+                         selector, forced, delta_min_size, dirty, metrics)
+
+
+@contextmanager
+def _open_archive(path):
+    """Stream the members of an archive; GzipFile reads all members of a parallel_gzip stream."""
+    with open_source(path) as f, gzip.GzipFile(fileobj=f) as gz, tarfile.open(fileobj=gz, mode='r|') as tar:
+        yield tar
+
+
+class _LazyChunks(Mapping):
+    """Chunk payloads of a region by index, read only when anvil.write_region asks for them."""
+
+    def __init__(self, indices, load):
+        self._indices = indices
+        self._load = load
+
+    def __getitem__(self, index):
+        return self._load(index)
+
+    def __iter__(self):
+        return iter(self._indices)
+
+    def __len__(self):
+        return len(self._indices)
+
+
+def synthesis_due(archive_dir, full_every):
+    since_full = incrementals_since_full(archive_dir)
+    return since_full is not None and since_full >= full_every
+
+
+def synthesize_full(archive_dir, workers=None, level=parallel_gzip.DEFAULT_LEVEL, delta_min_size=None,
+                    metrics=None):
+    """
+    Merge the newest full archive with the incrementals after it into a full
+    archive of the newest backup and return its manifest (None when there is
+    nothing to merge). Only archive_dir is read: regions changed in the chain
+    are rebuilt from the full archive's region and the newest copy of every
+    changed chunk, files stored as deltas are patched from the full archive's
+    copy, everything else is copied from the archive holding it. Signatures
+    are saved for files of at least delta_min_size bytes. The stage report
+    of the archive writer goes to metrics['pipeline'] if metrics is given.
+    """
+    archive_dir = Path(archive_dir)
+    chain = []
+    for path in list_manifests(archive_dir):
+        if parse_manifest_name(path.name)[1] in FULL_KINDS:
+            chain = []
+        chain.append(path)
+    if len(chain) < 2:
+        return None
+    manifests = [load_manifest(path) for path in chain]
+    target = manifests[-1]
+    backup_id = target['id']
+
+    # Which incremental holds the newest copy of every file and chunk changed after the full archive.
+    file_source, chunk_source = {}, {}
+    patched, reset, deltas = set(), set(), set()
+    for position, manifest in enumerate(manifests[1:], 1):
+        changes = manifest['changes']
+        for rel in changes['removed']:
+            file_source.pop(rel, None)
+            chunk_source.pop(rel, None)
+            reset.add(rel)
+        for rel in changes['files']:
+            file_source[rel] = position
+            deltas.discard(rel)
+        deltas.update(changes.get('deltas', ()))
+        for rel, indices in changes['chunks'].items():
+            chunk_source.setdefault(rel, {}).update(dict.fromkeys(indices, position))
+            patched.add(rel)
+        for rel, indices in changes['deleted_chunks'].items():
+            for index in indices:
+                chunk_source.get(rel, {}).pop(index, None)
+            patched.add(rel)
+
+    archive_path = archive_dir / archive_name(backup_id, 'synthetic')
+    tmp_path = archive_path.with_name(archive_path.name + '.partial')
+    # Rebuilt regions are stored like any region when the chain was made with a selector.
+    region_codec = codec.STORE.name if any('codecs' in m for m in manifests) else None
+    codecs = {}
+    # Winning members of the incrementals, spilled next to the archives.
+    spilled = {}
+    try:
+        with tempfile.TemporaryFile(dir=archive_dir) as spill:
+            for position, manifest in enumerate(manifests[1:], 1):
+                with _open_archive(archive_dir / manifest['archive']) as tar:
+                    for info in tar:
+                        rel = info.name
+                        if rel.startswith(CHUNK_DIR + '/'):
+                            rel, _, index = rel[len(CHUNK_DIR) + 1:].rpartition('/')
+                            wanted = chunk_source.get(rel, {}).get(int(index)) == position
+                        elif rel.startswith(DELTA_DIR + '/'):
+                            rel = rel[len(DELTA_DIR) + 1:]
+                            wanted = file_source.get(rel) == position and rel in deltas
+                        else:
+                            wanted = file_source.get(rel) == position and rel not in deltas
+                        if wanted:
+                            offset = spill.seek(0, os.SEEK_END)
+                            shutil.copyfileobj(tar.extractfile(info), spill)
+                            spilled[info.name] = (offset, info, manifest.get('codecs', {}).get(rel))
+
+            def read_spilled(name):
+                offset, info, _ = spilled[name]
+                spill.seek(offset)
+                return spill.read(info.size)
+
+            def open_spilled(name):
+                """The spill file at the start of a member; readers stop at the member's size."""
+                spill.seek(spilled[name][0])
+                return spill
+
+            def rebuild(rel, base, out):
+                """Write region rel as of the target backup to out, one chunk in memory at a time."""
+                table = _decode_table(target['regions'][rel][2])
+                sources = chunk_source.get(rel, {})
+                if base is not None:
+                    locations, _ = anvil.read_header(base)
+                present = []
+                for index, timestamp in enumerate(table):
+                    if not timestamp:
+                        continue
+                    if index not in sources and (base is None or not locations[index][0]):
+                        raise anvil.RegionError(f'chunk {index} of {rel} is missing from the chain')
+                    present.append(index)
+
+                def load(index):
+                    if index in sources:
+                        return read_spilled(f'{CHUNK_DIR}/{rel}/{index}')
+                    return anvil.read_chunk(base, locations[index])
+
+                anvil.write_region(out, table, _LazyChunks(present, load))
+
+            def add(tar, info, data_or_file, codec_name):
+                tar.fileobj.set_level(codec.get(codec_name).gzip_level if codec_name else level)
+                if codec_name:
+                    codecs[info.name] = codec_name
+                if isinstance(data_or_file, bytes):
+                    info.size = len(data_or_file)
+                    data_or_file = io.BytesIO(data_or_file)
+                tar.addfile(info, signer.wrap(info.name, data_or_file, info.size))
+
+            def add_patched(tar, info, base_file):
+                rel = info.name
+                with tempfile.SpooledTemporaryFile(DELTA_SPOOL_SIZE, dir=archive_dir) as old, \
+                        tempfile.SpooledTemporaryFile(DELTA_SPOOL_SIZE, dir=archive_dir) as new:
+                    shutil.copyfileobj(base_file, old)
+                    old.seek(0)
+                    info.size = delta.apply_delta(old, open_spilled(f'{DELTA_DIR}/{rel}'), new)
+                    info.mtime = target['files'][rel][1] // 10**9
+                    new.seek(0)
+                    add(tar, info, new, spilled[f'{DELTA_DIR}/{rel}'][2])
+
+            def add_rebuilt(tar, info, base_file):
+                rel = info.name
+                with tempfile.SpooledTemporaryFile(DELTA_SPOOL_SIZE, dir=archive_dir) as old, \
+                        tempfile.SpooledTemporaryFile(DELTA_SPOOL_SIZE, dir=archive_dir) as new:
+                    if base_file is not None:
+                        shutil.copyfileobj(base_file, old)
+                        old.seek(0)
+                    rebuild(rel, old if base_file is not None else None, new)
+                    info.size = new.seek(0, os.SEEK_END)
+                    info.mtime = target['regions'][rel][1] // 10**9
+                    new.seek(0)
+                    add(tar, info, new, region_codec)
+
+            full_manifest = manifests[0]
+            full_codecs = full_manifest.get('codecs', {})
+            done = set()
+            signer = _Signer(delta_min_size, workers)
+            with pipeline.open_tar(tmp_path, workers, level, gate=compress_gate, metrics=metrics) as out:
+                full_path = archive_dir / full_manifest['archive']
+                with _open_archive(full_path) as base:
+                    for info in base:
+                        rel = info.name
+                        if is_region_path(rel):
+                            if rel not in target['regions'] or rel in reset:
+                                continue
+                            if rel in patched:
+                                add_rebuilt(out, info, base.extractfile(info))
+                            else:
+                                add(out, info, base.extractfile(info), full_codecs.get(rel))
+                        elif rel in target['files'] and rel not in file_source:
+                            add(out, info, base.extractfile(info), full_codecs.get(rel))
+                        elif rel in target['files'] and rel in deltas:
+                            add_patched(out, info, base.extractfile(info))
+                        else:
+                            continue
+                        done.add(rel)
+                for rel in sorted(set(target['regions']) - done):
+                    add_rebuilt(out, tarfile.TarInfo(rel), None)
+                for rel in sorted(set(target['files']) - done):
+                    _, info, codec_name = spilled[rel]
+                    add(out, info, open_spilled(rel), codec_name)
+    except BaseException:
+        tmp_path.unlink(missing_ok=True)
+        raise
+    os.replace(tmp_path, archive_path)
+    signer.save(archive_dir / signatures_name(backup_id, 'synthetic'))
+
+    manifest = {
+        'version': MANIFEST_VERSION,
+        'id': backup_id,
+        'kind': 'synthetic',
+        'base': None,
+        'created': datetime.now().isoformat(timespec='seconds'),
+        'archive': archive_path.name,
+        'merged': [m['id'] for m in manifests],
+        'files': target['files'],
+        'regions': target['regions'],
+    }
+    if codecs:
+        manifest['codecs'] = codecs
+    save_manifest(archive_dir / manifest_name(backup_id, 'synthetic'), manifest)
+    logger.info('Synthetic full backup %s merged from %d archives: %.1f MiB',
+                backup_id, len(manifests), archive_path.stat().st_size / 2**20)
+    return manifest
+
+
+def prune_chains(archive_dir, keep_days):
+    """
+    Delete whole chains whose newest backup is older than keep_days.
+
+    The newest chain is always kept, and incrementals are never removed
+    without the full backup they are based on.
+    """
+    cutoff = datetime.now() - timedelta(days=keep_days)
+    chains = []
+    for path in list_manifests(archive_dir):
+        backup_id, kind = parse_manifest_name(path.name)
+        if kind in FULL_KINDS or not chains:
+            chains.append([])
+        chains[-1].append((backup_id, kind))
+    for chain in chains[:-1]:
+        newest = datetime.strptime(chain[-1][0], '%Y%m%d-%H%M%S')
+        if newest >= cutoff:
+            continue
+        for backup_id, kind in chain:
+            for name in (archive_name(backup_id, kind), manifest_name(backup_id, kind),
+                         signatures_name(backup_id, kind)):
+                (Path(archive_dir) / name).unlink(missing_ok=True)
+        logger.info('Removed backup chain %s..%s', chain[0][0], chain[-1][0])
@@ -0,0 +1,566 @@
+"""
+Chunk change journal for point-in-time recovery.
+
+Backups give one recovery point per run. The journal adds one per poll:
+every JOURNAL_INTERVAL_SECONDS the region headers of the world are compared
+with the previous poll (only regions whose size or mtime moved are opened)
+and the chunks whose location or save timestamp changed are appended to an
+append-only segment file, together with whole copies of the changed
+non-region files (level.dat, playerdata, ...). Nothing else is read, so a
+poll costs a stat of every file plus the changed chunks.
+
+Segments are named after the time of their first recovery point and hold
+records:
+
+    kind, path length, chunk index, data length, CRC-32 of the data,
+    value (chunk timestamp, file mtime or commit time), path, data
+
+A poll ends with a COMMIT record carrying its time; records after the last
+commit (a crash in the middle of a poll) are ignored by readers and cut off
+before the next append. A BASE record starts a batch that holds the complete
+state of the world, written on the first poll and by compaction.
+
+Compaction folds all segments older than the retention period into one
+checkpoint segment (a BASE batch with the state at the last folded recovery
+point), so the journal keeps every point of the last JOURNAL_RETENTION_HOURS
+and never grows past one copy of the world plus that period's changes.
+
+The server may be writing a chunk while it is read; chunks that do not
+decompress completely are left for the next poll.
+"""
+
+import argparse
+import base64
+import json
+import logging
+import os
+import struct
+import threading
+import time
+import zlib
+from datetime import datetime
+from pathlib import Path
+
+import anvil
+import incremental
+import regionpack
+from throttle import open_source
+
+logger = logging.getLogger(__name__)
+
+MAGIC = b'MCJL'
+VERSION = 1
+SEGMENT_SUFFIX = '.mcj'
+STATE_FILE = 'state.json'
+# A new segment is started once the current one is this large or this old;
+# compaction can only drop whole segments.
+SEGMENT_SIZE = 64 * 2**20
+SEGMENT_SECONDS = 3600
+WRITE_BUFFER = 2**20
+
+BASE = 1
+CHUNK = 2
+CHUNK_DELETED = 3
+FILE = 4
+REMOVED = 5
+COMMIT = 6
+
+_SEGMENT_HEADER = struct.Struct('>4sB')
+_RECORD = struct.Struct('>BHHIIQ')
+
+
+class JournalError(Exception):
+    pass
+
+
+def list_segments(root):
+    return sorted(Path(root).glob('*' + SEGMENT_SUFFIX))
+
+
+def _segment_time(path):
+    return int(path.name[:-len(SEGMENT_SUFFIX)])
+
+
+def format_time(time_ns):
+    return datetime.fromtimestamp(time_ns / 1e9).isoformat(timespec='seconds')
+
+
+def parse_time(text):
+    """Nanoseconds since the epoch for a local ISO time such as '2026-10-18T12:30'."""
+    try:
+        return int(datetime.fromisoformat(text).timestamp() * 10**9)
+    except ValueError:
+        raise JournalError(f'not an ISO date and time: {text}') from None
+
+
+def _read_records(fd):
+    """
+    Yield (kind, rel, index, value, (fd, offset, length, crc)) for the
+    records of a segment, stopping at a torn tail.
+    """
+    size = os.fstat(fd).st_size
+    with open(fd, 'rb', closefd=False) as f:
+        header = f.read(_SEGMENT_HEADER.size)
+        if len(header) < _SEGMENT_HEADER.size:
+            # Just created, nothing flushed yet.
+            return
+        magic, version = _SEGMENT_HEADER.unpack(header)
+        if magic != MAGIC or version != VERSION:
+            raise JournalError('not a journal segment')
+        offset = _SEGMENT_HEADER.size
+        while True:
+            head = f.read(_RECORD.size)
+            if len(head) < _RECORD.size:
+                return
+            kind, rel_length, index, length, crc, value = _RECORD.unpack(head)
+            rel = f.read(rel_length)
+            offset += _RECORD.size + rel_length
+            if len(rel) < rel_length or offset + length > size:
+                return
+            f.seek(length, os.SEEK_CUR)
+            yield kind, rel.decode('utf-8'), index, value, (fd, offset, length, crc)
+            offset += length
+
+
+def _batches(fd):
+    """Yield (commit time, base, records, end offset) for every committed batch of a segment."""
+    records, base = [], False
+    for kind, rel, index, value, location in _read_records(fd):
+        if kind == COMMIT:
+            yield value, base, records, location[1] + location[2]
+            records, base = [], False
+        elif kind == BASE:
+            base = True
+        else:
+            records.append((kind, rel, index, value, location))
+
+
+def _read_location(location):
+    fd, offset, length, crc = location
+    data = os.pread(fd, length, offset)
+    if len(data) < length or zlib.crc32(data) != crc:
+        raise JournalError(f'damaged record at offset {offset}')
+    return data
+
+
+class JournalState:
+    """The world as of one recovery point; usable as a restore snapshot."""
+
+    def __init__(self, fds, time_ns, regions, files):
+        self._fds = fds
+        self.time_ns = time_ns
+        self.id = format_time(time_ns)
+        self.regions = regions
+        self.files = files
+
+    def close(self):
+        for fd in self._fds:
+            os.close(fd)
+        self._fds = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def read_file(self, rel):
+        entry = self.files.get(rel)
+        return _read_location(entry[1]) if entry else None
+
+    def read_chunks(self, rel, indices):
+        chunks = self.regions.get(rel, {})
+        return {i: (chunks[i][0], _read_location(chunks[i][1])) for i in indices if i in chunks}
+
+    def materialize(self, target_dir):
+        """Write the journaled part of the world under target_dir."""
+        target_dir = Path(target_dir)
+        for rel, chunks in self.regions.items():
+            timestamps = [0] * anvil.CHUNKS_PER_REGION
+            payloads = {}
+            for index, (timestamp, location) in chunks.items():
+                timestamps[index] = timestamp
+                payloads[index] = _read_location(location)
+            self._write(target_dir / rel, lambda f: anvil.write_region(f, timestamps, payloads),
+                        self.time_ns)
+        for rel, (mtime_ns, location) in self.files.items():
+            data = _read_location(location)
+            self._write(target_dir / rel, lambda f: f.write(data), mtime_ns)
+        return len(self.regions) + len(self.files)
+
+    @staticmethod
+    def _write(path, write, mtime_ns):
+        path.parent.mkdir(parents=True, exist_ok=True)
+        tmp = path.with_name(path.name + '.partial')
+        with open(tmp, 'wb') as f:
+            write(f)
+        os.utime(tmp, ns=(mtime_ns, mtime_ns))
+        os.replace(tmp, path)
+
+
+def _open_segments(paths):
+    fds = []
+    try:
+        for path in paths:
+            fds.append(os.open(path, os.O_RDONLY))
+    except BaseException:
+        for fd in fds:
+            os.close(fd)
+        raise
+    return fds
+
+
+def _replay(fds, until=None):
+    """Replay segments up to the last commit at or before until; return (time, regions, files)."""
+    point, regions, files = None, {}, {}
+    for fd in fds:
+        for commit, base, records, _ in _batches(fd):
+            if until is not None and commit > until:
+                return point, regions, files
+            if base:
+                regions, files = {}, {}
+            for kind, rel, index, value, location in records:
+                if kind == CHUNK:
+                    regions.setdefault(rel, {})[index] = (value, location)
+                elif kind == CHUNK_DELETED:
+                    regions.setdefault(rel, {}).pop(index, None)
+                elif kind == FILE:
+                    files[rel] = (value, location)
+                elif kind == REMOVED:
+                    regions.pop(rel, None)
+                    files.pop(rel, None)
+            point = commit
+    return point, regions, files
+
+
+def open_state(root, at=None):
+    """
+    The state at the last recovery point at or before at (nanoseconds since
+    the epoch, the newest point by default) as a JournalState.
+    """
+    for _ in range(3):
+        try:
+            fds = _open_segments(list_segments(root))
+            break
+        except FileNotFoundError:
+            # Compaction removed a segment while the list was being opened.
+            continue
+    else:
+        raise JournalError(f'{root} is being compacted, try again')
+    try:
+        point, regions, files = _replay(fds, at)
+    except BaseException:
+        for fd in fds:
+            os.close(fd)
+        raise
+    if point is None:
+        for fd in fds:
+            os.close(fd)
+        if at is not None:
+            raise JournalError(f'the journal in {root} has no recovery point before {format_time(at)}')
+        raise JournalError(f'the journal in {root} is empty')
+    return JournalState(fds, point, regions, files)
+
+
+def recovery_points(root):
+    """Times (nanoseconds since the epoch) of all recovery points, oldest first."""
+    points = []
+    fds = _open_segments(list_segments(root))
+    try:
+        for fd in fds:
+            points.extend(commit for commit, _, _, _ in _batches(fd))
+    finally:
+        for fd in fds:
+            os.close(fd)
+    return points
+
+
+class _SegmentWriter:
+    """Appends records to a segment; a batch becomes visible with commit()."""
+
+    def __init__(self, path, create):
+        self.path = Path(path)
+        if create:
+            self._f = open(self.path, 'xb', buffering=WRITE_BUFFER)
+            self._f.write(_SEGMENT_HEADER.pack(MAGIC, VERSION))
+        else:
+            fd = os.open(self.path, os.O_RDONLY)
+            try:
+                end = _SEGMENT_HEADER.size
+                for _, _, _, end in _batches(fd):
+                    pass
+            finally:
+                os.close(fd)
+            self._f = open(self.path, 'r+b', buffering=WRITE_BUFFER)
+            self._f.truncate(end)
+            self._f.seek(end)
+        self.batch_start = self._f.tell()
+
+    def size(self):
+        return self._f.tell()
+
+    def write(self, kind, rel='', index=0, value=0, data=b''):
+        rel = rel.encode('utf-8')
+        self._f.write(_RECORD.pack(kind, len(rel), index, len(data), zlib.crc32(data), value))
+        self._f.write(rel)
+        self._f.write(data)
+
+    def commit(self, time_ns):
+        self.write(COMMIT, value=time_ns)
+        self._f.flush()
+        os.fsync(self._f.fileno())
+        self.batch_start = self._f.tell()
+
+    def rollback(self):
+        """Drop the records written since the last commit."""
+        self._f.flush()
+        self._f.truncate(self.batch_start)
+        self._f.seek(self.batch_start)
+
+    def close(self):
+        self._f.close()
+
+
+def _encode_header(locations, timestamps):
+    return base64.b64encode(anvil.pack_table(locations) + anvil.pack_table(timestamps)).decode('ascii')
+
+
+def _decode_header(text):
+    data = base64.b64decode(text)
+    return anvil.unpack_table(data[:anvil.SECTOR_SIZE]), anvil.unpack_table(data[anvil.SECTOR_SIZE:])
+
+
+def _complete(payload):
+    """False for a chunk that was read while the server was still writing it."""
+    if payload[0] not in (regionpack.CHUNK_GZIP, regionpack.CHUNK_ZLIB):
+        return True
+    inflater = zlib.decompressobj(47)
+    try:
+        inflater.decompress(payload[1:])
+    except zlib.error:
+        return False
+    return inflater.eof
+
+
+class Journal:
+    """Captures changes of paths under source_dir into the journal in root."""
+
+    def __init__(self, root, source_dir, paths=('world',), exclude=(),
+                 segment_size=SEGMENT_SIZE, segment_seconds=SEGMENT_SECONDS):
+        self.root = Path(root)
+        self.source_dir = Path(source_dir)
+        self.paths = paths
+        self.exclude = exclude
+        self.segment_size = segment_size
+        self.segment_seconds = segment_seconds
+        self.root.mkdir(parents=True, exist_ok=True)
+        self._lock = threading.Lock()
+        self._writer = None
+        self._state = self._load_state()
+
+    def _load_state(self):
+        try:
+            with open(self.root / STATE_FILE, encoding='utf-8') as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            # Without the state of the last poll the next one records everything as a new base.
+            return None
+
+    def _save_state(self, state):
+        path = self.root / STATE_FILE
+        tmp = path.with_name(path.name + '.partial')
+        with open(tmp, 'w', encoding='utf-8') as f:
+            json.dump(state, f, separators=(',', ':'))
+        os.replace(tmp, path)
+        self._state = state
+
+    def close(self):
+        with self._lock:
+            if self._writer is not None:
+                self._writer.close()
+                self._writer = None
+
+    def _iter_sources(self):
+        for path in self.paths:
+            for rel, st in incremental.iter_tree(self.source_dir / path, self.exclude):
+                yield f'{path}/{rel}', st
+
+    def _begin(self, now, base):
+        """Open the segment the batch goes to, starting a new one when due."""
+        writer = self._writer
+        if writer is None:
+            segments = list_segments(self.root)
+            if segments and not base:
+                writer = _SegmentWriter(segments[-1], create=False)
+        if writer is not None and (base or writer.size() >= self.segment_size
+                                   or now - _segment_time(writer.path) >= self.segment_seconds * 10**9):
+            writer.close()
+            writer = None
+        if writer is None:
+            writer = _SegmentWriter(self.root / f'{now:020d}{SEGMENT_SUFFIX}', create=True)
+        self._writer = writer
+        if base:
+            writer.write(BASE, value=now)
+        return writer
+
+    def poll(self):
+        """Append everything that changed since the last poll as one recovery point; return counters."""
+        with self._lock:
+            now = time.time_ns()
+            base = self._state is None
+            previous = self._state or {'regions': {}, 'files': {}}
+            state = {'regions': {}, 'files': {}}
+            stats = {'chunks': 0, 'deleted_chunks': 0, 'files': 0, 'removed': 0, 'bytes': 0, 'torn': 0}
+            writer = None
+
+            def record(*args, **kwargs):
+                nonlocal writer
+                if writer is None:
+                    writer = self._begin(now, base)
+                writer.write(*args, **kwargs)
+
+            try:
+                for rel, st in self._iter_sources():
+                    if incremental.is_region_path(rel):
+                        prev = previous['regions'].get(rel)
+                        if prev and prev[0] == st.st_size and prev[1] == st.st_mtime_ns:
+                            state['regions'][rel] = prev
+                        else:
+                            state['regions'][rel] = self._poll_region(rel, st, prev, record, stats)
+                        continue
+                    entry = [st.st_size, st.st_mtime_ns]
+                    if previous['files'].get(rel) != entry:
+                        try:
+                            with open_source(self.source_dir / rel) as f:
+                                data = f.read()
+                        except FileNotFoundError:
+                            continue
+                        record(FILE, rel, value=st.st_mtime_ns, data=data)
+                        stats['files'] += 1
+                        stats['bytes'] += len(data)
+                    state['files'][rel] = entry
+                for kind in ('regions', 'files'):
+                    for rel in sorted(set(previous[kind]) - set(state[kind])):
+                        record(REMOVED, rel)
+                        stats['removed'] += 1
+                if writer is not None:
+                    writer.commit(now)
+            except BaseException:
+                if writer is not None:
+                    writer.rollback()
+                raise
+            self._save_state(state)
+            stats['recorded'] = writer is not None
+            return stats
+
+    def _poll_region(self, rel, st, prev, record, stats):
+        """Record the changed chunks of one region and return its new state entry."""
+        if prev:
+            old_locations, old_timestamps = _decode_header(prev[2])
+        else:
+            old_locations = old_timestamps = [0] * anvil.CHUNKS_PER_REGION
+        retry = False
+        try:
+            with open_source(self.source_dir / rel) as f:
+                header, timestamps = anvil.read_header(f)
+                timestamps = anvil.effective_timestamps(header, timestamps)
+                locations = [sector << 8 | count for sector, count in header]
+                for index in range(anvil.CHUNKS_PER_REGION):
+                    if (locations[index] == old_locations[index]
+                            and timestamps[index] == old_timestamps[index]):
+                        continue
+                    if not timestamps[index]:
+                        if old_timestamps[index]:
+                            record(CHUNK_DELETED, rel, index)
+                            stats['deleted_chunks'] += 1
+                        continue
+                    try:
+                        payload = anvil.read_chunk(f, header[index])
+                    except anvil.RegionError:
+                        payload = None
+                    if not payload or not _complete(payload):
+                        # Keep the old entry so the chunk is read again next time.
+                        locations[index], timestamps[index] = old_locations[index], old_timestamps[index]
+                        retry = True
+                        stats['torn'] += 1
+                        continue
+                    record(CHUNK, rel, index, timestamps[index], payload)
+                    stats['chunks'] += 1
+                    stats['bytes'] += len(payload)
+        except anvil.RegionError as e:
+            logger.warning('Journal: cannot read %s yet: %s', rel, e)
+            return [0, 0, prev[2]] if prev else [0, 0, _encode_header(old_locations, old_timestamps)]
+        # A size of 0 makes the next poll look at the region again.
+        return [0 if retry else st.st_size, st.st_mtime_ns, _encode_header(locations, timestamps)]
+
+
+def compact(root, keep_seconds):
+    """
+    Fold the segments whose recovery points are all older than keep_seconds
+    into one checkpoint segment; return the number of segments removed.
+    """
+    root = Path(root)
+    cutoff = time.time_ns() - int(keep_seconds * 10**9)
+    segments = list_segments(root)
+    fold = [path for path, following in zip(segments, segments[1:]) if _segment_time(following) <= cutoff]
+    if not fold:
+        return 0
+    fds = _open_segments(fold)
+    try:
+        if len(fold) == 1 and sum(1 for _ in _batches(fds[0])) <= 1:
+            # Only the last checkpoint is old enough.
+            return 0
+        point, regions, files = _replay(fds)
+        if point is None:
+            return 0
+        path = root / f'{point:020d}{SEGMENT_SUFFIX}'
+        tmp = path.with_name(path.name + '.partial')
+        tmp.unlink(missing_ok=True)
+        writer = _SegmentWriter(tmp, create=True)
+        try:
+            writer.write(BASE, value=point)
+            for rel, chunks in sorted(regions.items()):
+                for index, (timestamp, location) in sorted(chunks.items()):
+                    writer.write(CHUNK, rel, index, timestamp, _read_location(location))
+            for rel, (mtime_ns, location) in sorted(files.items()):
+                writer.write(FILE, rel, value=mtime_ns, data=_read_location(location))
+            writer.commit(point)
+        finally:
+            writer.close()
+    finally:
+        for fd in fds:
+            os.close(fd)
+    os.replace(tmp, path)
+    for old in fold:
+        if old != path:
+            old.unlink()
+    logger.info('Journal: folded %d segments into a checkpoint at %s (%.1f MiB)',
+                len(fold), format_time(point), path.stat().st_size / 2**20)
+    return len(fold)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Inspect the chunk journal and rebuild the world at a point in time.')
+    parser.add_argument('journal', type=Path, help='journal directory (BACKUP_DIR/journal)')
+    commands = parser.add_subparsers(dest='command', required=True)
+    commands.add_parser('points', help='list recovery points')
+    materialize = commands.add_parser('materialize', help='write the world as of a point in time')
+    materialize.add_argument('target', type=Path)
+    materialize.add_argument('--at', help='local time like 2026-10-18T12:30 (the newest point by default)')
+    compact_parser = commands.add_parser('compact', help='fold old segments into a checkpoint')
+    compact_parser.add_argument('--keep-hours', type=float, required=True)
+    args = parser.parse_args()
+
+    if args.command == 'points':
+        for point in recovery_points(args.journal):
+            print(format_time(point))
+    elif args.command == 'materialize':
+        with open_state(args.journal, parse_time(args.at) if args.at else None) as state:
+            count = state.materialize(args.target)
+            print(f'{count} files as of {state.id} written to {args.target}')
+    else:
+        print(f'Removed {compact(args.journal, args.keep_hours * 3600)} segments')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,100 @@
+"""
+Follow the server log to find out when a command has taken effect.
+
+LogFollower remembers the end of logs/latest.log when it is started, so only
+lines written after that point (i.e. after the command that is about to be
+issued) are matched. It survives log rotation: when latest.log is replaced
+(new inode) or truncated, the rest of the old file is drained and reading
+continues from the start of the new one.
+"""
+
+import logging
+import os
+import re
+import time
+from pathlib import Path
+
+logger = logging.getLogger(__name__)
+
+SAVED_THE_GAME = re.compile(r'Saved the game')
+
+
+class LogFollower:
+    def __init__(self, path, poll_interval=0.05):
+        self.path = Path(path)
+        self.poll_interval = poll_interval
+        self._file = None
+        self._inode = None
+        self._partial = ''
+
+    def start(self):
+        """Start following from the current end of the log."""
+        self._open(at_end=True)
+        return self
+
+    def close(self):
+        if self._file:
+            self._file.close()
+            self._file = None
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def _open(self, at_end):
+        self.close()
+        try:
+            self._file = open(self.path, 'r', encoding='utf-8', errors='replace')
+        except FileNotFoundError:
+            return
+        self._inode = os.fstat(self._file.fileno()).st_ino
+        self._partial = ''
+        if at_end:
+            self._file.seek(0, os.SEEK_END)
+
+    def _rotated(self):
+        try:
+            st = os.stat(self.path)
+        except FileNotFoundError:
+            return False
+        return st.st_ino != self._inode or st.st_size < self._file.tell()
+
+    def read_lines(self):
+        """Return the complete lines written since the last call."""
+        if self._file is None:
+            # The log did not exist yet; whatever appears now is new.
+            self._open(at_end=False)
+            if self._file is None:
+                return []
+        data = self._file.read()
+        if self._rotated():
+            data += self._file.read()
+            lines = self._split(data)
+            if self._partial:
+                lines.append(self._partial)
+            self._open(at_end=False)
+            return lines + self._split(self._file.read())
+        return self._split(data)
+
+    def _split(self, data):
+        if not data:
+            return []
+        lines = (self._partial + data).split('\n')
+        self._partial = lines.pop()
+        return lines
+
+    def wait_for(self, pattern, timeout):
+        """Block until a new log line matches pattern and return it."""
+        if isinstance(pattern, str):
+            pattern = re.compile(pattern)
+        deadline = time.monotonic() + timeout
+        while True:
+            for line in self.read_lines():
+                if pattern.search(line):
+                    return line
+            if time.monotonic() >= deadline:
+                raise TimeoutError(f'no line matching {pattern.pattern!r} in {self.path} '
+                                   f'within {timeout} s')
+            time.sleep(self.poll_interval)
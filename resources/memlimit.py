@@ -0,0 +1,106 @@
+"""
+Resident memory limit of the backup process.
+
+The backup runs on the same host as the server's 16 GB JVM, so it has to
+stay small no matter how large the world's files are. The archive writers
+keep their memory fixed (pipeline.py) and this module turns that into a
+guarantee: reader.BackupFileIO reports every read here, and after every
+CHECK_BYTES read the resident set size is compared with LIMIT. Above it,
+freed memory is handed back to the system (gc, malloc_trim) and if that is
+not enough the read fails with MemoryLimitError. A failed backup is retried
+at the next run; a host that runs out of memory kills the server.
+
+The peak resident set of a run is the kernel's high-water mark (VmHWM),
+reset through /proc/self/clear_refs when the run starts. Without it the
+peak is the highest since the process started.
+"""
+
+import ctypes
+import ctypes.util
+import gc
+import logging
+import os
+import resource
+
+logger = logging.getLogger(__name__)
+
+# Bytes; set from BACKUP_MAX_RSS_MB by resource_script.py, None turns the check off.
+LIMIT = None
+CHECK_BYTES = 16 * 2**20
+PAGE_SIZE = os.sysconf('SC_PAGE_SIZE')
+
+_read_since_check = 0
+
+
+class MemoryLimitError(Exception):
+    pass
+
+
+def _load_libc():
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library('c'))
+        libc.malloc_trim.argtypes = [ctypes.c_size_t]
+        return libc
+    except (OSError, AttributeError):
+        return None
+
+
+_libc = _load_libc()
+
+
+def rss():
+    """Current resident set size in bytes, or None if /proc is not available."""
+    try:
+        with open('/proc/self/statm', 'rb') as f:
+            return int(f.read().split()[1]) * PAGE_SIZE
+    except (OSError, ValueError, IndexError):
+        return None
+
+
+def reset_peak():
+    """Start a new peak measurement; False if the kernel does not support it."""
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+        return True
+    except OSError:
+        return False
+
+
+def peak_rss():
+    """Highest resident set size in bytes since reset_peak()."""
+    try:
+        with open('/proc/self/status', encoding='ascii') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) * 1024
+    except (OSError, ValueError):
+        pass
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def account(nbytes):
+    """Count nbytes read by the backup and check the limit every CHECK_BYTES."""
+    global _read_since_check
+    if LIMIT is None:
+        return
+    _read_since_check += nbytes
+    if _read_since_check >= CHECK_BYTES:
+        _read_since_check = 0
+        check()
+
+
+def check():
+    """Raise MemoryLimitError if the process is above LIMIT even after freeing what it can."""
+    current = rss()
+    if LIMIT is None or current is None or current <= LIMIT:
+        return
+    gc.collect()
+    if _libc is not None:
+        _libc.malloc_trim(0)
+    trimmed = rss()
+    logger.warning('Backup process at %.0f MiB, over the %.0f MiB limit; trimmed to %.0f MiB',
+                   current / 2**20, LIMIT / 2**20, trimmed / 2**20)
+    if trimmed > LIMIT:
+        raise MemoryLimitError(f'backup process uses {trimmed / 2**20:.0f} MiB, '
+                               f'more than BACKUP_MAX_RSS_MB ({LIMIT / 2**20:.0f} MiB)')
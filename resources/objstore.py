@@ -0,0 +1,538 @@
+"""
+Content-addressed, deduplicating backup store.
+
+Layout under the store root:
+
+    objects/ab/cdef...   objects keyed by the SHA-256 of their content
+    snapshots/<id>.json.gz   one manifest per snapshot
+    refs.db              SQLite table with a reference count per object
+
+Regular files are split into FILE_BLOCK_SIZE blocks, each block is an object.
+Region files are stored chunk by chunk: every chunk payload is an object and
+the region itself is a small "table" object holding the timestamp table and
+the chunk hashes, so a region nobody touched costs one hash per snapshot and
+an edited region costs only its changed chunks plus a new table.
+
+Snapshots reference file blocks and region tables, tables reference chunks.
+An object is deleted when its reference count drops to zero.
+
+The first byte of an object is the tag of the codec it is compressed with
+(see codec.py). Chunks are stored as they are, file blocks use the codec a
+CodecSelector picked for the file, recorded in the manifest under 'codecs'.
+
+With chunk_delta_depth set, a changed chunk can instead be stored as a delta
+object: a binary delta (delta.py, small blocks) between the inflated NBT of
+the chunk's previous version and the new one, so a chunk where a few blocks
+changed costs a few hundred bytes instead of the whole compressed chunk. A
+delta object references its base, which is kept as long as the delta is.
+Its depth is its distance from a whole chunk; a version that would exceed
+chunk_delta_depth is stored whole again, which rebases the chain and bounds
+the work to read a chunk. Chunks read back from deltas are deflated again
+at the server's level, so their NBT is the original one but the compressed
+bytes may differ (as with regionpack.py).
+
+A snapshot's references and its row in refs.db are committed before its
+manifest is published, so every manifest belongs to a committed snapshot and
+processes that only read the store (restores, the catalog) can open it while
+a backup writes. Objects written by a snapshot that fails are removed again.
+A crash leaves the WRITING_MARKER file behind, and only then does the next
+snapshot sweep the whole object tree for unreferenced objects.
+"""
+
+import gzip
+import hashlib
+import io
+import json
+import logging
+import os
+import sqlite3
+import struct
+import zlib
+from datetime import datetime, timedelta
+from pathlib import Path
+
+import anvil
+import delta
+import pipeline
+from codec import STORE, CodecError, decode, get as get_codec
+from incremental import is_region_path, iter_dirty, iter_tree
+from regionpack import RECOMPRESS_LEVEL, deflate_chunk, inflate_chunk
+from throttle import open_source
+
+logger = logging.getLogger(__name__)
+
+FILE_BLOCK_SIZE = 4 * 2**20
+MANIFEST_VERSION = 1
+# Present while a snapshot is being written; holds its id.
+WRITING_MARKER = 'writing'
+
+DEFAULT_CODEC = get_codec('zlib-6')
+
+TABLE_MAGIC = b'MCRT'
+_TABLE_ENTRY = struct.Struct('>H32s')
+
+# Delta objects start with this tag (not a codec tag), then the base chunk's
+# hash, the chunk's compression type and the depth, then the zlib-compressed
+# delta of the inflated NBT.
+DELTA_TAG = 0x80
+_DELTA_HEADER = struct.Struct('>B32sBB')
+MAX_DELTA_DEPTH = 255
+CHUNK_DELTA_BLOCK_SIZE = 64
+# A delta is kept only if it is smaller than this share of the chunk payload.
+CHUNK_DELTA_MAX_RATIO = 0.5
+
+
+class StoreError(Exception):
+    pass
+
+
+def encode_table(timestamps, hashes):
+    """Serialize a region table: timestamps plus {chunk index: hex hash}."""
+    entries = b''.join(_TABLE_ENTRY.pack(index, bytes.fromhex(hashes[index]))
+                       for index in sorted(hashes))
+    return TABLE_MAGIC + anvil.pack_table(timestamps) + struct.pack('>H', len(hashes)) + entries
+
+
+def decode_table(data):
+    if data[:4] != TABLE_MAGIC:
+        raise StoreError('not a region table object')
+    timestamps = anvil.unpack_table(data[4:4 + anvil.SECTOR_SIZE])
+    offset = 4 + anvil.SECTOR_SIZE
+    count, = struct.unpack_from('>H', data, offset)
+    offset += 2
+    hashes = {}
+    for _ in range(count):
+        index, digest = _TABLE_ENTRY.unpack_from(data, offset)
+        hashes[index] = digest.hex()
+        offset += _TABLE_ENTRY.size
+    return timestamps, hashes
+
+
+class ObjectStore:
+    def __init__(self, root, chunk_delta_depth=0):
+        self.root = Path(root)
+        self.chunk_delta_depth = min(chunk_delta_depth, MAX_DELTA_DEPTH)
+        self.delta_chunks = 0
+        self._written = None
+        # Files are read block by block into one reusable buffer.
+        self._blocks = pipeline.BufferPool(FILE_BLOCK_SIZE, 1)
+        self.objects_dir = self.root / 'objects'
+        self.snapshots_dir = self.root / 'snapshots'
+        self.objects_dir.mkdir(parents=True, exist_ok=True)
+        self.snapshots_dir.mkdir(parents=True, exist_ok=True)
+        self.db = sqlite3.connect(str(self.root / 'refs.db'))
+        self.db.executescript('''
+            CREATE TABLE IF NOT EXISTS objects (
+                hash TEXT PRIMARY KEY,
+                kind TEXT NOT NULL,
+                size INTEGER NOT NULL,
+                refs INTEGER NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS snapshots (
+                id TEXT PRIMARY KEY,
+                created TEXT NOT NULL
+            );
+        ''')
+        self._recover()
+
+    def close(self):
+        self.db.close()
+
+    # Objects
+
+    def _object_path(self, digest):
+        return self.objects_dir / digest[:2] / digest[2:]
+
+    def put(self, data, codec=DEFAULT_CODEC):
+        """Store data unless an identical object exists; return (hash, stored bytes)."""
+        digest = hashlib.sha256(data).hexdigest()
+        path = self._object_path(digest)
+        if path.exists():
+            return digest, 0
+        tag, encoded = STORE.tag, data
+        if codec is not STORE:
+            packed = codec.compress(data)
+            if len(packed) < len(data) * 0.95:
+                tag, encoded = codec.tag, packed
+        # Written as two pieces so a stored block is not copied to prepend the tag.
+        self._write_object(path, bytes([tag]), encoded)
+        return digest, 1 + len(encoded)
+
+    def _write_object(self, path, *pieces):
+        path.parent.mkdir(exist_ok=True)
+        tmp = path.with_name(path.name + '.partial')
+        with open(tmp, 'wb') as f:
+            for piece in pieces:
+                f.write(piece)
+        os.replace(tmp, path)
+        if self._written is not None:
+            self._written.append(path.parent.name + path.name)
+
+    def put_chunk(self, payload, base=None):
+        """
+        Store a chunk payload, as a delta against the chunk object base when
+        deltas are enabled and it pays off; return (hash, stored bytes).
+        """
+        digest = hashlib.sha256(payload).hexdigest()
+        path = self._object_path(digest)
+        if base is None or not self.chunk_delta_depth or path.exists():
+            return self.put(payload, STORE)
+        raw = inflate_chunk(payload[0], payload[1:])
+        try:
+            resolved = self._chunk_nbt(base) if raw is not None else None
+        except StoreError as e:
+            logger.warning('Storing chunk %s whole: %s', digest, e)
+            resolved = None
+        if resolved is None or resolved[2] >= self.chunk_delta_depth:
+            return self.put(payload, STORE)
+        builder = delta.SignatureBuilder(CHUNK_DELTA_BLOCK_SIZE)
+        builder.feed(resolved[1])
+        out = io.BytesIO()
+        if delta.make_delta(builder.finish(), io.BytesIO(raw), out, len(raw) // 2) is None:
+            return self.put(payload, STORE)
+        encoded = (_DELTA_HEADER.pack(DELTA_TAG, bytes.fromhex(base), payload[0], resolved[2] + 1)
+                   + zlib.compress(out.getvalue(), 9))
+        if len(encoded) >= len(payload) * CHUNK_DELTA_MAX_RATIO:
+            return self.put(payload, STORE)
+        self._write_object(path, encoded)
+        self.delta_chunks += 1
+        return digest, len(encoded)
+
+    def _read_object(self, digest):
+        try:
+            with open(self._object_path(digest), 'rb') as f:
+                return f.read()
+        except FileNotFoundError:
+            raise StoreError(f'object {digest} is missing') from None
+
+    def get(self, digest):
+        encoded = self._read_object(digest)
+        if encoded[0] == DELTA_TAG:
+            chunk_type, raw, _ = self._chunk_nbt(digest, encoded)
+            return bytes([chunk_type]) + deflate_chunk(chunk_type, raw, RECOMPRESS_LEVEL)
+        return self._decode(digest, encoded)
+
+    @staticmethod
+    def _decode(digest, encoded):
+        try:
+            return decode(encoded[0], encoded[1:])
+        except CodecError as e:
+            raise StoreError(f'object {digest}: {e}') from None
+
+    def _chunk_nbt(self, digest, encoded=None):
+        """
+        (compression type, inflated NBT, delta depth) of a chunk object, or
+        None for a chunk that is not stored deflated.
+        """
+        if encoded is None:
+            encoded = self._read_object(digest)
+        if encoded[0] != DELTA_TAG:
+            payload = self._decode(digest, encoded)
+            raw = inflate_chunk(payload[0], payload[1:])
+            return None if raw is None else (payload[0], raw, 0)
+        _, base, chunk_type, depth = _DELTA_HEADER.unpack_from(encoded)
+        resolved = self._chunk_nbt(base.hex())
+        if resolved is None:
+            raise StoreError(f'object {digest}: base chunk {base.hex()} is not deflated')
+        out = io.BytesIO()
+        try:
+            patch = zlib.decompress(encoded[_DELTA_HEADER.size:])
+            delta.apply_delta(io.BytesIO(resolved[1]), io.BytesIO(patch), out)
+        except (zlib.error, delta.DeltaError) as e:
+            raise StoreError(f'object {digest}: {e}') from None
+        return chunk_type, out.getvalue(), depth
+
+    def _delta_base(self, digest):
+        """Hash of the base of a delta object, None for other objects."""
+        with open(self._object_path(digest), 'rb') as f:
+            header = f.read(_DELTA_HEADER.size)
+        if header[:1] != bytes([DELTA_TAG]):
+            return None
+        return _DELTA_HEADER.unpack(header)[1].hex()
+
+    # Reference counting
+
+    def _add_refs(self, refs):
+        """Increment reference counts; refs is an iterable of (hash, kind)."""
+        pending = list(refs)
+        while pending:
+            digest, kind = pending.pop()
+            cur = self.db.execute('UPDATE objects SET refs = refs + 1 WHERE hash = ?', (digest,))
+            if cur.rowcount:
+                continue
+            size = self._object_path(digest).stat().st_size
+            base = self._delta_base(digest) if kind == 'chunk' else None
+            if base is not None:
+                kind = 'delta'
+                pending.append((base, 'chunk'))
+            self.db.execute('INSERT INTO objects (hash, kind, size, refs) VALUES (?, ?, ?, 1)',
+                            (digest, kind, size))
+            if kind == 'table':
+                _, hashes = decode_table(self.get(digest))
+                pending.extend((h, 'chunk') for h in hashes.values())
+
+    def _drop_refs(self, digests):
+        """Decrement reference counts and delete objects nobody references."""
+        pending = list(digests)
+        freed = 0
+        while pending:
+            digest = pending.pop()
+            row = self.db.execute('SELECT kind, size, refs FROM objects WHERE hash = ?',
+                                  (digest,)).fetchone()
+            if row is None:
+                continue
+            kind, size, refs = row
+            if refs > 1:
+                self.db.execute('UPDATE objects SET refs = refs - 1 WHERE hash = ?', (digest,))
+                continue
+            if kind == 'table':
+                _, hashes = decode_table(self.get(digest))
+                pending.extend(hashes.values())
+            elif kind == 'delta':
+                pending.append(self._delta_base(digest))
+            self.db.execute('DELETE FROM objects WHERE hash = ?', (digest,))
+            self._object_path(digest).unlink(missing_ok=True)
+            freed += size
+        return freed
+
+    def _recover(self):
+        """
+        Publish the manifests of snapshots committed just before a crash and
+        drop manifests whose snapshot is not committed (left by a crash while
+        deleting it). Manifests still being written are not committed and
+        stay .partial, so this is safe while another process writes one.
+        """
+        committed = {row[0] for row in self.db.execute('SELECT id FROM snapshots')}
+        for tmp in self.snapshots_dir.glob('*.json.gz.partial'):
+            if tmp.name[:-len('.json.gz.partial')] in committed:
+                logger.warning('Publishing the manifest of committed snapshot %s', tmp.name)
+                try:
+                    os.replace(tmp, tmp.with_name(tmp.name[:-len('.partial')]))
+                except FileNotFoundError:
+                    pass  # its writer got there first
+        for path in self.snapshots_dir.glob('*.json.gz'):
+            if path.name[:-len('.json.gz')] not in committed:
+                logger.warning('Removing uncommitted snapshot manifest %s', path.name)
+                path.unlink(missing_ok=True)
+
+    def _remove_uncommitted(self, digests):
+        """Delete the objects among digests that no committed snapshot references."""
+        for digest in digests:
+            if self.db.execute('SELECT 1 FROM objects WHERE hash = ?', (digest,)).fetchone() is None:
+                self._object_path(digest).unlink(missing_ok=True)
+
+    def collect_garbage(self):
+        """
+        Remove object files and .partial manifests that no committed
+        snapshot references. This reads the whole object tree; the store
+        runs it only after a crash, before the next snapshot.
+        """
+        committed = {row[0] for row in self.db.execute('SELECT id FROM snapshots')}
+        for tmp in self.snapshots_dir.glob('*.json.gz.partial'):
+            if tmp.name[:-len('.json.gz.partial')] not in committed:
+                tmp.unlink()
+        live = {row[0] for row in self.db.execute('SELECT hash FROM objects')}
+        removed = 0
+        for path in self.objects_dir.glob('*/*'):
+            digest = path.parent.name + path.name
+            if digest not in live:
+                path.unlink()
+                removed += 1
+        if removed:
+            logger.info('Removed %d unreferenced objects', removed)
+        return removed
+
+    # Snapshots
+
+    def snapshot_ids(self):
+        return [row[0] for row in self.db.execute('SELECT id FROM snapshots ORDER BY id')]
+
+    def _manifest_path(self, snapshot_id):
+        return self.snapshots_dir / f'{snapshot_id}.json.gz'
+
+    def load_snapshot(self, snapshot_id):
+        with gzip.open(self._manifest_path(snapshot_id), 'rt', encoding='utf-8') as f:
+            return json.load(f)
+
+    def read_table(self, digest):
+        return decode_table(self.get(digest))
+
+    def _store_file(self, path, rel, size, selector):
+        """Store a file block by block and return (hashes, stored bytes, codec)."""
+        hashes, stored = [], 0
+        with open_source(path) as f:
+            codec = selector.choose(rel, f, size) if selector is not None else DEFAULT_CODEC
+            block = self._blocks.acquire()
+            try:
+                while True:
+                    n = pipeline.read_into(f, memoryview(block))
+                    if not n:
+                        break
+                    digest, written = self.put(memoryview(block)[:n], codec)
+                    hashes.append(digest)
+                    stored += written
+                    if n < len(block):
+                        break
+            finally:
+                self._blocks.release(block)
+        return hashes, stored, codec
+
+    def _store_region(self, path, previous, forced=()):
+        """Store the changed and forced chunks of a region and return (table hash, stored bytes)."""
+        old_timestamps, old_hashes = (self.read_table(previous[2]) if previous
+                                      else ([0] * anvil.CHUNKS_PER_REGION, {}))
+        hashes, stored = {}, 0
+        with open_source(path) as f:
+            locations, timestamps = anvil.read_header(f)
+            timestamps = anvil.effective_timestamps(locations, timestamps)
+            for index, ts in enumerate(timestamps):
+                if not ts:
+                    continue
+                if ts == old_timestamps[index] and index in old_hashes and index not in forced:
+                    hashes[index] = old_hashes[index]
+                    continue
+                digest, size = self.put_chunk(anvil.read_chunk(f, locations[index]), old_hashes.get(index))
+                hashes[index] = digest
+                stored += size
+        digest, size = self.put(encode_table(timestamps, hashes))
+        return digest, stored + size
+
+    def create_snapshot(self, source_dir, snapshot_id, exclude=(), selector=None, forced=None, dirty=None):
+        """
+        Store the state of source_dir as a new snapshot.
+
+        Files and regions whose size and mtime match the previous snapshot are
+        referenced without being read again. selector picks the codec of each
+        stored file; without one DEFAULT_CODEC is used. forced maps region
+        paths to chunk indices that are stored even with unchanged timestamps.
+        dirty, (files, dirs) from dirtyset.py, limits the scan to the paths
+        changed since the previous snapshot.
+
+        Only one snapshot may be written at a time.
+        """
+        ids = self.snapshot_ids()
+        if snapshot_id in ids:
+            raise StoreError(f'snapshot {snapshot_id} already exists')
+        marker = self.root / WRITING_MARKER
+        if marker.exists():
+            logger.warning('Snapshot %s was not finished, removing the objects it left',
+                           marker.read_text(encoding='utf-8').strip())
+            self.collect_garbage()
+        marker.write_text(snapshot_id, encoding='utf-8')
+        self._written = []
+        try:
+            manifest = self._write_snapshot(Path(source_dir), snapshot_id, ids, exclude, selector,
+                                            forced or {}, dirty)
+        except BaseException:
+            self._remove_uncommitted(self._written)
+            marker.unlink()
+            raise
+        finally:
+            self._written = None
+        marker.unlink()
+        return manifest
+
+    def _write_snapshot(self, source_dir, snapshot_id, ids, exclude, selector, forced, dirty):
+        previous = self.load_snapshot(ids[-1]) if ids else {'files': {}, 'regions': {}}
+        files, regions, codecs = {}, {}, {}
+        prev_codecs = previous.get('codecs', {})
+        stored = 0
+        self.delta_chunks = 0
+        if ids and dirty is not None:
+            entries = iter_dirty(source_dir, {**previous['files'], **previous['regions']}, *dirty, exclude)
+        else:
+            entries = iter_tree(source_dir, exclude)
+        for rel, st in entries:
+            path = source_dir / rel
+            if is_region_path(rel):
+                prev = previous['regions'].get(rel)
+                if prev and prev[0] == st.st_size and prev[1] == st.st_mtime_ns and rel not in forced:
+                    regions[rel] = prev
+                    continue
+                digest, size = self._store_region(path, prev, set(forced.get(rel, ())))
+                regions[rel] = [st.st_size, st.st_mtime_ns, digest]
+            else:
+                prev = previous['files'].get(rel)
+                if prev and prev[0] == st.st_size and prev[1] == st.st_mtime_ns:
+                    files[rel] = prev
+                    if rel in prev_codecs:
+                        codecs[rel] = prev_codecs[rel]
+                    continue
+                hashes, size, codec = self._store_file(path, rel, st.st_size, selector)
+                files[rel] = [st.st_size, st.st_mtime_ns, hashes]
+                codecs[rel] = codec.name
+            stored += size
+
+        created = datetime.now().isoformat(timespec='seconds')
+        manifest = {
+            'version': MANIFEST_VERSION,
+            'id': snapshot_id,
+            'created': created,
+            'files': files,
+            'regions': regions,
+            'codecs': codecs,
+        }
+        path = self._manifest_path(snapshot_id)
+        tmp = path.with_name(path.name + '.partial')
+        try:
+            with gzip.open(tmp, 'wt', encoding='utf-8') as f:
+                json.dump(manifest, f, separators=(',', ':'))
+            with self.db:
+                self._add_refs(self._snapshot_refs(manifest))
+                self.db.execute('INSERT INTO snapshots (id, created) VALUES (?, ?)', (snapshot_id, created))
+        except BaseException:
+            tmp.unlink(missing_ok=True)
+            raise
+        # Published last: a manifest without its snapshot row would be taken
+        # for a crashed one and removed by any process opening the store.
+        os.replace(tmp, path)
+        logger.info('Snapshot %s: %d files, %d regions, %.1f MiB of new objects (%d chunk deltas)',
+                    snapshot_id, len(files), len(regions), stored / 2**20, self.delta_chunks)
+        return manifest
+
+    @staticmethod
+    def _snapshot_refs(manifest):
+        for entry in manifest['files'].values():
+            for digest in entry[2]:
+                yield digest, 'blob'
+        for entry in manifest['regions'].values():
+            yield entry[2], 'table'
+
+    def delete_snapshot(self, snapshot_id):
+        manifest = self.load_snapshot(snapshot_id)
+        with self.db:
+            self.db.execute('DELETE FROM snapshots WHERE id = ?', (snapshot_id,))
+            freed = self._drop_refs(digest for digest, _ in self._snapshot_refs(manifest))
+        self._manifest_path(snapshot_id).unlink(missing_ok=True)
+        logger.info('Deleted snapshot %s, freed %.1f MiB', snapshot_id, freed / 2**20)
+
+    def prune(self, keep_days):
+        """Delete snapshots older than keep_days, always keeping the newest one."""
+        cutoff = (datetime.now() - timedelta(days=keep_days)).isoformat(timespec='seconds')
+        old = [row[0] for row in self.db.execute(
+            'SELECT id FROM snapshots WHERE created < ? ORDER BY id', (cutoff,))]
+        ids = self.snapshot_ids()
+        for snapshot_id in old:
+            if snapshot_id != ids[-1]:
+                self.delete_snapshot(snapshot_id)
+
+    def restore_snapshot(self, snapshot_id, target_dir):
+        """Recreate the files and regions of a snapshot under target_dir."""
+        target_dir = Path(target_dir)
+        manifest = self.load_snapshot(snapshot_id)
+        for rel, (size, mtime_ns, hashes) in manifest['files'].items():
+            path = target_dir / rel
+            path.parent.mkdir(parents=True, exist_ok=True)
+            with open(path, 'wb') as f:
+                for digest in hashes:
+                    f.write(self.get(digest))
+            os.utime(path, ns=(mtime_ns, mtime_ns))
+        for rel, (size, mtime_ns, digest) in manifest['regions'].items():
+            path = target_dir / rel
+            path.parent.mkdir(parents=True, exist_ok=True)
+            timestamps, hashes = self.read_table(digest)
+            with open(path, 'wb') as f:
+                if hashes:
+                    anvil.write_region(f, timestamps, {i: self.get(h) for i, h in hashes.items()})
+            os.utime(path, ns=(mtime_ns, mtime_ns))
+        logger.info('Restored snapshot %s to %s', snapshot_id, target_dir)
@@ -0,0 +1,26 @@
+"""
+Block-parallel gzip format.
+
+The input is cut into fixed-size blocks and every block is compressed into
+a complete gzip member, so blocks can be compressed on a thread pool (zlib
+releases the GIL, so threads scale with cores). Members are written in
+order, and a concatenation of gzip members is a valid gzip stream, so the
+output opens with gzip -d, tarfile 'r:gz' or any other standard decoder,
+the same way pigz --independent output does. pipeline.PipelineWriter
+writes .tar.gz backups this way.
+
+The compression level can change between tar members, which is how
+per-file codec choices end up in a .tar.gz: already compressed files are
+written as stored deflate blocks.
+"""
+
+import zlib
+
+DEFAULT_BLOCK_SIZE = 2**20
+DEFAULT_LEVEL = 6
+
+
+def compress_block(data, level=DEFAULT_LEVEL):
+    """Compress data into one self-contained gzip member."""
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    return compressor.compress(data) + compressor.flush()
@@ -0,0 +1,628 @@
+"""
+Staged .tar.gz writer: reader, chunker, compressor pool, writer, hasher and
+uploader connected by bounded queues.
+
+Compressing on a pool alone is not enough when the thread that reads the
+world also writes the compressed members: the disk holding the backups
+waits while a source file is read and the reverse. Here every stage runs on
+its own thread(s):
+
+    reader      the calling thread: tarfile reads source files (through
+                throttle.open_source) and formats the tar stream
+    chunker     cuts the stream into blocks, cut early where set_level()
+                changes the compression level between members
+    compressor  pool compressing blocks into gzip members (compress_gate)
+    writer      writes the members to the archive in order
+    hasher      SHA-256 of the archive as written
+    uploader    optional: streams the archive to an HTTP URL while it is
+                written (chunked PUT, needs requests)
+
+Stages hand data over through queues bounded in bytes. The buffer pools
+and the queues of compressed members together add up to MEMORY_BUDGET, so
+a slow stage stalls the ones before it instead of buffering the world in
+memory. Data taken from a queue still counts against it until the next
+stage is done with it. report() includes the most that was held at once.
+
+Every stage records how long it was busy, starved (waiting for input) and
+blocked (waiting for room in the next queue). report() turns that into
+utilization per stage: the busiest stage is the bottleneck, a starved
+compressor pool means reading is too slow, a blocked reader that the
+compressors or the disk cannot keep up.
+
+Memory stays constant however large a file is: source data is read with
+readinto() into buffers from a BufferPool and copied into pooled compression
+blocks, so no file is ever held whole and no bytes object is made per block
+before compression; the compressed members are shared by the writer, hasher
+and uploader without copies.
+
+The output is a multi-member gzip stream (parallel_gzip.py) that gzip and
+tarfile 'r:gz' read like any other.
+"""
+
+import collections
+import copy
+import hashlib
+import logging
+import os
+import tarfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+
+from parallel_gzip import DEFAULT_BLOCK_SIZE, DEFAULT_LEVEL, compress_block
+
+try:
+    import requests
+except ImportError:
+    requests = None
+
+logger = logging.getLogger(__name__)
+
+# Bytes held by all queues of one archive; set from BACKUP_PIPELINE_MEMORY_MB
+# by resource_script.py.
+MEMORY_BUDGET = 256 * 2**20
+# Size of the pooled buffers source files are read into.
+READ_SIZE = 2**20
+UPLOAD_TIMEOUT = (30, 300)
+
+
+class PipelineError(Exception):
+    pass
+
+
+class _Aborted(Exception):
+    pass
+
+
+class StageStats:
+    """Time one stage spent busy, starved and blocked, summed over its threads."""
+
+    def __init__(self, name, workers=1):
+        self.name = name
+        self.workers = workers
+        self.busy = 0.0
+        self.starved = 0.0
+        self.blocked = 0.0
+        self.items = 0
+        self.bytes = 0
+        self._lock = threading.Lock()
+
+    def add(self, busy=0.0, starved=0.0, blocked=0.0, items=0, nbytes=0):
+        with self._lock:
+            self.busy += busy
+            self.starved += starved
+            self.blocked += blocked
+            self.items += items
+            self.bytes += nbytes
+
+    def snapshot(self, wall):
+        capacity = wall * self.workers
+        return {
+            'workers': self.workers,
+            'busy_seconds': round(self.busy, 3),
+            'starved_seconds': round(self.starved, 3),
+            'blocked_seconds': round(self.blocked, 3),
+            'items': self.items,
+            'bytes': self.bytes,
+            'utilization': round(min(1.0, self.busy / capacity), 3) if capacity else 0.0,
+        }
+
+
+class _Queue:
+    """
+    FIFO bounded by the bytes it holds; one item always fits, however large.
+    An item counts until the consumer calls done() for it.
+    """
+
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self._items = collections.deque()
+        self._used = 0
+        self.peak = 0
+        self.aborted = False
+        self._cond = threading.Condition()
+
+    def put(self, item, size, stats):
+        started = time.monotonic()
+        with self._cond:
+            while self._used and self._used + size > self.capacity and not self.aborted:
+                self._cond.wait()
+            if self.aborted:
+                raise _Aborted()
+            self._items.append((item, size))
+            self._used += size
+            self.peak = max(self.peak, self._used)
+            self._cond.notify_all()
+        stats.add(blocked=time.monotonic() - started)
+
+    def get(self, stats):
+        """(item, size) of the oldest item."""
+        started = time.monotonic()
+        with self._cond:
+            while not self._items and not self.aborted:
+                self._cond.wait()
+            if self.aborted:
+                raise _Aborted()
+            entry = self._items.popleft()
+        stats.add(starved=time.monotonic() - started)
+        return entry
+
+    def done(self, size):
+        with self._cond:
+            self._used -= size
+            self._cond.notify_all()
+
+    def abort(self):
+        with self._cond:
+            self.aborted = True
+            self._cond.notify_all()
+
+
+class BufferPool:
+    """
+    Reusable bytearrays of one size. At most count are ever allocated, so the
+    memory they take is fixed; acquire() waits until one is released.
+    """
+
+    def __init__(self, size, count):
+        self.size = size
+        self.count = count
+        self.aborted = False
+        self._free = []
+        self.allocated = 0
+        self._cond = threading.Condition()
+
+    def acquire(self, stats=None):
+        started = time.monotonic()
+        with self._cond:
+            while not self._free and self.allocated >= self.count and not self.aborted:
+                self._cond.wait()
+            if self.aborted:
+                raise _Aborted()
+            if self._free:
+                buffer = self._free.pop()
+            else:
+                buffer = bytearray(self.size)
+                self.allocated += 1
+        if stats is not None:
+            stats.add(blocked=time.monotonic() - started)
+        return buffer
+
+    def release(self, buffer):
+        with self._cond:
+            self._free.append(buffer)
+            self._cond.notify()
+
+    def abort(self):
+        with self._cond:
+            self.aborted = True
+            self._cond.notify_all()
+
+
+def read_into(f, view):
+    """
+    Fill the memoryview view from file object f, with readinto() where f
+    has it; return the number of bytes read, less than len(view) only at
+    the end of f.
+    """
+    readinto = getattr(f, 'readinto', None)
+    filled = 0
+    while filled < len(view):
+        if readinto is None:
+            data = f.read(len(view) - filled)
+            n = len(data)
+            view[filled:filled + n] = data
+        else:
+            n = readinto(view[filled:])
+        if not n:
+            break
+        filled += n
+    return filled
+
+
+class PipelineWriter:
+    """
+    Write-only file object for tarfile: data written to it goes through the
+    chunker, compressor, writer, hasher and uploader threads into fileobj.
+    """
+
+    def __init__(self, fileobj, workers=None, block_size=DEFAULT_BLOCK_SIZE, level=DEFAULT_LEVEL,
+                 gate=None, upload_url=None, memory_budget=None):
+        """
+        gate, if given, returns a context manager every block is compressed
+        in; upload_url, if given, receives the archive as a chunked PUT.
+        """
+        self.fileobj = fileobj
+        self.workers = workers or os.cpu_count() or 1
+        self.block_size = block_size
+        self.level = level
+        self.gate = gate
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.sha256 = None
+        self.upload_failed = False
+        self.closed = False
+        if upload_url and requests is None:
+            logger.warning('requests is not installed, the archive is not uploaded')
+            upload_url = None
+        self.upload_url = upload_url
+        self.memory_budget = memory_budget or MEMORY_BUDGET
+
+        # Source data is read into pooled buffers and copied into pooled blocks
+        # that the compressors read from, so no bytes object is made per block.
+        # The pools take an eighth and a quarter of the budget (at least what
+        # keeps every compressor busy); the queues of compressed members split
+        # the rest, half of it for the members waiting to be written in order.
+        self._buffers = BufferPool(READ_SIZE, max(2, self.memory_budget // 8 // READ_SIZE))
+        self._blocks = BufferPool(block_size, max(self.workers + 1, self.memory_budget // 4 // block_size))
+        pooled = self._buffers.count * READ_SIZE + self._blocks.count * block_size
+        rest = max(0, self.memory_budget - pooled)
+        outputs = 2 if upload_url else 1
+        # The raw queue holds only buffers of the pool, which bounds it already.
+        self._raw = _Queue(self._buffers.count * READ_SIZE)
+        self._ordered = _Queue(max(block_size, rest // 2))
+        self._hashed = _Queue(max(block_size, rest // 2 // outputs))
+        self._uploaded = _Queue(max(block_size, rest // 2 // outputs)) if upload_url else None
+        self._buffer = None
+        self._fill = 0
+        self._bounded = [q for q in (self._raw, self._ordered, self._hashed, self._uploaded, self._buffers,
+                                     self._blocks) if q is not None]
+
+        self.stages = {
+            'reader': StageStats('reader'),
+            'chunker': StageStats('chunker'),
+            'compressor': StageStats('compressor', self.workers),
+            'writer': StageStats('writer'),
+            'hasher': StageStats('hasher'),
+        }
+        if upload_url:
+            self.stages['uploader'] = StageStats('uploader')
+        self._error = None
+        self._started = time.monotonic()
+        self._wall = None
+        self._executor = ThreadPoolExecutor(self.workers, thread_name_prefix='pipeline-compress')
+        self._threads = [threading.Thread(target=self._run, args=(name, target), name=f'pipeline-{name}',
+                                          daemon=True)
+                         for name, target in (('chunker', self._chunk), ('writer', self._write),
+                                              ('hasher', self._hash), ('uploader', self._upload))
+                         if name in self.stages]
+        for thread in self._threads:
+            thread.start()
+
+    # Reader side, called by tarfile
+
+    def write(self, data):
+        if self.closed:
+            raise ValueError('write to closed PipelineWriter')
+        view = memoryview(data).cast('B')
+        offset = 0
+        while offset < len(view):
+            buffer = self._reserve()
+            take = min(len(buffer) - self._fill, len(view) - offset)
+            buffer[self._fill:self._fill + take] = view[offset:offset + take]
+            self._fill += take
+            offset += take
+            self._flush_full()
+        self.bytes_in += len(view)
+        return len(view)
+
+    def readfrom(self, fileobj, size):
+        """Copy size bytes of fileobj into the pipeline, read with readinto into pooled buffers."""
+        if self.closed:
+            raise ValueError('write to closed PipelineWriter')
+        readinto = getattr(fileobj, 'readinto', None)
+        remaining = size
+        while remaining:
+            if readinto is None:
+                data = fileobj.read(min(READ_SIZE, remaining))
+                n = self.write(data) if data else 0
+            else:
+                buffer = self._reserve()
+                end = min(len(buffer), self._fill + remaining)
+                n = readinto(memoryview(buffer)[self._fill:end])
+                self._fill += n
+                self.bytes_in += n
+                self._flush_full()
+            if not n:
+                raise OSError('unexpected end of data')
+            remaining -= n
+
+    def tell(self):
+        return self.bytes_in
+
+    def set_level(self, level):
+        """Compress everything written from now on with level; 0 stores it."""
+        if level == self.level:
+            return
+        self._flush()
+        self.level = level
+        self._put_raw(level, 0)
+
+    def _reserve(self):
+        """The buffer being filled, taken from the pool when there is none."""
+        if self._buffer is None:
+            try:
+                self._buffer = self._buffers.acquire(self.stages['reader'])
+            except _Aborted:
+                self._raise()
+            self._fill = 0
+        return self._buffer
+
+    def _flush_full(self):
+        if self._fill == len(self._buffer):
+            self._flush()
+
+    def _flush(self):
+        buffer, fill = self._buffer, self._fill
+        self._buffer, self._fill = None, 0
+        if buffer is None:
+            return
+        if fill:
+            self._put_raw(buffer, fill)
+        else:
+            self._buffers.release(buffer)
+
+    def _put_raw(self, item, size):
+        try:
+            self._raw.put(item, size, self.stages['reader'])
+        except _Aborted:
+            self._raise()
+
+    def close(self):
+        """Wait for every stage to finish; raises PipelineError if one failed."""
+        if self.closed:
+            return
+        try:
+            self._flush()
+            self._put_raw(None, 0)
+            for thread in self._threads:
+                thread.join()
+            if self._error is not None:
+                self._raise()
+        finally:
+            self._finish()
+
+    def abort(self):
+        """Stop all stages without finishing the archive."""
+        if self.closed:
+            return
+        self._abort()
+        for thread in self._threads:
+            thread.join()
+        self._finish()
+
+    def _finish(self):
+        self.closed = True
+        self._executor.shutdown(cancel_futures=True)
+        self._wall = time.monotonic() - self._started
+
+    def _raise(self):
+        name, error = self._error
+        raise PipelineError(f'{name} stage failed: {error}') from error
+
+    def _abort(self):
+        for q in self._bounded:
+            q.abort()
+
+    def _run(self, name, target):
+        try:
+            target()
+        except _Aborted:
+            pass
+        except BaseException as e:
+            if self._error is None:
+                self._error = (name, e)
+            self._abort()
+
+    # Stages
+
+    def _chunk(self):
+        stats = self.stages['chunker']
+        block, fill = None, 0
+        level = self.level
+        emitted = False
+        while True:
+            item, size = self._raw.get(stats)
+            started, blocked = time.monotonic(), stats.blocked
+            if item is None:
+                break
+            if isinstance(item, int):
+                if fill:
+                    self._emit(block, fill, level, stats)
+                    block, fill = None, 0
+                    emitted = True
+                level = item
+            else:
+                view = memoryview(item)
+                offset = 0
+                while offset < size:
+                    if block is None:
+                        block = self._blocks.acquire(stats)
+                    take = min(self.block_size - fill, size - offset)
+                    block[fill:fill + take] = view[offset:offset + take]
+                    fill += take
+                    offset += take
+                    if fill == self.block_size:
+                        self._emit(block, fill, level, stats)
+                        block, fill = None, 0
+                        emitted = True
+                self._buffers.release(item)
+            self._raw.done(size)
+            # Time spent waiting for a block or for room in the ordered queue is not work.
+            stats.add(busy=time.monotonic() - started - (stats.blocked - blocked), items=1, nbytes=size)
+        if fill or not emitted:
+            self._emit(block if block is not None else self._blocks.acquire(stats), fill, level, stats)
+        self._ordered.put(None, 0, stats)
+
+    def _emit(self, block, size, level, stats):
+        future = self._executor.submit(self._compress, block, size, level)
+        self._ordered.put(future, size, stats)
+
+    def _compress(self, block, size, level):
+        stats = self.stages['compressor']
+        started = admitted = time.monotonic()
+        try:
+            if self.gate is None:
+                member = compress_block(memoryview(block)[:size], level)
+            else:
+                with self.gate():
+                    admitted = time.monotonic()
+                    member = compress_block(memoryview(block)[:size], level)
+        finally:
+            self._blocks.release(block)
+        stats.add(busy=time.monotonic() - admitted, blocked=admitted - started, items=1, nbytes=size)
+        return member
+
+    def _write(self):
+        stats = self.stages['writer']
+        outputs = [q for q in (self._hashed, self._uploaded) if q is not None]
+        while True:
+            future, size = self._ordered.get(stats)
+            if future is None:
+                break
+            waited = time.monotonic()
+            member = future.result()
+            started = time.monotonic()
+            self.fileobj.write(member)
+            self.bytes_out += len(member)
+            stats.add(busy=time.monotonic() - started, starved=started - waited, items=1, nbytes=len(member))
+            self._ordered.done(size)
+            for q in outputs:
+                q.put(member, len(member), stats)
+        for q in outputs:
+            q.put(None, 0, stats)
+
+    def _hash(self):
+        stats = self.stages['hasher']
+        digest = hashlib.sha256()
+        while True:
+            member, size = self._hashed.get(stats)
+            if member is None:
+                break
+            started = time.monotonic()
+            digest.update(member)
+            self._hashed.done(size)
+            stats.add(busy=time.monotonic() - started, items=1, nbytes=size)
+        self.sha256 = digest.hexdigest()
+
+    def _upload_body(self):
+        stats = self.stages['uploader']
+        while True:
+            member, size = self._uploaded.get(stats)
+            if member is None:
+                self._upload_finished = True
+                return
+            started = time.monotonic()
+            try:
+                # Resumes once requests has sent the member.
+                yield member
+            finally:
+                self._uploaded.done(size)
+                stats.add(busy=time.monotonic() - started, items=1, nbytes=size)
+
+    def _upload(self):
+        self._upload_finished = False
+        body = self._upload_body()
+        try:
+            response = requests.put(self.upload_url, data=body, timeout=UPLOAD_TIMEOUT)
+            response.raise_for_status()
+        except Exception as e:
+            if self._uploaded.aborted:
+                raise _Aborted() from e
+            logger.warning('Upload of the archive failed, it is only kept locally: %s', e)
+            self.upload_failed = True
+        finally:
+            body.close()
+        if not self._upload_finished:
+            if not self.upload_failed:
+                logger.warning('The upload server answered before the whole archive was sent')
+                self.upload_failed = True
+            # Keep taking members so the writer is not blocked.
+            for _ in self._upload_body():
+                pass
+
+    def peak_buffered(self):
+        """
+        Most bytes the pools and the queues of compressed members held; an
+        upper bound, as the queues' peaks need not coincide.
+        """
+        return (self._buffers.size * self._buffers.allocated + self._blocks.size * self._blocks.allocated
+                + sum(q.peak for q in (self._ordered, self._hashed, self._uploaded) if q is not None))
+
+    def report(self):
+        """Per-stage metrics of a closed writer, with the busiest stage as 'bottleneck'."""
+        wall = self._wall if self._wall is not None else time.monotonic() - self._started
+        reader = self.stages['reader']
+        # The calling thread reads whenever it is not waiting for the chunker.
+        reader.busy = max(0.0, wall - reader.blocked)
+        reader.items, reader.bytes = 0, self.bytes_in
+        stages = {name: stats.snapshot(wall) for name, stats in self.stages.items()}
+        report = {
+            'wall_seconds': round(wall, 3),
+            'memory_budget': self.memory_budget,
+            'peak_buffered': self.peak_buffered(),
+            'bytes_in': self.bytes_in,
+            'bytes_out': self.bytes_out,
+            'bottleneck': max(stages, key=lambda name: stages[name]['utilization']),
+            'stages': stages,
+        }
+        if self.sha256 is not None:
+            report['sha256'] = self.sha256
+        if self.upload_url:
+            report['upload_failed'] = self.upload_failed
+        return report
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, *exc):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+
+class _TarFile(tarfile.TarFile):
+    """TarFile that hands member data to PipelineWriter.readfrom() instead of copying it as bytes."""
+
+    def addfile(self, tarinfo, fileobj=None):
+        if fileobj is None or not tarinfo.size:
+            return super().addfile(tarinfo, fileobj)
+        self._check('awx')
+        tarinfo = copy.copy(tarinfo)
+        buf = tarinfo.tobuf(self.format, self.encoding, self.errors)
+        self.fileobj.write(buf)
+        self.offset += len(buf)
+        self.fileobj.readfrom(fileobj, tarinfo.size)
+        blocks, remainder = divmod(tarinfo.size, tarfile.BLOCKSIZE)
+        if remainder:
+            self.fileobj.write(tarfile.NUL * (tarfile.BLOCKSIZE - remainder))
+            blocks += 1
+        self.offset += blocks * tarfile.BLOCKSIZE
+        self.members.append(tarinfo)
+
+
+def format_report(report):
+    stages = ', '.join(f"{name} {stats['utilization']:.0%}" for name, stats in report['stages'].items())
+    return (f"{report['bytes_in'] / 2**20:.1f} MiB -> {report['bytes_out'] / 2**20:.1f} MiB "
+            f"in {report['wall_seconds']:.1f} s, bottleneck {report['bottleneck']} ({stages})")
+
+
+@contextmanager
+def open_tar(path, workers=None, level=DEFAULT_LEVEL, block_size=DEFAULT_BLOCK_SIZE, gate=None,
+             upload_url=None, metrics=None):
+    """
+    Open path for writing a .tar.gz through a PipelineWriter. The tar is not
+    opened in stream mode, so tar.fileobj is the writer itself and a
+    set_level() call takes effect exactly at the next member. The stage
+    report is logged and, if metrics is given, stored as metrics['pipeline'].
+    """
+    with open(path, 'wb') as f:
+        with PipelineWriter(f, workers, block_size, level, gate, upload_url) as writer:
+            with _TarFile.open(fileobj=writer, mode='w') as tar:
+                yield tar
+    report = writer.report()
+    logger.info('Wrote %s: %s', os.path.basename(path).removesuffix('.partial'), format_report(report))
+    if metrics is not None:
+        metrics['pipeline'] = report
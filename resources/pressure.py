@@ -0,0 +1,128 @@
+"""
+Linux pressure stall information (PSI) for backup backpressure.
+
+Reads /proc/pressure/{io,memory} (whole host) and the cgroup v2
+io.pressure/memory.pressure of our own container. Stall percentages are
+computed from the growth of the 'total' counters (microseconds stalled)
+between two samples, which reacts faster than the kernel's avg10; the first
+sample falls back to avg10.
+
+PressureMonitor polls the files on a thread and tells the IoGovernor when
+any configured threshold is crossed, so readers and compressors back off
+while the JVM container is fighting for the same disk or memory.
+"""
+
+import logging
+import threading
+import time
+from pathlib import Path
+
+logger = logging.getLogger(__name__)
+
+SOURCES = {
+    'system': Path('/proc/pressure'),
+    'cgroup': Path('/sys/fs/cgroup'),
+}
+_FILE_NAMES = {
+    'system': {'io': 'io', 'memory': 'memory'},
+    'cgroup': {'io': 'io.pressure', 'memory': 'memory.pressure'},
+}
+
+
+def read_psi(path):
+    """Parse a PSI file into {'some': {...}, 'full': {...}}, or None if unavailable."""
+    try:
+        text = Path(path).read_text()
+    except OSError:
+        return None
+    result = {}
+    for line in text.splitlines():
+        kind, _, fields = line.partition(' ')
+        values = {}
+        for field in fields.split():
+            key, _, value = field.partition('=')
+            values[key] = int(value) if key == 'total' else float(value)
+        result[kind] = values
+    return result
+
+
+class PressureMonitor:
+    def __init__(self, thresholds, interval=2.0, governor=None, sources=None):
+        """
+        thresholds maps (resource, kind) such as ('io', 'some') to a stall
+        percentage; crossing any of them counts as pressure.
+        """
+        self.thresholds = thresholds
+        self.interval = interval
+        self.governor = governor
+        self.files = {}
+        for source, root in (sources or SOURCES).items():
+            for resource, name in _FILE_NAMES[source].items():
+                path = root / name
+                if read_psi(path) is not None:
+                    self.files[(source, resource)] = path
+        self.stalled_seconds = 0.0
+        self.peaks = {}
+        self._last = {}
+        self._stop = threading.Event()
+        self._thread = None
+
+    @property
+    def available(self):
+        return bool(self.files)
+
+    def sample(self):
+        """Return {(source, resource, kind): stall %} for all readable PSI files."""
+        now = time.monotonic()
+        stalls = {}
+        for (source, resource), path in self.files.items():
+            psi = read_psi(path)
+            if psi is None:
+                continue
+            for kind, values in psi.items():
+                key = (source, resource, kind)
+                last = self._last.get(key)
+                if last is not None and now > last[0]:
+                    stall = (values['total'] - last[1]) / ((now - last[0]) * 1e6) * 100
+                else:
+                    stall = values.get('avg10', 0.0)
+                self._last[key] = (now, values['total'])
+                stalls[key] = max(0.0, min(100.0, stall))
+                name = '_'.join(key)
+                self.peaks[name] = max(self.peaks.get(name, 0.0), stalls[key])
+        return stalls
+
+    def exceeded(self, stalls):
+        return [f'{source} {resource} {kind} {stall:.1f}%'
+                for (source, resource, kind), stall in stalls.items()
+                if stall >= self.thresholds.get((resource, kind), 101)]
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            reasons = self.exceeded(self.sample())
+            if reasons:
+                self.stalled_seconds += self.interval
+            if self.governor is not None:
+                self.governor.set_pressure(reasons)
+
+    def start(self):
+        if not self.available:
+            logger.info('No PSI files found, pressure-based throttling is disabled')
+            return self
+        self.sample()
+        self._thread = threading.Thread(target=self._run, name='psi-monitor', daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+
+    def stats(self):
+        if not self.available:
+            return {}
+        return {
+            'psi_stalled_seconds': round(self.stalled_seconds, 1),
+            'psi_peak': {k: round(v, 1) for k, v in sorted(self.peaks.items())},
+        }
@@ -0,0 +1,69 @@
+"""
+Token bucket rate limiter.
+
+Thread-safe and non-blocking at its core: reserve() takes the tokens at once
+and returns how long the caller has to wait before using them, so the same
+bucket works for threads (time.sleep) and coroutines (asyncio.sleep).
+"""
+
+import threading
+import time
+
+
+class TokenBucket:
+    def __init__(self, rate, capacity=None):
+        """rate is in tokens per second; None or 0 means unlimited."""
+        self._lock = threading.Lock()
+        self.rate = rate
+        self.capacity = capacity if capacity is not None else rate
+        self._tokens = self.capacity or 0
+        self._updated = time.monotonic()
+
+    @property
+    def unlimited(self):
+        return not self.rate
+
+    def _refill(self, now):
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def set_rate(self, rate, capacity=None):
+        with self._lock:
+            if not self.unlimited:
+                self._refill(time.monotonic())
+            self.rate = rate
+            self.capacity = capacity if capacity is not None else rate
+            if self.capacity:
+                self._tokens = min(self._tokens, self.capacity)
+
+    def delay(self, amount=1):
+        """Seconds until amount tokens are available, without taking them."""
+        if self.unlimited:
+            return 0.0
+        with self._lock:
+            self._refill(time.monotonic())
+            return max(0.0, (amount - self._tokens) / self.rate)
+
+    def try_acquire(self, amount=1):
+        if self.unlimited:
+            return True
+        with self._lock:
+            self._refill(time.monotonic())
+            if self._tokens < amount:
+                return False
+            self._tokens -= amount
+            return True
+
+    def reserve(self, amount=1):
+        """Take amount tokens now (possibly going into debt) and return the wait in seconds."""
+        if self.unlimited:
+            return 0.0
+        with self._lock:
+            self._refill(time.monotonic())
+            self._tokens -= amount
+            return max(0.0, -self._tokens / self.rate)
+
+    def acquire(self, amount=1):
+        wait = self.reserve(amount)
+        if wait:
+            time.sleep(wait)
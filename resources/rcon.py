@@ -0,0 +1,247 @@
+"""
+Asyncio RCON client.
+
+One authenticated TCP connection is kept open and shared by every caller.
+The server's RCON handler parses only the first packet of every socket read
+and drops the rest, so one command is on the wire at a time and every packet
+gets its own write: the command packet, then, once its first reply packet
+shows the server has read it, an empty packet of an unknown type (the
+marker). The server answers packets in order, so the command's response is
+complete when the marker's "Unknown request" reply arrives; this reassembles
+responses the server splits across several 4 KiB packets. A dropped
+connection fails the request in flight and is re-established on the next
+command.
+
+RconThread runs a client behind a dispatcher.RconDispatcher on its own event
+loop thread, so blocking code (backup jobs, monitoring polls) shares the same
+connection and goes through the same priority queue.
+"""
+
+import asyncio
+import itertools
+import logging
+import struct
+import threading
+
+import dispatcher
+
+logger = logging.getLogger(__name__)
+
+SERVERDATA_RESPONSE_VALUE = 0
+SERVERDATA_EXECCOMMAND = 2
+SERVERDATA_AUTH = 3
+
+_HEADER = struct.Struct('<iii')
+
+
+class RconError(Exception):
+    pass
+
+
+class RconAuthError(RconError):
+    pass
+
+
+class RconConnectionError(RconError):
+    pass
+
+
+def encode_packet(request_id, packet_type, payload):
+    body = _HEADER.pack(0, request_id, packet_type)[4:] + payload.encode('utf-8') + b'\0\0'
+    return struct.pack('<i', len(body)) + body
+
+
+class _Request:
+    def __init__(self, loop):
+        self.future = loop.create_future()
+        self.answered = asyncio.Event()
+        self.parts = []
+
+
+class RconClient:
+    def __init__(self, host, port, password, timeout=10.0, max_reconnect_delay=30.0):
+        self.host = host
+        self.port = port
+        self.password = password
+        self.timeout = timeout
+        self.max_reconnect_delay = max_reconnect_delay
+        self._ids = itertools.count(1)
+        self._reader = None
+        self._writer = None
+        self._reader_task = None
+        self._connect_lock = asyncio.Lock()
+        self._send_lock = asyncio.Lock()
+        self._requests = {}
+        self._markers = {}
+        self._failures = 0
+
+    @property
+    def connected(self):
+        return self._writer is not None and not self._writer.is_closing()
+
+    def _next_id(self):
+        # Request ids are signed 32-bit; -1 is the server's "auth failed" reply.
+        return next(self._ids) % 0x7FFFFFFF or next(self._ids)
+
+    async def _read_packet(self):
+        size, = struct.unpack('<i', await self._reader.readexactly(4))
+        data = await self._reader.readexactly(size)
+        request_id, packet_type = struct.unpack_from('<ii', data)
+        return request_id, packet_type, data[8:-2].decode('utf-8', errors='replace')
+
+    async def _connect(self):
+        if self._failures:
+            delay = min(self.max_reconnect_delay, 2 ** (self._failures - 1))
+            logger.info('Reconnecting to RCON %s:%s in %d s', self.host, self.port, delay)
+            await asyncio.sleep(delay)
+        try:
+            self._reader, self._writer = await asyncio.wait_for(
+                asyncio.open_connection(self.host, self.port), self.timeout)
+            auth_id = self._next_id()
+            self._writer.write(encode_packet(auth_id, SERVERDATA_AUTH, self.password))
+            await self._writer.drain()
+            while True:
+                request_id, packet_type, _ = await asyncio.wait_for(self._read_packet(), self.timeout)
+                if request_id == -1:
+                    raise RconAuthError('RCON authentication failed')
+                if request_id == auth_id:
+                    break
+        except Exception:
+            self._failures += 1
+            await self._disconnect()
+            raise
+        self._failures = 0
+        self._reader_task = asyncio.ensure_future(self._read_loop())
+        logger.info('Connected to RCON %s:%s', self.host, self.port)
+
+    async def _ensure_connected(self):
+        if self.connected:
+            return
+        async with self._connect_lock:
+            if not self.connected:
+                await self._connect()
+
+    async def _disconnect(self):
+        if self._writer is not None:
+            self._writer.close()
+            try:
+                await self._writer.wait_closed()
+            except OSError:
+                pass
+        self._reader = self._writer = None
+
+    async def _read_loop(self):
+        try:
+            while True:
+                request_id, _, payload = await self._read_packet()
+                request = self._requests.get(request_id)
+                if request is not None:
+                    request.parts.append(payload)
+                    request.answered.set()
+                    continue
+                command_id = self._markers.pop(request_id, None)
+                request = self._requests.pop(command_id, None)
+                if request is not None and not request.future.done():
+                    request.future.set_result(''.join(request.parts))
+        except (OSError, asyncio.IncompleteReadError) as e:
+            logger.warning('RCON connection lost: %s', e)
+        finally:
+            await self._disconnect()
+            for request in self._requests.values():
+                if not request.future.done():
+                    request.future.set_exception(RconConnectionError('RCON connection lost'))
+            self._requests.clear()
+            self._markers.clear()
+
+    async def _send(self, command, timeout):
+        async with self._send_lock:
+            if not self.connected:
+                raise RconConnectionError('RCON connection lost')
+            command_id, marker_id = self._next_id(), self._next_id()
+            request = _Request(asyncio.get_running_loop())
+            self._requests[command_id] = request
+            try:
+                return await asyncio.wait_for(self._exchange(command, command_id, marker_id, request), timeout)
+            except asyncio.TimeoutError:
+                # The late reply, or a marker the server has not read yet, would
+                # mix with the next command; start over on a fresh connection.
+                await self._reset()
+                raise
+            finally:
+                self._requests.pop(command_id, None)
+                self._markers.pop(marker_id, None)
+
+    async def _exchange(self, command, command_id, marker_id, request):
+        self._writer.write(encode_packet(command_id, SERVERDATA_EXECCOMMAND, command))
+        await self._writer.drain()
+        # Sent together, the marker could arrive in the same read as the command and be dropped.
+        answered = asyncio.ensure_future(request.answered.wait())
+        try:
+            await asyncio.wait({answered, request.future}, return_when=asyncio.FIRST_COMPLETED)
+        finally:
+            answered.cancel()
+        if not request.future.done():
+            self._markers[marker_id] = command_id
+            self._writer.write(encode_packet(marker_id, SERVERDATA_RESPONSE_VALUE, ''))
+            await self._writer.drain()
+        return await request.future
+
+    async def command(self, command, timeout=None, retries=1):
+        """
+        Run a console command and return its full response text. Only
+        connecting is retried: once the command is written it may have run,
+        and save-all flush, save-off or say must not run twice.
+        """
+        timeout = timeout or self.timeout
+        for attempt in range(retries + 1):
+            try:
+                await self._ensure_connected()
+                break
+            except (RconError, OSError) as e:
+                if attempt == retries:
+                    raise RconConnectionError(f'RCON command {command!r} failed: {e}') from e
+        try:
+            return await self._send(command, timeout)
+        except (RconConnectionError, OSError) as e:
+            raise RconConnectionError(f'RCON command {command!r} failed: {e}') from e
+
+    async def _reset(self):
+        """Close the connection once its reader has failed the request in flight."""
+        task = self._reader_task
+        if task is not None:
+            task.cancel()
+            await asyncio.wait({task})
+        await self._disconnect()
+
+    async def close(self):
+        await self._reset()
+
+
+class RconThread:
+    """Blocking facade over a dispatched RconClient running on a private event loop."""
+
+    def __init__(self, host, port, password, timeout=10.0, max_in_flight=2, rates=None):
+        self.timeout = timeout
+        self.loop = asyncio.new_event_loop()
+        self._thread = threading.Thread(target=self.loop.run_forever, name='rcon', daemon=True)
+        self._thread.start()
+        self.client, self.dispatcher = self.run(
+            self._create(host, port, password, timeout, max_in_flight, rates))
+
+    @staticmethod
+    async def _create(host, port, password, timeout, max_in_flight, rates):
+        client = RconClient(host, port, password, timeout)
+        return client, dispatcher.RconDispatcher(client, max_in_flight, rates)
+
+    def run(self, coro, timeout=None):
+        """Run a coroutine on the RCON loop and wait for its result."""
+        return asyncio.run_coroutine_threadsafe(coro, self.loop).result(timeout)
+
+    def command(self, command, priority=dispatcher.NORMAL, timeout=None):
+        return self.run(self.dispatcher.command(command, priority, timeout))
+
+    def close(self):
+        self.run(self.dispatcher.close())
+        self.run(self.client.close())
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self._thread.join()
@@ -0,0 +1,164 @@
+"""
+Page-cache friendly reader for backup sources.
+
+Reading the whole world through the page cache pushes out the region files
+the server is working with. Files opened with open_source() are read in large
+aligned blocks with POSIX_FADV_SEQUENTIAL and a WILLNEED window ahead of the
+read position; the ranges already consumed are dropped again with DONTNEED.
+
+Pages that were cached before the backup touched the file are left alone:
+residency is checked with mincore() when the file is opened, and only ranges
+that the backup itself brought in are dropped. Without mincore a file written
+in the last HOT_SECONDS is assumed to be hot and is not dropped at all.
+
+Every read is also counted against the memory limit (memlimit.py).
+"""
+
+import ctypes
+import ctypes.util
+import io
+import mmap
+import os
+import time
+
+import memlimit
+
+READ_SIZE = 2**20
+READAHEAD = 8 * 2**20
+HOT_SECONDS = 600
+CACHE_FRIENDLY = True
+PAGE_SIZE = mmap.PAGESIZE
+
+_HAS_FADVISE = hasattr(os, 'posix_fadvise')
+_RESIDENT = bytes(i & 1 for i in range(256))
+
+
+def _load_libc():
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        libc.mmap.restype = ctypes.c_void_p
+        libc.mmap.argtypes = [ctypes.c_void_p, ctypes.c_size_t, ctypes.c_int,
+                              ctypes.c_int, ctypes.c_int, ctypes.c_long]
+        libc.munmap.argtypes = [ctypes.c_void_p, ctypes.c_size_t]
+        libc.mincore.argtypes = [ctypes.c_void_p, ctypes.c_size_t, ctypes.c_char_p]
+        return libc
+    except (OSError, AttributeError):
+        return None
+
+
+_libc = _load_libc()
+
+
+def resident_pages(fd, size):
+    """Bytes with 1 for every page of the file that is in the page cache, or None."""
+    if _libc is None or size == 0:
+        return None
+    addr = _libc.mmap(None, size, mmap.PROT_READ, mmap.MAP_SHARED, fd, 0)
+    if addr in (None, ctypes.c_void_p(-1).value):
+        return None
+    try:
+        pages = (size + PAGE_SIZE - 1) // PAGE_SIZE
+        vec = ctypes.create_string_buffer(pages)
+        if _libc.mincore(addr, size, vec) != 0:
+            return None
+        return vec.raw.translate(_RESIDENT)
+    finally:
+        _libc.munmap(addr, size)
+
+
+class BackupFileIO(io.RawIOBase):
+    """Raw file that manages its own page-cache footprint and pays reads to a governor."""
+
+    def __init__(self, path, governor=None, cache_friendly=True):
+        super().__init__()
+        self.fd = os.open(path, os.O_RDONLY | getattr(os, 'O_CLOEXEC', 0))
+        self.governor = governor
+        self.cache_friendly = cache_friendly and _HAS_FADVISE
+        st = os.fstat(self.fd)
+        self.size = st.st_size
+        self._pos = 0
+        self._advised = 0
+        self._touched = []
+        self._touched_bytes = 0
+        self._resident = None
+        self._hot = False
+        if self.cache_friendly:
+            self._resident = resident_pages(self.fd, self.size)
+            self._hot = self._resident is None and time.time() - st.st_mtime < HOT_SECONDS
+            os.posix_fadvise(self.fd, 0, 0, os.POSIX_FADV_SEQUENTIAL)
+
+    def fileno(self):
+        return self.fd
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        self._pos = os.lseek(self.fd, offset, whence)
+        return self._pos
+
+    def tell(self):
+        return self._pos
+
+    def readinto(self, buffer):
+        n = os.readv(self.fd, [buffer])
+        if self.cache_friendly and n:
+            self._touched.append((self._pos, n))
+            self._touched_bytes += n
+            if self._pos + n > self._advised:
+                # Ask for the next window while this one is being processed.
+                self._advised = self._pos + n + READAHEAD
+                os.posix_fadvise(self.fd, self._pos + n, READAHEAD, os.POSIX_FADV_WILLNEED)
+            if self._touched_bytes >= READAHEAD:
+                self._drop_touched()
+        self._pos += n
+        if self.governor is not None:
+            self.governor.throttle(n)
+        memlimit.account(n)
+        return n
+
+    def _drop(self, start, end):
+        if end > start:
+            os.posix_fadvise(self.fd, start, end - start, os.POSIX_FADV_DONTNEED)
+
+    def _drop_touched(self):
+        """DONTNEED the ranges read so far, except pages that were resident before."""
+        touched, self._touched = self._touched, []
+        self._touched_bytes = 0
+        if self._hot:
+            return
+        for offset, length in touched:
+            start = offset - offset % PAGE_SIZE
+            end = offset + length
+            if self._resident is None:
+                self._drop(start, end)
+                continue
+            page, last = start // PAGE_SIZE, (end + PAGE_SIZE - 1) // PAGE_SIZE
+            while page < last:
+                hot = self._resident.find(1, page, last)
+                stop = last if hot < 0 else hot
+                self._drop(page * PAGE_SIZE, stop * PAGE_SIZE)
+                if hot < 0:
+                    break
+                cold = self._resident.find(0, hot, last)
+                page = last if cold < 0 else cold
+
+    def close(self):
+        if self.closed:
+            return
+        try:
+            if self.cache_friendly:
+                self._drop_touched()
+        finally:
+            os.close(self.fd)
+            super().close()
+
+
+def open_source(path, governor=None, cache_friendly=None, buffer_size=READ_SIZE):
+    """Open a backup source file for reading; cache_friendly defaults to CACHE_FRIENDLY."""
+    if cache_friendly is None:
+        cache_friendly = CACHE_FRIENDLY
+    return io.BufferedReader(BackupFileIO(path, governor, cache_friendly), buffer_size)
@@ -0,0 +1,281 @@
+"""
+Packed region files (.mca.mcax) for long-term archives.
+
+Every chunk in a region file is compressed on its own, so whatever the
+chunks have in common (block palettes, biome lists, heightmaps, mod data)
+is stored again in each of them. A packed region inflates all chunks and
+compresses the raw NBT of the whole region as one zstd stream (xz when
+zstandard is not installed), which typically makes it 2-4 times smaller
+than the .mca file.
+
+Layout: a 6-byte header (magic, version, codec tag) followed by one
+compressed stream holding the original 8 KiB region header (sector map and
+timestamps) and one entry per chunk:
+
+    chunk index (2 bytes), compression type, flags, length (4 bytes), data
+
+Chunks compressed with gzip or zlib are stored inflated; other types
+(uncompressed, external .mcc, LZ4 or anything unknown) are kept as they
+are. When recompressing the NBT at the same level reproduces the original
+bytes, the chunk is flagged as exact; if all chunks of a region are exact
+the unpacked region is identical to the original, sector map included.
+Otherwise the chunks that no longer fit their sectors are moved to the end
+of the file and the NBT content is still the same. Packing and unpacking
+hold one chunk in memory at a time, however large the region.
+"""
+
+import argparse
+import gzip
+import logging
+import lzma
+import os
+import struct
+import tempfile
+import zlib
+from contextlib import contextmanager
+from pathlib import Path
+
+import anvil
+import codec
+from throttle import compress_gate, open_source
+
+logger = logging.getLogger(__name__)
+
+MAGIC = b'MCAX'
+VERSION = 1
+PACKED_SUFFIX = '.mcax'
+# The server deflates chunks with the zlib default level.
+RECOMPRESS_LEVEL = 6
+ZSTD_LEVEL = 19
+XZ_PRESET = 9
+SPOOL_SIZE = 16 * 2**20
+
+CHUNK_GZIP = 1
+CHUNK_ZLIB = 2
+
+FLAG_INFLATED = 0x80
+FLAG_EXACT = 0x40
+LEVEL_MASK = 0x0F
+
+_HEADER = struct.Struct('>4sBB')
+_ENTRY = struct.Struct('>HBBI')
+
+
+class PackError(Exception):
+    pass
+
+
+def default_codec():
+    return codec.TAG_ZSTD if codec.zstandard is not None else codec.TAG_XZ
+
+
+def _stream_writer(f, tag):
+    if tag == codec.TAG_ZSTD:
+        return codec.zstandard.ZstdCompressor(level=ZSTD_LEVEL).stream_writer(f, closefd=False)
+    if tag == codec.TAG_XZ:
+        return lzma.open(f, 'wb', preset=XZ_PRESET)
+    raise PackError(f'unsupported codec tag {tag} for packed regions')
+
+
+def _stream_reader(f, tag):
+    if tag == codec.TAG_ZSTD:
+        if codec.zstandard is None:
+            raise PackError('packed region uses zstd, but zstandard is not installed')
+        return codec.zstandard.ZstdDecompressor().stream_reader(f, closefd=False)
+    if tag == codec.TAG_XZ:
+        return lzma.open(f, 'rb')
+    raise PackError(f'unknown codec tag {tag} in packed region')
+
+
+def inflate_chunk(chunk_type, data):
+    try:
+        if chunk_type == CHUNK_ZLIB:
+            return zlib.decompress(data)
+        if chunk_type == CHUNK_GZIP:
+            return gzip.decompress(data)
+    except (zlib.error, OSError, EOFError):
+        pass
+    return None
+
+
+def deflate_chunk(chunk_type, raw, level):
+    if chunk_type == CHUNK_ZLIB:
+        return zlib.compress(raw, level)
+    return gzip.compress(raw, level, mtime=0)
+
+
+def _read_exact(f, size):
+    data = b''
+    while len(data) < size:
+        piece = f.read(size - len(data))
+        if not piece:
+            break
+        data += piece
+    return data
+
+
+def pack_region(src, dst, tag=None):
+    """
+    Pack the region file object src into dst and return counters. Raises
+    anvil.RegionError for a damaged region.
+    """
+    tag = tag or default_codec()
+    locations, timestamps = anvil.read_header(src)
+    stats = {'chunks': 0, 'exact': 0, 'raw_bytes': 0}
+    dst.write(_HEADER.pack(MAGIC, VERSION, tag))
+    with _stream_writer(dst, tag) as out:
+        out.write(anvil.pack_table([sector << 8 | count for sector, count in locations]))
+        out.write(anvil.pack_table(timestamps))
+        for index, location in enumerate(locations):
+            payload = anvil.read_chunk(src, location)
+            if payload is None:
+                continue
+            chunk_type, data = payload[0], payload[1:]
+            flags = 0
+            raw = inflate_chunk(chunk_type, data)
+            if raw is not None:
+                flags = FLAG_INFLATED | RECOMPRESS_LEVEL
+                if deflate_chunk(chunk_type, raw, RECOMPRESS_LEVEL) == data:
+                    flags |= FLAG_EXACT
+                    stats['exact'] += 1
+                data = raw
+            out.write(_ENTRY.pack(index, chunk_type, flags, len(data)))
+            out.write(data)
+            stats['chunks'] += 1
+            stats['raw_bytes'] += len(data)
+    return stats
+
+
+def unpack_region(src, dst):
+    """
+    Rebuild a region file in the seekable dst from the packed region file
+    object src, one chunk at a time. A chunk goes back to its original
+    sectors when it fits there, so a region whose chunks are all exact comes
+    back byte for byte; the others are appended after the original sectors.
+    """
+    magic, version, tag = _HEADER.unpack(_read_exact(src, _HEADER.size))
+    if magic != MAGIC or version != VERSION:
+        raise PackError('not a packed region file')
+    reader = _stream_reader(src, tag)
+    header = _read_exact(reader, anvil.HEADER_SIZE)
+    if len(header) < anvil.HEADER_SIZE:
+        raise PackError('packed region is truncated')
+    locations = [(loc >> 8, loc & 0xFF) for loc in anvil.unpack_table(header[:anvil.SECTOR_SIZE])]
+    timestamps = anvil.unpack_table(header[anvil.SECTOR_SIZE:])
+    table_locations = [0] * anvil.CHUNKS_PER_REGION
+    table = [0] * anvil.CHUNKS_PER_REGION
+    free = max([anvil.HEADER_SIZE // anvil.SECTOR_SIZE]
+               + [sector + count for sector, count in locations if sector])
+    used = set()
+    end = anvil.HEADER_SIZE
+    chunks = 0
+    while True:
+        entry = _read_exact(reader, _ENTRY.size)
+        if not entry:
+            break
+        if len(entry) < _ENTRY.size:
+            raise PackError('packed region is truncated')
+        index, chunk_type, flags, length = _ENTRY.unpack(entry)
+        data = _read_exact(reader, length)
+        if len(data) < length:
+            raise PackError(f'chunk {index} in packed region is truncated')
+        if flags & FLAG_INFLATED:
+            data = deflate_chunk(chunk_type, data, flags & LEVEL_MASK)
+        payload = bytes([chunk_type]) + data
+        sector, count = locations[index]
+        if (sector and len(payload) + 4 <= count * anvil.SECTOR_SIZE
+                and used.isdisjoint(range(sector, sector + count))):
+            anvil.write_chunk(dst, sector, payload, count)
+        else:
+            sector = free
+            count = anvil.write_chunk(dst, sector, payload)
+            free += count
+        used.update(range(sector, sector + count))
+        table_locations[index] = sector << 8 | count
+        table[index] = timestamps[index]
+        end = max(end, (sector + count) * anvil.SECTOR_SIZE)
+        chunks += 1
+    dst.seek(end)
+    dst.truncate()
+    dst.seek(0)
+    dst.write(anvil.pack_table(table_locations) + anvil.pack_table(table))
+    return chunks
+
+
+@contextmanager
+def packed(path, tag=None):
+    """Pack the region at path into a temporary file; yield (file at offset 0, packed size)."""
+    with open_source(path) as f, tempfile.SpooledTemporaryFile(SPOOL_SIZE) as out:
+        with compress_gate():
+            pack_region(f, out, tag)
+        size = out.tell()
+        out.seek(0)
+        yield out, size
+
+
+def add_packed(tar, path, rel, tag=None):
+    """
+    Add the region at path to a tar from pipeline.open_tar as
+    rel + PACKED_SUFFIX and return (region size, packed size).
+    """
+    writer = tar.fileobj
+    level = writer.level
+    with packed(path, tag) as (f, size):
+        info = tar.gettarinfo(str(path), arcname=rel + PACKED_SUFFIX)
+        info.size = size
+        # The stream is compressed already, gzip would only waste time on it.
+        writer.set_level(codec.STORE.gzip_level)
+        try:
+            tar.addfile(info, f)
+        finally:
+            writer.set_level(level)
+    return os.path.getsize(path), size
+
+
+def unpack_file(path):
+    """Replace an extracted .mca.mcax with the region file, keeping its mtime."""
+    path = Path(path)
+    target = path.with_name(path.name[:-len(PACKED_SUFFIX)])
+    tmp = target.with_name(target.name + '.partial')
+    with open(path, 'rb') as src, open(tmp, 'wb') as dst:
+        unpack_region(src, dst)
+    st = path.stat()
+    os.utime(tmp, ns=(st.st_atime_ns, st.st_mtime_ns))
+    os.replace(tmp, target)
+    path.unlink()
+    return target
+
+
+def unpack_tree(root):
+    """Unpack every packed region under root, e.g. after extracting an archive."""
+    count = 0
+    for path in sorted(Path(root).rglob('*.mca' + PACKED_SUFFIX)):
+        unpack_file(path)
+        count += 1
+    return count
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Pack and unpack region files.')
+    commands = parser.add_subparsers(dest='command', required=True)
+    pack = commands.add_parser('pack', help='pack one region file')
+    pack.add_argument('region', type=Path)
+    pack.add_argument('--xz', action='store_true', help='use xz even if zstandard is installed')
+    unpack = commands.add_parser('unpack', help='unpack .mca.mcax files (a file or a directory tree)')
+    unpack.add_argument('path', type=Path)
+    args = parser.parse_args()
+
+    if args.command == 'pack':
+        target = args.region.with_name(args.region.name + PACKED_SUFFIX)
+        with open(args.region, 'rb') as src, open(target, 'wb') as dst:
+            stats = pack_region(src, dst, codec.TAG_XZ if args.xz else None)
+        print(f'{target}: {stats["chunks"]} chunks ({stats["exact"]} exact), '
+              f'{args.region.stat().st_size} -> {target.stat().st_size} bytes')
+    elif args.path.is_dir():
+        print(f'Unpacked {unpack_tree(args.path)} regions')
+    else:
+        print(unpack_file(args.path))
+
+
+if __name__ == '__main__':
+    main()
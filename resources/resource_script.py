@@ -1,19 +1,50 @@
 #!/usr/bin/env python3
 """
+Backup service for the Minecraft server.
 
+Runs next to the Manager container, talks to the server over RCON to pause
+autosave while the world is archived and keeps backups of MC_DATA_DIR in
+BACKUP_DIR. BACKUP_MODE selects a plain full archive on every run ('full'),
+a chain of a full archive followed by chunk-level incrementals
+('incremental') or snapshots in the deduplicating object store ('store').
 """
 
 import os
 import sys
+import json
 import time
 import shutil
 import tarfile
-import schedule
 import logging
+import argparse
 import requests
+import threading
+from contextlib import contextmanager, nullcontext
 from datetime import datetime, timedelta
 from pathlib import Path
-from mcrcon import MCRcon
+
+import anvil
+import catalog
+import codec
+import dirtyset
+import incremental
+import journal
+import logwatch
+import memlimit
+import objstore
+import pipeline
+import pressure
+import rcon
+import reader
+import regionpack
+import restore
+import scheduler
+import seekable
+from dispatcher import CRITICAL, MONITORING, NORMAL
+import snapshot
+import tarindex
+import throttle
+import walker
 
 logging.basicConfig(
     level=logging.INFO,
@@ -24,4 +55,669 @@ logging.basicConfig(
     ]
 )
 
-logger = logging.getLogger(__name__)
\ No newline at end of file
+logger = logging.getLogger(__name__)
+
+MC_DATA_DIR = Path(os.environ.get('MC_DATA_DIR', '/data'))
+BACKUP_DIR = Path(os.environ.get('BACKUP_DIR', '/app/backups'))
+RCON_HOST = os.environ.get('RCON_HOST', 'localhost')
+RCON_PORT = int(os.environ.get('RCON_PORT', '25575'))
+RCON_PASSWORD = os.environ.get('RCON_PASSWORD', '')
+# Commands handed to the RCON connection at once, which sends them one at a
+# time (one slot is kept for backup control), and the rate limit for
+# monitoring polls in commands per second.
+RCON_MAX_IN_FLIGHT = int(os.environ.get('RCON_MAX_IN_FLIGHT', '2'))
+RCON_MONITORING_RATE = float(os.environ.get('RCON_MONITORING_RATE', '2'))
+
+BACKUP_MODE = os.environ.get('BACKUP_MODE', 'full')
+BACKUP_INTERVAL_MINUTES = int(os.environ.get('BACKUP_INTERVAL_MINUTES', '60'))
+# Cron expression ("0 */2 * * *"); when set it replaces BACKUP_INTERVAL_MINUTES.
+BACKUP_CRON = os.environ.get('BACKUP_CRON', '')
+BACKUP_JITTER_SECONDS = int(os.environ.get('BACKUP_JITTER_SECONDS', '0'))
+# Threads for short periodic jobs (journal polls) and, separately, for long
+# ones (backups, tar indexing, journal compaction).
+SCHEDULER_WORKERS = int(os.environ.get('SCHEDULER_WORKERS', '2'))
+SCHEDULER_LONG_WORKERS = int(os.environ.get('SCHEDULER_LONG_WORKERS', '2'))
+BACKUP_RETENTION_DAYS = int(os.environ.get('BACKUP_RETENTION_DAYS', '7'))
+# In incremental mode a new full backup is made after this many incrementals.
+FULL_BACKUP_EVERY = int(os.environ.get('FULL_BACKUP_EVERY', '24'))
+# Make that full backup by merging the chain in BACKUP_DIR (after saving is
+# back on) instead of reading the whole world again.
+BACKUP_SYNTHETIC_FULL = os.environ.get('BACKUP_SYNTHETIC_FULL', 'true').lower() in ('1', 'true', 'yes')
+# Incrementals store files of at least BACKUP_DELTA_MIN_MB that changed in
+# place as rsync-style deltas against the chain's full backup.
+BACKUP_DELTA = os.environ.get('BACKUP_DELTA', 'true').lower() in ('1', 'true', 'yes')
+BACKUP_DELTA_MIN_MB = float(os.environ.get('BACKUP_DELTA_MIN_MB', '1'))
+DELTA_MIN_SIZE = int(BACKUP_DELTA_MIN_MB * 2**20) if BACKUP_DELTA else None
+# In store mode a changed chunk may be kept as a delta against its previous
+# version, at most this many in a row before it is stored whole again (0: off).
+STORE_CHUNK_DELTA_DEPTH = int(os.environ.get('STORE_CHUNK_DELTA_DEPTH', '0'))
+BACKUP_EXCLUDE = set(filter(None, os.environ.get('BACKUP_EXCLUDE', 'logs,crash-reports').split(',')))
+MC_LOG_FILE = Path(os.environ.get('MC_LOG_FILE', str(MC_DATA_DIR / 'logs' / 'latest.log')))
+# How long to wait for "Saved the game" in the server log after save-all flush.
+SAVE_TIMEOUT_SECONDS = int(os.environ.get('SAVE_TIMEOUT_SECONDS', '300'))
+# Fixed wait used only when the server log cannot be followed.
+SAVE_WAIT_SECONDS = int(os.environ.get('SAVE_WAIT_SECONDS', '10'))
+# Compression threads for .tar.gz archives; 0 means one per CPU core.
+BACKUP_WORKERS = int(os.environ.get('BACKUP_WORKERS', '0')) or None
+BACKUP_COMPRESS_LEVEL = int(os.environ.get('BACKUP_COMPRESS_LEVEL', '6'))
+# Codecs probed per file type; an empty list compresses everything at
+# BACKUP_COMPRESS_LEVEL. .tar.gz modes only use store and zlib levels.
+BACKUP_CODECS = [c.strip() for c in os.environ.get(
+    'BACKUP_CODECS', ','.join(codec.DEFAULT_CANDIDATES)).split(',') if c.strip()]
+BACKUP_CODEC_CPU_COST = float(os.environ.get('BACKUP_CODEC_CPU_COST_MB', '8')) * 2**20
+# Full archives store region files packed (regionpack.py): much smaller,
+# but every chunk is inflated and the region recompressed with zstd/xz.
+BACKUP_REGION_PACK = os.environ.get('BACKUP_REGION_PACK', 'false').lower() in ('1', 'true', 'yes')
+# Background indexing of .tar.gz archives (tarindex.py): member lists and
+# gzip access points every TAR_INDEX_SPAN_MB for fast single-file restores.
+TAR_INDEX = os.environ.get('TAR_INDEX', 'true').lower() in ('1', 'true', 'yes')
+TAR_INDEX_INTERVAL_MINUTES = int(os.environ.get('TAR_INDEX_INTERVAL_MINUTES', '60'))
+TAR_INDEX_SPAN = int(float(os.environ.get('TAR_INDEX_SPAN_MB', '8')) * 2**20)
+# Format of full-mode archives: 'tar.gz' or 'seekable' (seekable.py, random
+# access to single files without reading the whole archive).
+BACKUP_ARCHIVE_FORMAT = os.environ.get('BACKUP_ARCHIVE_FORMAT', 'tar.gz')
+# Continuous chunk journal (journal.py): changed chunks and files of
+# JOURNAL_PATHS are appended every JOURNAL_INTERVAL_SECONDS, giving recovery
+# points for the last JOURNAL_RETENTION_HOURS; older segments are folded
+# into a checkpoint every JOURNAL_COMPACT_HOURS. With JOURNAL_SAVE_ALL every
+# poll is preceded by save-all, for servers that only write on autosave.
+JOURNAL = os.environ.get('JOURNAL', 'false').lower() in ('1', 'true', 'yes')
+JOURNAL_INTERVAL_SECONDS = int(os.environ.get('JOURNAL_INTERVAL_SECONDS', '60'))
+JOURNAL_RETENTION_HOURS = float(os.environ.get('JOURNAL_RETENTION_HOURS', '24'))
+JOURNAL_COMPACT_HOURS = float(os.environ.get('JOURNAL_COMPACT_HOURS', '6'))
+JOURNAL_PATHS = [p.strip().strip('/') for p in os.environ.get('JOURNAL_PATHS', 'world').split(',') if p.strip()]
+JOURNAL_SAVE_ALL = os.environ.get('JOURNAL_SAVE_ALL', 'false').lower() in ('1', 'true', 'yes')
+# SQLite catalog of all backups (catalog.py), synced after every run: file
+# and chunk versions for listings and "what changed since" queries.
+BACKUP_CATALOG = os.environ.get('BACKUP_CATALOG', 'true').lower() in ('1', 'true', 'yes')
+# Watch MC_DATA_DIR with inotify between backups (dirtyset.py) so incremental
+# and store backups stat only the changed paths instead of the whole tree.
+BACKUP_DIRTY_SET = os.environ.get('BACKUP_DIRTY_SET', 'true').lower() in ('1', 'true', 'yes')
+
+# Two-phase backups: clone the world to SNAPSHOT_DIR while saving is off and
+# compress from the clone after saving is back on. SNAPSHOT_DIR should be on
+# the same filesystem as MC_DATA_DIR so reflinks and hardlinks work.
+BACKUP_SNAPSHOT = os.environ.get('BACKUP_SNAPSHOT', 'false').lower() in ('1', 'true', 'yes')
+SNAPSHOT_DIR = Path(os.environ.get('SNAPSHOT_DIR', str(MC_DATA_DIR / '.backup-snapshot')))
+if SNAPSHOT_DIR.is_relative_to(MC_DATA_DIR):
+    BACKUP_EXCLUDE.add(SNAPSHOT_DIR.relative_to(MC_DATA_DIR).as_posix())
+
+# Adaptive read throttling: the backup read rate moves between the two limits
+# depending on the server's mean tick time, sampled every TPS_SAMPLE_SECONDS.
+# A backup that comes due while MSPT is above BACKUP_DEFER_MSPT is retried
+# after BACKUP_DEFER_MINUTES, at most BACKUP_MAX_DEFERRALS times in a row.
+BACKUP_THROTTLE = os.environ.get('BACKUP_THROTTLE', 'true').lower() in ('1', 'true', 'yes')
+BACKUP_READ_RATE_MIN_MB = float(os.environ.get('BACKUP_READ_RATE_MIN_MB', '5'))
+BACKUP_READ_RATE_MAX_MB = float(os.environ.get('BACKUP_READ_RATE_MAX_MB', '200'))
+BACKUP_MSPT_LOW = float(os.environ.get('BACKUP_MSPT_LOW', '25'))
+BACKUP_MSPT_HIGH = float(os.environ.get('BACKUP_MSPT_HIGH', '40'))
+BACKUP_DEFER_MSPT = float(os.environ.get('BACKUP_DEFER_MSPT', '50'))
+BACKUP_DEFER_MINUTES = int(os.environ.get('BACKUP_DEFER_MINUTES', '10'))
+BACKUP_MAX_DEFERRALS = int(os.environ.get('BACKUP_MAX_DEFERRALS', '6'))
+TPS_SAMPLE_SECONDS = float(os.environ.get('TPS_SAMPLE_SECONDS', '5'))
+# Kernel pressure (PSI) backpressure: while any stall percentage is above its
+# threshold the backup reads at BACKUP_READ_RATE_MIN_MB with one compressor.
+BACKUP_PSI = os.environ.get('BACKUP_PSI', 'true').lower() in ('1', 'true', 'yes')
+PSI_THRESHOLDS = {
+    ('io', 'some'): float(os.environ.get('PSI_IO_SOME', '30')),
+    ('io', 'full'): float(os.environ.get('PSI_IO_FULL', '10')),
+    ('memory', 'some'): float(os.environ.get('PSI_MEMORY_SOME', '20')),
+    ('memory', 'full'): float(os.environ.get('PSI_MEMORY_FULL', '5')),
+}
+PSI_SAMPLE_SECONDS = float(os.environ.get('PSI_SAMPLE_SECONDS', '2'))
+# Read world files with fadvise hints and drop the pages the backup itself
+# pulled into the page cache, so the server's hot regions stay cached.
+BACKUP_FADVISE = os.environ.get('BACKUP_FADVISE', 'true').lower() in ('1', 'true', 'yes')
+reader.CACHE_FRIENDLY = BACKUP_FADVISE
+# Threads listing and stat'ing MC_DATA_DIR (walker.py); more help on network volumes.
+BACKUP_WALK_WORKERS = int(os.environ.get('BACKUP_WALK_WORKERS', '8'))
+walker.WORKERS = BACKUP_WALK_WORKERS
+# Memory the buffers and queues between the stages of a .tar.gz backup may hold (pipeline.py).
+BACKUP_PIPELINE_MEMORY_MB = int(os.environ.get('BACKUP_PIPELINE_MEMORY_MB', '256'))
+pipeline.MEMORY_BUDGET = BACKUP_PIPELINE_MEMORY_MB * 2**20
+# Resident memory the backup process may use (memlimit.py); a backup that
+# cannot stay below it fails instead of taking memory from the server. 0: no limit.
+BACKUP_MAX_RSS_MB = int(os.environ.get('BACKUP_MAX_RSS_MB', '1024'))
+memlimit.LIMIT = BACKUP_MAX_RSS_MB * 2**20 or None
+# Full .tar.gz archives are also streamed to this URL as they are written
+# (chunked HTTP PUT); {name} is replaced by the archive's file name.
+BACKUP_UPLOAD_URL = os.environ.get('BACKUP_UPLOAD_URL', '')
+
+FULL_ARCHIVE_DIR = BACKUP_DIR / 'full'
+CHAIN_ARCHIVE_DIR = BACKUP_DIR / 'chain'
+STORE_DIR = BACKUP_DIR / 'store'
+JOURNAL_DIR = BACKUP_DIR / 'journal'
+CATALOG_PATH = BACKUP_DIR / catalog.CATALOG_FILE
+# Next to a full .tar.gz made with BACKUP_CODECS: {member: codec name}.
+CODECS_SUFFIX = '.codecs.json'
+
+_backup_lock = threading.Lock()
+# Held from a backup's start to its completion, like _backup_lock, but across
+# processes: the restore commands refuse to run while a backup holds it.
+_save_control_file = restore.SaveControlLock(BACKUP_DIR)
+_deferrals = 0
+# Held while saving is switched off or on; journal polls only send save-all
+# while saving is on.
+_save_control = threading.Lock()
+_saving_paused = threading.Event()
+_journal = None
+_dirty = None
+
+
+_rcon = None
+_rcon_lock = threading.Lock()
+
+
+def get_rcon():
+    """The RCON connection shared by backups and monitoring."""
+    global _rcon
+    with _rcon_lock:
+        if _rcon is None:
+            _rcon = rcon.RconThread(RCON_HOST, RCON_PORT, RCON_PASSWORD,
+                                    max_in_flight=RCON_MAX_IN_FLIGHT,
+                                    rates={MONITORING: RCON_MONITORING_RATE})
+        return _rcon
+
+
+def close_rcon():
+    global _rcon
+    with _rcon_lock:
+        if _rcon is not None:
+            _rcon.close()
+            _rcon = None
+
+
+def rcon_command(command, priority=CRITICAL, timeout=None):
+    response = get_rcon().command(command, priority, timeout)
+    logger.info('RCON %s: %s', command, response.strip())
+    return response
+
+
+def make_selector():
+    if not BACKUP_CODECS:
+        return None
+    candidates = codec.available(BACKUP_CODECS)
+    if BACKUP_MODE == 'incremental' or (BACKUP_MODE == 'full' and BACKUP_ARCHIVE_FORMAT == 'tar.gz'):
+        candidates = codec.gzip_compatible(candidates)
+    return codec.CodecSelector(candidates, BACKUP_CODEC_CPU_COST)
+
+
+def create_full_archive(source_dir, backup_id, selector=None, metrics=None):
+    FULL_ARCHIVE_DIR.mkdir(parents=True, exist_ok=True)
+    if BACKUP_ARCHIVE_FORMAT == 'seekable':
+        archive_path = FULL_ARCHIVE_DIR / f'world-{backup_id}{seekable.SUFFIX}'
+        region_bytes, packed_bytes = _write_seekable(source_dir, archive_path, selector)
+    else:
+        archive_path = FULL_ARCHIVE_DIR / f'world-{backup_id}.tar.gz'
+        region_bytes, packed_bytes = _write_tar(source_dir, archive_path, selector, metrics)
+    logger.info('Full backup written to %s', archive_path)
+    if region_bytes:
+        logger.info('Packed regions: %.1f MiB -> %.1f MiB', region_bytes / 2**20, packed_bytes / 2**20)
+        if metrics is not None:
+            metrics['region_pack'] = {'region_bytes': region_bytes, 'packed_bytes': packed_bytes}
+    return archive_path
+
+
+def codecs_path(archive_path):
+    """Sidecar of a full .tar.gz listing the codec chosen for each member, like the manifests' 'codecs'."""
+    return archive_path.with_name(archive_path.name + CODECS_SUFFIX)
+
+
+def _write_tar(source_dir, archive_path, selector, metrics=None):
+    tmp_path = archive_path.with_name(archive_path.name + '.partial')
+    region_bytes = packed_bytes = 0
+    codecs = {}
+    upload_url = BACKUP_UPLOAD_URL.format(name=archive_path.name) if BACKUP_UPLOAD_URL else None
+    # A failed archive, e.g. stopped by the memory limit, must not stay behind as .partial.
+    try:
+        with pipeline.open_tar(tmp_path, BACKUP_WORKERS, BACKUP_COMPRESS_LEVEL, gate=throttle.compress_gate,
+                               upload_url=upload_url, metrics=metrics) as tar:
+            for rel, _ in incremental.iter_tree(source_dir, BACKUP_EXCLUDE):
+                if BACKUP_REGION_PACK and incremental.is_region_path(rel):
+                    try:
+                        size, packed = regionpack.add_packed(tar, source_dir / rel, rel)
+                        region_bytes += size
+                        packed_bytes += packed
+                        if selector is not None:
+                            codecs[rel + regionpack.PACKED_SUFFIX] = codec.STORE.name
+                        continue
+                    except anvil.RegionError as e:
+                        logger.warning('Storing %s unpacked: %s', rel, e)
+                incremental.add_file(tar, source_dir / rel, rel, selector, codecs)
+    except BaseException:
+        tmp_path.unlink(missing_ok=True)
+        raise
+    if codecs:
+        sidecar = codecs_path(archive_path)
+        tmp_sidecar = sidecar.with_name(sidecar.name + '.partial')
+        with open(tmp_sidecar, 'w', encoding='utf-8') as f:
+            json.dump(codecs, f, separators=(',', ':'))
+        os.replace(tmp_sidecar, sidecar)
+    os.replace(tmp_path, archive_path)
+    return region_bytes, packed_bytes
+
+
+def _write_seekable(source_dir, archive_path, selector):
+    region_bytes = packed_bytes = 0
+    default = codec.CODECS.get(f'zlib-{BACKUP_COMPRESS_LEVEL}', codec.CODECS['zlib-6'])
+    with seekable.SeekableWriter(archive_path, BACKUP_WORKERS, throttle.compress_gate,
+                                 default_codec=default) as archive:
+        for rel, st in incremental.iter_tree(source_dir, BACKUP_EXCLUDE):
+            if BACKUP_REGION_PACK and incremental.is_region_path(rel):
+                try:
+                    with regionpack.packed(source_dir / rel) as (f, size):
+                        archive.add_stream(rel + regionpack.PACKED_SUFFIX, f, st.st_mtime_ns,
+                                           st.st_mode & 0o7777, codec.STORE)
+                    region_bytes += st.st_size
+                    packed_bytes += size
+                    continue
+                except anvil.RegionError as e:
+                    logger.warning('Storing %s unpacked: %s', rel, e)
+            archive.add_file(source_dir / rel, rel, selector)
+    return region_bytes, packed_bytes
+
+
+def cleanup_old_backups():
+    cutoff = datetime.now() - timedelta(days=BACKUP_RETENTION_DAYS)
+    archives = [*FULL_ARCHIVE_DIR.glob('world-*.tar.gz'),
+                *FULL_ARCHIVE_DIR.glob('world-*' + seekable.SUFFIX)]
+    for path in archives:
+        if datetime.fromtimestamp(path.stat().st_mtime) < cutoff:
+            path.unlink()
+            codecs_path(path).unlink(missing_ok=True)
+            logger.info('Removed old backup %s', path.name)
+    if CHAIN_ARCHIVE_DIR.exists():
+        incremental.prune_chains(CHAIN_ARCHIVE_DIR, BACKUP_RETENTION_DAYS)
+    if STORE_DIR.exists():
+        store = objstore.ObjectStore(STORE_DIR)
+        try:
+            store.prune(BACKUP_RETENTION_DAYS)
+        finally:
+            store.close()
+
+
+class BackupRun:
+    """State of one backup run shared by the capture and archive phases."""
+
+    def __init__(self):
+        self.id = datetime.now().strftime('%Y%m%d-%H%M%S')
+        self.started = time.monotonic()
+        self.metrics = {'id': self.id, 'mode': BACKUP_MODE, 'snapshot': BACKUP_SNAPSHOT}
+        self.governor = None
+        self.sampler = None
+        self.pressure = None
+        self.selector = make_selector()
+        memlimit.reset_peak()
+
+
+def archive(source_dir, run):
+    # Chunks restored since the last run may carry old timestamps.
+    pending = restore.pending_chunks(BACKUP_DIR)
+    # The dirty set describes the live directory only, not a clone of it.
+    tracked = _dirty.pending() if _dirty is not None and source_dir == MC_DATA_DIR else nullcontext()
+    with throttle.governed(run.governor), tracked as dirty:
+        if dirty is not None:
+            run.metrics['dirty_paths'] = len(dirty[0]) + len(dirty[1])
+        if BACKUP_MODE == 'incremental':
+            incremental.run_backup(source_dir, CHAIN_ARCHIVE_DIR, run.id,
+                                   FULL_BACKUP_EVERY, BACKUP_EXCLUDE,
+                                   BACKUP_WORKERS, BACKUP_COMPRESS_LEVEL, run.selector, pending,
+                                   BACKUP_SYNTHETIC_FULL, DELTA_MIN_SIZE, dirty, run.metrics)
+        elif BACKUP_MODE == 'store':
+            store = objstore.ObjectStore(STORE_DIR, STORE_CHUNK_DELTA_DEPTH)
+            try:
+                store.create_snapshot(source_dir, run.id, BACKUP_EXCLUDE, run.selector, pending, dirty)
+            finally:
+                store.close()
+        else:
+            create_full_archive(source_dir, run.id, run.selector, run.metrics)
+    if pending:
+        restore.clear_pending(BACKUP_DIR, pending)
+    if run.selector is not None:
+        run.metrics.update(run.selector.stats())
+
+
+def record_metrics(metrics):
+    BACKUP_DIR.mkdir(parents=True, exist_ok=True)
+    with open(BACKUP_DIR / 'metrics.jsonl', 'a', encoding='utf-8') as f:
+        f.write(json.dumps(metrics) + '\n')
+
+
+def monitor_command(command):
+    return get_rcon().command(command, MONITORING)
+
+
+def check_admission():
+    """Raise RetryLater when the server is already lagging at backup time."""
+    global _deferrals
+    result = throttle.TpsSampler(monitor_command).sample()
+    if result is None or result[0] <= BACKUP_DEFER_MSPT:
+        _deferrals = 0
+        return
+    if _deferrals >= BACKUP_MAX_DEFERRALS:
+        logger.warning('MSPT is %.1f ms but the backup was deferred %d times already, running it',
+                       result[0], _deferrals)
+        _deferrals = 0
+        return
+    _deferrals += 1
+    raise scheduler.RetryLater(BACKUP_DEFER_MINUTES * 60, f'server is lagging (MSPT {result[0]:.1f} ms)')
+
+
+def flush_world():
+    """Run save-all flush and wait until the server reports the save as done."""
+    if not MC_LOG_FILE.exists():
+        logger.warning('%s not found, waiting %d s for the save instead', MC_LOG_FILE, SAVE_WAIT_SECONDS)
+        rcon_command('save-all flush', timeout=SAVE_TIMEOUT_SECONDS)
+        time.sleep(SAVE_WAIT_SECONDS)
+        return
+    started = time.monotonic()
+    with logwatch.LogFollower(MC_LOG_FILE) as follower:
+        # Current servers answer save-all flush only once the save is done.
+        rcon_command('save-all flush', timeout=SAVE_TIMEOUT_SECONDS)
+        follower.wait_for(logwatch.SAVED_THE_GAME, max(1.0, SAVE_TIMEOUT_SECONDS - (time.monotonic() - started)))
+    logger.info('World saved in %.1f s', time.monotonic() - started)
+
+
+def capture(run):
+    """
+    Pause autosave, flush the world and either archive it directly or, with
+    BACKUP_SNAPSHOT enabled, only clone it to SNAPSHOT_DIR before saving is
+    switched back on.
+    """
+    with _save_control:
+        rcon_command('save-off')
+        _saving_paused.set()
+    disabled_at = time.monotonic()
+    try:
+        flush_world()
+        if BACKUP_SNAPSHOT:
+            shutil.rmtree(SNAPSHOT_DIR, ignore_errors=True)
+            run.metrics['snapshot_files'] = snapshot.snapshot_tree(MC_DATA_DIR, SNAPSHOT_DIR, BACKUP_EXCLUDE)
+        else:
+            archive(MC_DATA_DIR, run)
+    finally:
+        with _save_control:
+            try:
+                rcon_command('save-on')
+                _saving_paused.clear()
+            except Exception:
+                logger.exception('Could not re-enable saving')
+        run.metrics['saving_disabled_seconds'] = round(time.monotonic() - disabled_at, 3)
+        logger.info('Saving was disabled for %.1f s', run.metrics['saving_disabled_seconds'])
+
+
+def synthesize_full(metrics):
+    """Restart a long chain from a synthetic full backup; reads only BACKUP_DIR."""
+    if not incremental.synthesis_due(CHAIN_ARCHIVE_DIR, FULL_BACKUP_EVERY):
+        return
+    started = time.monotonic()
+    synthetic = {}
+    try:
+        incremental.synthesize_full(CHAIN_ARCHIVE_DIR, BACKUP_WORKERS, BACKUP_COMPRESS_LEVEL, DELTA_MIN_SIZE,
+                                    synthetic)
+    except Exception:
+        logger.exception('Could not build a synthetic full backup, will retry after the next backup')
+        metrics['synthetic_failed'] = True
+    if 'pipeline' in synthetic:
+        metrics['synthetic_pipeline'] = synthetic['pipeline']
+    metrics['synthetic_seconds'] = round(time.monotonic() - started, 3)
+
+
+def update_catalog(metrics):
+    started = time.monotonic()
+    try:
+        with catalog.Catalog(CATALOG_PATH) as backups:
+            backups.sync(BACKUP_DIR, MC_DATA_DIR)
+    except Exception:
+        logger.exception('Could not update the backup catalog')
+        metrics['catalog_failed'] = True
+    metrics['catalog_seconds'] = round(time.monotonic() - started, 3)
+
+
+def complete(run):
+    metrics = run.metrics
+    metrics['total_seconds'] = round(time.monotonic() - run.started, 3)
+    if run.sampler is not None:
+        run.sampler.stop()
+        metrics.update(run.sampler.stats())
+    if run.pressure is not None:
+        run.pressure.stop()
+        metrics.update(run.pressure.stats())
+    if run.governor is not None:
+        metrics.update(run.governor.stats())
+    if _rcon is not None:
+        metrics['rcon_queue_latency'] = _rcon.dispatcher.latency_snapshot()
+    logger.info('Backup %s finished in %.1f s', run.id, metrics['total_seconds'])
+    try:
+        if BACKUP_MODE == 'incremental' and BACKUP_SYNTHETIC_FULL and not metrics.get('failed'):
+            synthesize_full(metrics)
+        cleanup_old_backups()
+        if BACKUP_CATALOG:
+            update_catalog(metrics)
+        metrics['peak_rss_mb'] = round(memlimit.peak_rss() / 2**20, 1)
+        logger.info('Peak memory of backup %s: %.0f MiB', run.id, metrics['peak_rss_mb'])
+        record_metrics(metrics)
+    finally:
+        _save_control_file.release()
+        _backup_lock.release()
+
+
+def archive_snapshot(run):
+    archive_started = time.monotonic()
+    try:
+        archive(SNAPSHOT_DIR, run)
+    except Exception:
+        logger.exception('Backup %s failed', run.id)
+        run.metrics['failed'] = True
+    finally:
+        run.metrics['archive_seconds'] = round(time.monotonic() - archive_started, 3)
+        shutil.rmtree(SNAPSHOT_DIR, ignore_errors=True)
+        complete(run)
+
+
+def backup():
+    if not _backup_lock.acquire(blocking=False):
+        logger.warning('Previous backup is still running, skipping this run')
+        return
+    try:
+        if BACKUP_THROTTLE:
+            check_admission()
+        if not _save_control_file.acquire():
+            raise scheduler.RetryLater(60, 'a restore is running')
+    except BaseException:
+        _backup_lock.release()
+        raise
+    run = BackupRun()
+    logger.info('Starting %s backup %s', BACKUP_MODE, run.id)
+    if BACKUP_THROTTLE or BACKUP_PSI:
+        run.governor = throttle.IoGovernor(BACKUP_READ_RATE_MIN_MB * 2**20, BACKUP_READ_RATE_MAX_MB * 2**20,
+                                           BACKUP_MSPT_LOW, BACKUP_MSPT_HIGH)
+    if BACKUP_THROTTLE:
+        run.sampler = throttle.TpsSampler(monitor_command, TPS_SAMPLE_SECONDS, run.governor).start()
+    if BACKUP_PSI:
+        run.pressure = pressure.PressureMonitor(PSI_THRESHOLDS, PSI_SAMPLE_SECONDS, run.governor).start()
+    try:
+        capture(run)
+    except Exception:
+        logger.exception('Backup %s failed', run.id)
+        run.metrics['failed'] = True
+        complete(run)
+        return
+    if BACKUP_SNAPSHOT:
+        # Saving is already back on; compress from the clone in the background.
+        threading.Thread(target=archive_snapshot, args=(run,), name=f'backup-{run.id}').start()
+    else:
+        complete(run)
+
+
+def index_archives():
+    if _backup_lock.locked():
+        raise scheduler.RetryLater(300, 'a backup is running')
+    built = tarindex.index_archives(BACKUP_DIR, TAR_INDEX_SPAN, busy=_backup_lock.locked)
+    if built:
+        logger.info('Indexed %d archives', built)
+
+
+@contextmanager
+def restore_exclusive():
+    """Hold the save-control lock for a restore command; refuse while the service runs a backup."""
+    lock = restore.SaveControlLock(BACKUP_DIR)
+    if not lock.acquire():
+        raise restore.RestoreError('a backup is running, restore again when it has finished')
+    try:
+        yield
+    finally:
+        lock.release()
+
+
+def restore_chunks(args):
+    region_dir = restore.dimension_dir(args.dimension, args.world)
+    started = time.monotonic()
+    with restore_exclusive():
+        snap = restore.open_snapshot(BACKUP_DIR, args.snapshot)
+        try:
+            if args.offline:
+                restored = restore.restore_chunks(snap, MC_DATA_DIR, region_dir, *args.start, *args.end,
+                                                  offline=True)
+            else:
+                rcon_command('save-off')
+                try:
+                    flush_world()
+                    restored = restore.restore_chunks(snap, MC_DATA_DIR, region_dir, *args.start, *args.end)
+                finally:
+                    rcon_command('save-on')
+        finally:
+            snap.close()
+        restore.record_restored(BACKUP_DIR, restored)
+    logger.info('Restored %d chunks from backup %s in %.1f s', sum(len(v) for v in restored.values()),
+                snap.id, time.monotonic() - started)
+
+
+def restore_player(args):
+    uuid = restore.normalize_uuid(args.uuid)
+    with restore_exclusive():
+        if not args.offline:
+            name = restore.player_name(MC_DATA_DIR, uuid)
+            online = rcon_command('list')
+            if name is None:
+                logger.warning('Player %s is not in usercache.json, cannot check whether they are online', uuid)
+            elif name in online.split(':', 1)[-1].replace(',', ' ').split():
+                if not args.kick:
+                    raise restore.RestoreError(f'{name} is online, pass --kick to disconnect them first')
+                rcon_command(f'kick {name} Restoring player data from a backup')
+        started = time.monotonic()
+        snap = restore.open_snapshot(BACKUP_DIR, args.snapshot)
+        try:
+            paths = restore.restore_player(snap, MC_DATA_DIR, uuid, args.world, args.with_stats)
+        finally:
+            snap.close()
+    logger.info('Restored %d files of %s from backup %s in %.1f s', len(paths), uuid, snap.id,
+                time.monotonic() - started)
+
+
+def list_changes(args):
+    # The service syncs the catalog after every run.
+    with catalog.Catalog(CATALOG_PATH) as backups:
+        source = {'incremental': 'chain'}.get(BACKUP_MODE, BACKUP_MODE)
+        found = backups.changes(source, args.since, args.until)
+    for rel in found['files']:
+        print(f'M {rel}')
+    for rel in found['removed']:
+        print(f'D {rel}')
+    for region, positions in found['chunks'].items():
+        print(f'C {region}: {len(positions)} chunks')
+
+
+def list_snapshots(args):
+    for snapshot_id, kind in restore.list_snapshots(BACKUP_DIR):
+        print(f'{snapshot_id}  {kind}')
+    points = journal.recovery_points(JOURNAL_DIR) if JOURNAL_DIR.exists() else []
+    if points:
+        print(f'journal@{journal.format_time(points[0])} .. journal@{journal.format_time(points[-1])}  '
+              f'({len(points)} recovery points)')
+
+
+def journal_poll():
+    if JOURNAL_SAVE_ALL:
+        with _save_control:
+            if not _saving_paused.is_set():
+                rcon_command('save-all', NORMAL)
+    stats = _journal.poll()
+    if stats['recorded']:
+        logger.info('Journal: %d chunks, %d files, %d deletions, %.1f MiB',
+                    stats['chunks'], stats['files'], stats['deleted_chunks'] + stats['removed'],
+                    stats['bytes'] / 2**20)
+
+
+def journal_compact():
+    journal.compact(JOURNAL_DIR, JOURNAL_RETENTION_HOURS * 3600)
+
+
+def run_service():
+    global _journal, _dirty
+    logger.info('Backup service started: mode=%s, schedule=%s, data=%s, backups=%s',
+                BACKUP_MODE, BACKUP_CRON or f'every {BACKUP_INTERVAL_MINUTES} min',
+                MC_DATA_DIR, BACKUP_DIR)
+    BACKUP_DIR.mkdir(parents=True, exist_ok=True)
+    jobs = scheduler.Scheduler(BACKUP_DIR / 'scheduler.json', SCHEDULER_WORKERS, SCHEDULER_LONG_WORKERS)
+    if BACKUP_CRON:
+        jobs.add_job('backup', backup, cron=BACKUP_CRON, jitter=BACKUP_JITTER_SECONDS, long=True)
+    else:
+        jobs.add_job('backup', backup, interval=BACKUP_INTERVAL_MINUTES * 60,
+                     jitter=BACKUP_JITTER_SECONDS, long=True)
+    if TAR_INDEX:
+        jobs.add_job('index-archives', index_archives, interval=TAR_INDEX_INTERVAL_MINUTES * 60, long=True)
+    if BACKUP_DIRTY_SET and BACKUP_MODE in ('incremental', 'store') and not BACKUP_SNAPSHOT:
+        _dirty = dirtyset.DirtyTracker(MC_DATA_DIR, BACKUP_EXCLUDE)
+        if not _dirty.start():
+            _dirty = None
+    if JOURNAL:
+        _journal = journal.Journal(JOURNAL_DIR, MC_DATA_DIR, JOURNAL_PATHS, BACKUP_EXCLUDE)
+        jobs.add_job('journal', journal_poll, interval=JOURNAL_INTERVAL_SECONDS)
+        jobs.add_job('journal-compact', journal_compact, interval=JOURNAL_COMPACT_HOURS * 3600, long=True)
+    jobs.run_forever()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Minecraft backup service and partial restores.')
+    commands = parser.add_subparsers(dest='command')
+    commands.add_parser('run', help='run the backup service (default)')
+    commands.add_parser('snapshots', help='list the backups restores can use')
+    changes = commands.add_parser('changes', help='files and chunks changed after a backup (from the catalog)')
+    changes.add_argument('since', help='backup id')
+    changes.add_argument('--until', help='backup id (the newest by default)')
+    chunks = commands.add_parser('restore-chunks', help='restore a range of chunks')
+    chunks.add_argument('snapshot', help="backup id or 'latest'")
+    chunks.add_argument('--dimension', default='overworld',
+                        help="overworld, the_nether, the_end or a modded id like 'namespace:path'")
+    chunks.add_argument('--from', dest='start', type=int, nargs=2, metavar=('X', 'Z'), required=True,
+                        help='chunk coordinates (block coordinates >> 4)')
+    chunks.add_argument('--to', dest='end', type=int, nargs=2, metavar=('X', 'Z'), required=True)
+    chunks.add_argument('--offline', action='store_true',
+                        help='the server is stopped: rewrite whole regions, no RCON')
+    player = commands.add_parser('restore-player', help="restore one player's data")
+    player.add_argument('snapshot', help="backup id or 'latest'")
+    player.add_argument('uuid')
+    player.add_argument('--with-stats', action='store_true', help='also restore stats and advancements')
+    player.add_argument('--kick', action='store_true', help='kick the player if they are online')
+    player.add_argument('--offline', action='store_true', help='the server is stopped, no RCON')
+    for sub in (chunks, player):
+        sub.add_argument('--world', default='world', help='world directory under MC_DATA_DIR')
+    args = parser.parse_args(argv)
+
+    if args.command in (None, 'run'):
+        run_service()
+        return
+    handler = {'snapshots': list_snapshots, 'changes': list_changes, 'restore-chunks': restore_chunks,
+               'restore-player': restore_player}[args.command]
+    try:
+        handler(args)
+    except restore.RestoreError as e:
+        logger.error('%s', e)
+        sys.exit(1)
+    finally:
+        close_rcon()
+
+
+if __name__ == '__main__':
+    main()
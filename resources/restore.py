@@ -0,0 +1,487 @@
+"""
+Partial restores: a range of chunks or one player's data from any backup.
+
+Every kind of backup is opened as a snapshot with the same two reads,
+read_file(rel) and read_chunks(region rel, chunk indices):
+
+- store snapshots read the region table and the chunk objects directly;
+- incremental chains walk back from the requested backup to its full
+  archive and take every chunk or file from the newest archive holding it;
+- full archives use the seekable index (.mcsa) or the tarindex sidecar
+  (.tar.gz, built on first use), so only the needed members are inflated;
+- the chunk journal (journal.py) is replayed up to the requested time.
+
+Chunks are written into the live region files. With the server running
+(saving switched off by the caller), a chunk is only written into the
+sectors it already occupies: the server keeps region headers in memory, so
+moving a chunk or adding or removing one would be undone or corrupted by
+its next write. Chunks that do not fit need a restore with the server
+stopped (offline=True), which rewrites the whole region.
+
+Chunks the players are standing in are held in memory by the server and
+will be saved over the restored data; restore areas nobody is near.
+
+Because the server may write the old timestamps back into the header, the
+restored chunks are remembered in BACKUP_DIR/restored.json and the next
+incremental or store backup stores them regardless of their timestamps.
+
+Restores run as separate commands next to the backup service. Both take the
+flock on BACKUP_DIR/save-control.lock (SaveControlLock) for as long as they
+may switch saving off, so a restore never runs during a backup and neither
+switches saving back on while the other still needs it off.
+"""
+
+import base64
+import fcntl
+import io
+import json
+import logging
+import os
+import shutil
+import struct
+from pathlib import Path
+
+import anvil
+import delta
+import incremental
+import journal
+import objstore
+import regionpack
+import seekable
+import tarindex
+
+logger = logging.getLogger(__name__)
+
+PENDING_FILE = 'restored.json'
+LOCK_FILE = 'save-control.lock'
+_KNOWN_DIMENSIONS = {
+    'minecraft:overworld': 'region',
+    'minecraft:the_nether': 'DIM-1/region',
+    'minecraft:the_end': 'DIM1/region',
+}
+
+
+class RestoreError(Exception):
+    pass
+
+
+def dimension_dir(dimension, world='world'):
+    """Region directory of a dimension such as 'overworld' or 'twilightforest:twilight_forest'."""
+    name = dimension if ':' in dimension else 'minecraft:' + dimension
+    if name in _KNOWN_DIMENSIONS:
+        return f'{world}/{_KNOWN_DIMENSIONS[name]}'
+    namespace, path = name.split(':', 1)
+    return f'{world}/dimensions/{namespace}/{path}/region'
+
+
+def chunks_by_region(x1, z1, x2, z2):
+    """{(region x, region z): [chunk indices]} for an inclusive chunk range."""
+    regions = {}
+    for x in range(min(x1, x2), max(x1, x2) + 1):
+        for z in range(min(z1, z2), max(z1, z2) + 1):
+            regions.setdefault((x >> 5, z >> 5), []).append(anvil.chunk_index(x, z))
+    return regions
+
+
+def normalize_uuid(text):
+    digits = text.replace('-', '').lower()
+    if len(digits) != 32 or any(c not in '0123456789abcdef' for c in digits):
+        raise RestoreError(f'not a UUID: {text}')
+    return f'{digits[:8]}-{digits[8:12]}-{digits[12:16]}-{digits[16:20]}-{digits[20:]}'
+
+
+def _chunks_from_region(data, indices):
+    f = io.BytesIO(data)
+    locations, timestamps = anvil.read_header(f)
+    return {i: (timestamps[i], anvil.read_chunk(f, locations[i])) for i in indices if locations[i][0]}
+
+
+# Snapshot sources
+
+class StoreSnapshot:
+    def __init__(self, store_dir, snapshot_id):
+        self.id = snapshot_id
+        self.store = objstore.ObjectStore(store_dir)
+        try:
+            self.manifest = self.store.load_snapshot(snapshot_id)
+        except Exception:
+            self.store.close()
+            raise
+
+    def read_file(self, rel):
+        entry = self.manifest['files'].get(rel)
+        if entry is None:
+            return None
+        return b''.join(self.store.get(digest) for digest in entry[2])
+
+    def read_chunks(self, rel, indices):
+        entry = self.manifest['regions'].get(rel)
+        if entry is None:
+            return {}
+        timestamps, hashes = self.store.read_table(entry[2])
+        return {i: (timestamps[i], self.store.get(hashes[i])) for i in indices if i in hashes}
+
+    def close(self):
+        self.store.close()
+
+
+class ArchiveSnapshot:
+    """A full archive (.tar.gz or .mcsa), or one archive of a chain."""
+
+    def __init__(self, path, snapshot_id=None):
+        self.id = snapshot_id
+        self.path = Path(path)
+        if self.path.name.endswith(seekable.SUFFIX):
+            self.archive = seekable.SeekableArchive(self.path)
+            self.names = set(self.archive.members)
+        else:
+            self.archive = None
+            self.index = tarindex.load_index(self.path) or tarindex.build_index(self.path)
+            self.names = {m['name'] for m in self.index['members']}
+
+    def read_member(self, name):
+        if name not in self.names:
+            return None
+        if self.archive is not None:
+            return self.archive.read(name)
+        return b''.join(tarindex.iter_member(self.path, self.index, name))
+
+    def read_file(self, rel):
+        return self.read_member(rel)
+
+    def read_region(self, rel):
+        data = self.read_member(rel)
+        if data is None:
+            packed = self.read_member(rel + regionpack.PACKED_SUFFIX)
+            if packed is None:
+                return None
+            region = io.BytesIO()
+            regionpack.unpack_region(io.BytesIO(packed), region)
+            data = region.getvalue()
+        return data
+
+    def read_chunks(self, rel, indices):
+        data = self.read_region(rel)
+        return _chunks_from_region(data, indices) if data is not None else {}
+
+    def close(self):
+        if self.archive is not None:
+            self.archive.close()
+
+
+class ChainSnapshot:
+    """One backup of an incremental chain."""
+
+    def __init__(self, archive_dir, snapshot_id):
+        self.id = snapshot_id
+        self.archive_dir = Path(archive_dir)
+        manifests = incremental.list_manifests(archive_dir)
+        # A synthetic full backup has the same state as the incremental it
+        # was merged up to and is preferred, being a single archive.
+        matches = [path for path in manifests if incremental.parse_manifest_name(path.name)[0] == snapshot_id]
+        if not matches:
+            raise RestoreError(f'backup {snapshot_id} is not in {archive_dir}')
+        chain = []
+        for path in manifests[:manifests.index(matches[-1]) + 1]:
+            if incremental.parse_manifest_name(path.name)[1] in incremental.FULL_KINDS:
+                chain = []
+            chain.append(path)
+        # Newest first: the requested backup, then back to its full archive.
+        self.manifests = [incremental.load_manifest(path) for path in reversed(chain)]
+        self._archives = {}
+
+    def _archive(self, manifest):
+        name = manifest['archive']
+        if name not in self._archives:
+            self._archives[name] = ArchiveSnapshot(self.archive_dir / name)
+        return self._archives[name]
+
+    def read_file(self, rel):
+        if rel not in self.manifests[0]['files']:
+            return None
+        for manifest in self.manifests:
+            if manifest['kind'] in incremental.FULL_KINDS or rel in manifest['changes']['files']:
+                break
+        else:
+            return None
+        if manifest['kind'] in incremental.FULL_KINDS or rel not in manifest['changes'].get('deltas', ()):
+            return self._archive(manifest).read_file(rel)
+        # Deltas are against the chain's full archive.
+        patch = self._archive(manifest).read_member(f'{incremental.DELTA_DIR}/{rel}')
+        base = self._archive(self.manifests[-1]).read_file(rel)
+        if patch is None or base is None:
+            return None
+        out = io.BytesIO()
+        try:
+            delta.apply_delta(io.BytesIO(base), io.BytesIO(patch), out)
+        except delta.DeltaError as e:
+            raise RestoreError(f'{rel} in backup {manifest["id"]}: {e}') from e
+        return out.getvalue()
+
+    def read_chunks(self, rel, indices):
+        entry = self.manifests[0]['regions'].get(rel)
+        if entry is None:
+            return {}
+        table = anvil.unpack_table(base64.b64decode(entry[2]))
+        wanted = {i for i in indices if table[i]}
+        found = {}
+        for manifest in self.manifests:
+            if not wanted:
+                break
+            if manifest['kind'] in incremental.FULL_KINDS:
+                for i, (_, payload) in self._archive(manifest).read_chunks(rel, wanted).items():
+                    found[i] = (table[i], payload)
+                break
+            for i in wanted & set(manifest['changes']['chunks'].get(rel, ())):
+                payload = self._archive(manifest).read_member(f'{incremental.CHUNK_DIR}/{rel}/{i}')
+                if payload is not None:
+                    found[i] = (table[i], payload)
+            wanted -= set(found)
+        return found
+
+    def close(self):
+        for archive in self._archives.values():
+            archive.close()
+
+
+def list_snapshots(backup_dir):
+    """[(snapshot id, kind)] of all backups under backup_dir, oldest first."""
+    backup_dir = Path(backup_dir)
+    found = []
+    store_dir = backup_dir / 'store'
+    if (store_dir / 'refs.db').exists():
+        store = objstore.ObjectStore(store_dir)
+        try:
+            found += [(snapshot_id, 'store') for snapshot_id in store.snapshot_ids()]
+        finally:
+            store.close()
+    chain_ids = {incremental.parse_manifest_name(path.name)[0]
+                 for path in incremental.list_manifests(backup_dir / 'chain')}
+    found += [(backup_id, 'chain') for backup_id in chain_ids]
+    for path in sorted((backup_dir / 'full').glob('world-*')):
+        for suffix in ('.tar.gz', seekable.SUFFIX):
+            if path.name.endswith(suffix):
+                found.append((path.name[len('world-'):-len(suffix)], 'full'))
+    return sorted(found)
+
+
+def open_snapshot(backup_dir, snapshot_id='latest'):
+    """
+    Open a backup by id ('latest' for the newest one) from whichever mode
+    made it; 'journal@<time>' opens the chunk journal as of a local ISO time
+    and plain 'journal' its newest recovery point.
+    """
+    backup_dir = Path(backup_dir)
+    if snapshot_id == 'journal' or snapshot_id.startswith('journal@'):
+        at = snapshot_id.partition('@')[2]
+        try:
+            return journal.open_state(backup_dir / 'journal', journal.parse_time(at) if at else None)
+        except journal.JournalError as e:
+            raise RestoreError(str(e)) from None
+    snapshots = list_snapshots(backup_dir)
+    if not snapshots:
+        raise RestoreError(f'no backups in {backup_dir}')
+    if snapshot_id == 'latest':
+        snapshot_id = snapshots[-1][0]
+    kinds = [kind for sid, kind in snapshots if sid == snapshot_id]
+    if not kinds:
+        raise RestoreError(f'backup {snapshot_id} not found')
+    if 'store' in kinds:
+        return StoreSnapshot(backup_dir / 'store', snapshot_id)
+    if 'chain' in kinds:
+        return ChainSnapshot(backup_dir / 'chain', snapshot_id)
+    for suffix in (seekable.SUFFIX, '.tar.gz'):
+        path = backup_dir / 'full' / f'world-{snapshot_id}{suffix}'
+        if path.exists():
+            return ArchiveSnapshot(path, snapshot_id)
+    raise RestoreError(f'backup {snapshot_id} not found')
+
+
+class SaveControlLock:
+    """Non-blocking flock on BACKUP_DIR/save-control.lock, shared by the service and the restore commands."""
+
+    def __init__(self, backup_dir):
+        self.path = Path(backup_dir) / LOCK_FILE
+        self._file = None
+
+    def acquire(self):
+        """Take the lock and return True, or return False if another process holds it."""
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        f = open(self.path, 'a')
+        try:
+            fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            f.close()
+            return False
+        self._file = f
+        return True
+
+    def release(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+
+# Chunk restore
+
+def _write_in_place(path, chunks):
+    """Overwrite chunks inside their current sectors; they were checked to fit."""
+    with open(path, 'r+b') as f:
+        locations, _ = anvil.read_header(f)
+        for index, (timestamp, payload) in chunks.items():
+            f.seek(locations[index][0] * anvil.SECTOR_SIZE)
+            f.write(struct.pack('>I', len(payload)) + payload)
+            f.seek(anvil.SECTOR_SIZE + 4 * index)
+            f.write(struct.pack('>I', timestamp))
+
+
+def _rewrite_region(path, chunks, removed):
+    payloads, timestamps = {}, [0] * anvil.CHUNKS_PER_REGION
+    if path.exists():
+        with open(path, 'rb') as f:
+            locations, current = anvil.read_header(f)
+            for index, location in enumerate(locations):
+                payload = anvil.read_chunk(f, location)
+                if payload is not None and index not in removed:
+                    payloads[index] = payload
+                    timestamps[index] = current[index]
+    for index, (timestamp, payload) in chunks.items():
+        payloads[index] = payload
+        timestamps[index] = timestamp
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp = path.with_name(path.name + '.partial')
+    with open(tmp, 'wb') as f:
+        anvil.write_region(f, timestamps, payloads)
+    os.replace(tmp, path)
+
+
+def restore_chunks(snapshot, data_dir, region_dir, x1, z1, x2, z2, offline=False):
+    """
+    Copy the chunks in the inclusive range from snapshot into the region
+    files under data_dir and return {region rel: [restored chunk indices]}.
+
+    Chunks that are missing from the snapshot (not generated yet at the
+    time) are deleted in offline mode and left alone otherwise.
+    """
+    data_dir = Path(data_dir)
+    plan = []
+    problems = []
+    for (rx, rz), indices in sorted(chunks_by_region(x1, z1, x2, z2).items()):
+        rel = f'{region_dir}/r.{rx}.{rz}.mca'
+        chunks = snapshot.read_chunks(rel, indices)
+        missing = [i for i in indices if i not in chunks]
+        path = data_dir / rel
+        if not offline:
+            if missing:
+                logger.warning('%s: %d chunks are not in backup %s and stay as they are',
+                               rel, len(missing), snapshot.id)
+            if chunks and not path.exists():
+                problems.append(f'{rel} does not exist')
+                continue
+            if chunks:
+                with open(path, 'rb') as f:
+                    locations, _ = anvil.read_header(f)
+                for index, (_, payload) in chunks.items():
+                    sector, count = locations[index]
+                    if not sector or len(payload) + 4 > count * anvil.SECTOR_SIZE:
+                        x, z = anvil.chunk_coords(index, rx, rz)
+                        problems.append(f'chunk {x},{z} does not fit into its sectors in {rel}')
+        plan.append((rel, path, chunks, missing))
+    if problems:
+        raise RestoreError('cannot restore with the server running, stop it and restore offline: '
+                           + '; '.join(problems))
+
+    restored = {}
+    for rel, path, chunks, missing in plan:
+        if offline:
+            if chunks or (missing and path.exists()):
+                _rewrite_region(path, chunks, set(missing))
+        elif chunks:
+            _write_in_place(path, chunks)
+        if chunks:
+            restored[rel] = sorted(chunks)
+        logger.info('%s: restored %d chunks from backup %s', rel, len(chunks), snapshot.id)
+    return restored
+
+
+# Player restore
+
+def player_files(uuid, world='world', with_stats=False):
+    files = [f'{world}/playerdata/{uuid}.dat']
+    if with_stats:
+        files += [f'{world}/stats/{uuid}.json', f'{world}/advancements/{uuid}.json']
+    return files
+
+
+def player_name(data_dir, uuid):
+    """The player's last known name from usercache.json, or None."""
+    try:
+        with open(Path(data_dir) / 'usercache.json', encoding='utf-8') as f:
+            entries = json.load(f)
+    except (OSError, ValueError):
+        return None
+    return next((e.get('name') for e in entries if e.get('uuid') == uuid), None)
+
+
+def restore_player(snapshot, data_dir, uuid, world='world', with_stats=False):
+    """
+    Replace the player's data files with the ones from snapshot and return
+    their paths. The current files are kept next to them as *.pre-restore.
+    The player must be offline, or the server will save over the result.
+    """
+    data_dir = Path(data_dir)
+    contents = {}
+    for rel in player_files(uuid, world, with_stats):
+        data = snapshot.read_file(rel)
+        if data is None and rel.endswith('.dat'):
+            raise RestoreError(f'{rel} is not in backup {snapshot.id}')
+        if data is not None:
+            contents[rel] = data
+    paths = []
+    for rel, data in contents.items():
+        path = data_dir / rel
+        path.parent.mkdir(parents=True, exist_ok=True)
+        if path.exists():
+            shutil.copy2(path, path.with_name(path.name + '.pre-restore'))
+        tmp = path.with_name(path.name + '.partial')
+        tmp.write_bytes(data)
+        os.replace(tmp, path)
+        paths.append(path)
+        logger.info('Restored %s from backup %s', rel, snapshot.id)
+    return paths
+
+
+# Chunks restored since the last backup
+
+def record_restored(backup_dir, restored):
+    """Remember restored chunks so the next backup stores them whatever their timestamps say."""
+    pending = pending_chunks(backup_dir)
+    for rel, indices in restored.items():
+        pending[rel] = sorted(set(pending.get(rel, [])) | set(indices))
+    path = Path(backup_dir) / PENDING_FILE
+    tmp = path.with_name(path.name + '.partial')
+    tmp.write_text(json.dumps(pending), encoding='utf-8')
+    os.replace(tmp, path)
+
+
+def pending_chunks(backup_dir):
+    try:
+        return json.loads((Path(backup_dir) / PENDING_FILE).read_text(encoding='utf-8'))
+    except (OSError, ValueError):
+        return {}
+
+
+def clear_pending(backup_dir, handled):
+    """Forget the chunks in handled after a backup stored them."""
+    pending = pending_chunks(backup_dir)
+    for rel, indices in handled.items():
+        left = sorted(set(pending.get(rel, [])) - set(indices))
+        if left:
+            pending[rel] = left
+        else:
+            pending.pop(rel, None)
+    path = Path(backup_dir) / PENDING_FILE
+    if pending:
+        path.write_text(json.dumps(pending), encoding='utf-8')
+    else:
+        path.unlink(missing_ok=True)
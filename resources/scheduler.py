@@ -0,0 +1,245 @@
+"""
+Heap-based job scheduler.
+
+Jobs are kept in a heap ordered by their next deadline and the scheduler
+thread sleeps exactly until the earliest one (or until a job is added). Due
+jobs run on bounded thread pools: jobs added with long=True (backups,
+indexing, compaction) get a pool of their own, so however long they take,
+short periodic jobs such as journal polls keep their workers. A job that is
+still running when it comes due again is skipped rather than started twice.
+
+Jobs run either every N seconds or on a cron expression, optionally with a
+random jitter. The time of the last successful run of each job is persisted
+to a JSON file; after a restart a job whose next run was missed while the
+container was down runs immediately (once, however many runs were missed).
+"""
+
+import heapq
+import itertools
+import json
+import logging
+import os
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+from pathlib import Path
+
+logger = logging.getLogger(__name__)
+
+# Upper bound for one sleep, so wall-clock jumps are noticed reasonably soon.
+MAX_SLEEP_SECONDS = 60
+
+
+class CronError(ValueError):
+    pass
+
+
+class RetryLater(Exception):
+    """Raised by a job that cannot run now and wants another try after delay seconds."""
+
+    def __init__(self, delay, reason=''):
+        super().__init__(reason)
+        self.delay = delay
+
+
+def _parse_field(text, low, high):
+    values = set()
+    for part in text.split(','):
+        step = 1
+        if '/' in part:
+            part, step_text = part.split('/', 1)
+            step = int(step_text)
+            if step < 1:
+                raise CronError(f'bad step in {text!r}')
+        if part == '*':
+            start, end = low, high
+        elif '-' in part:
+            start, end = (int(v) for v in part.split('-', 1))
+        else:
+            start = int(part)
+            end = high if step > 1 else start
+        if not low <= start <= end <= high:
+            raise CronError(f'{text!r} is out of range {low}-{high}')
+        values.update(range(start, end + 1, step))
+    return values
+
+
+class CronExpression:
+    """Standard five-field cron expression: minute hour day-of-month month day-of-week."""
+
+    def __init__(self, expression):
+        fields = expression.split()
+        if len(fields) != 5:
+            raise CronError(f'cron expression needs 5 fields: {expression!r}')
+        self.expression = expression
+        self.minutes = _parse_field(fields[0], 0, 59)
+        self.hours = _parse_field(fields[1], 0, 23)
+        self.days = _parse_field(fields[2], 1, 31)
+        self.months = _parse_field(fields[3], 1, 12)
+        # 0 and 7 are both Sunday; datetime.weekday() has Monday as 0.
+        self.weekdays = {(d - 1) % 7 for d in _parse_field(fields[4], 0, 7)}
+        self._any_day = fields[2] == '*'
+        self._any_weekday = fields[4] == '*'
+
+    def _day_matches(self, dt):
+        day_ok = dt.day in self.days
+        weekday_ok = dt.weekday() in self.weekdays
+        if self._any_day or self._any_weekday:
+            return day_ok and weekday_ok
+        # Like cron: when both are restricted, either one matching is enough.
+        return day_ok or weekday_ok
+
+    def next_after(self, dt):
+        """First matching minute strictly after dt (naive local time)."""
+        dt = dt.replace(second=0, microsecond=0) + timedelta(minutes=1)
+        limit = dt + timedelta(days=366 * 5)
+        while dt < limit:
+            if dt.month not in self.months:
+                dt = (dt.replace(day=1, hour=0, minute=0) + timedelta(days=32)).replace(day=1)
+            elif not self._day_matches(dt):
+                dt = dt.replace(hour=0, minute=0) + timedelta(days=1)
+            elif dt.hour not in self.hours:
+                dt = dt.replace(minute=0) + timedelta(hours=1)
+            elif dt.minute not in self.minutes:
+                dt += timedelta(minutes=1)
+            else:
+                return dt
+        raise CronError(f'{self.expression!r} never matches')
+
+
+class Job:
+    def __init__(self, name, func, interval=None, cron=None, jitter=0, long=False):
+        self.name = name
+        self.func = func
+        self.interval = interval
+        self.cron = CronExpression(cron) if cron else None
+        self.jitter = jitter
+        self.long = long
+        self.last_run = None
+        self.running = False
+
+    def next_after(self, timestamp):
+        """Next scheduled time (epoch seconds, without jitter) after timestamp."""
+        if self.cron:
+            return self.cron.next_after(datetime.fromtimestamp(timestamp)).timestamp()
+        return timestamp + self.interval
+
+    def __repr__(self):
+        return f'Job({self.name!r}, {self.cron.expression if self.cron else f"every {self.interval} s"})'
+
+
+class Scheduler:
+    def __init__(self, state_path=None, max_workers=2, long_workers=1):
+        """max_workers threads run the short jobs, long_workers threads the long ones."""
+        self.state_path = Path(state_path) if state_path else None
+        self._executor = ThreadPoolExecutor(max_workers, thread_name_prefix='job')
+        self._long_executor = ThreadPoolExecutor(long_workers, thread_name_prefix='long-job')
+        self._cond = threading.Condition()
+        self._heap = []
+        self._seq = itertools.count()
+        self._stopped = False
+        self._state = self._load_state()
+
+    def _load_state(self):
+        if not self.state_path or not self.state_path.exists():
+            return {}
+        try:
+            with open(self.state_path, encoding='utf-8') as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            logger.exception('Could not read scheduler state %s', self.state_path)
+            return {}
+
+    def _save_state(self):
+        if not self.state_path:
+            return
+        tmp = self.state_path.with_name(self.state_path.name + '.partial')
+        with open(tmp, 'w', encoding='utf-8') as f:
+            json.dump(self._state, f, indent=2)
+        os.replace(tmp, self.state_path)
+
+    def _push(self, job, due, retry=False):
+        run_at = due if retry else due + random.uniform(0, job.jitter)
+        heapq.heappush(self._heap, (run_at, next(self._seq), due, retry, job))
+        self._cond.notify()
+
+    def add_job(self, name, func, interval=None, cron=None, jitter=0, long=False):
+        """
+        Schedule func every interval seconds or on a cron expression; long
+        jobs run on the separate pool.
+        """
+        if (interval is None) == (cron is None):
+            raise ValueError('exactly one of interval and cron is required')
+        job = Job(name, func, interval, cron, jitter, long)
+        now = time.time()
+        job.last_run = self._state.get(name)
+        if job.last_run is not None and job.next_after(job.last_run) <= now:
+            logger.info('%r missed its run at %s, catching up', job,
+                        datetime.fromtimestamp(job.next_after(job.last_run)).isoformat(timespec='seconds'))
+            due = now
+        else:
+            due = job.next_after(job.last_run if job.last_run is not None else now)
+        with self._cond:
+            self._push(job, due)
+        return job
+
+    def _run_job(self, job):
+        started = time.time()
+        try:
+            job.func()
+        except RetryLater as e:
+            logger.info('Job %s deferred by %d s: %s', job.name, e.delay, e)
+            with self._cond:
+                self._push(job, time.time() + e.delay, retry=True)
+        except Exception:
+            logger.exception('Job %s failed', job.name)
+        else:
+            with self._cond:
+                job.last_run = started
+                self._state[job.name] = started
+                self._save_state()
+            logger.info('Job %s finished in %.1f s', job.name, time.time() - started)
+        finally:
+            with self._cond:
+                job.running = False
+
+    def _next_due(self, job, scheduled, now):
+        due = job.next_after(scheduled)
+        while due <= now:
+            due = job.next_after(due)
+        return due
+
+    def run_forever(self):
+        with self._cond:
+            while not self._stopped:
+                if not self._heap:
+                    self._cond.wait(MAX_SLEEP_SECONDS)
+                    continue
+                run_at, _, scheduled, retry, job = self._heap[0]
+                now = time.time()
+                if run_at > now:
+                    self._cond.wait(min(run_at - now, MAX_SLEEP_SECONDS))
+                    continue
+                heapq.heappop(self._heap)
+                if job.running:
+                    logger.warning('Job %s is still running, skipping this run', job.name)
+                else:
+                    job.running = True
+                    executor = self._long_executor if job.long else self._executor
+                    executor.submit(self._run_job, job)
+                if not retry:
+                    self._push(job, self._next_due(job, scheduled, now))
+
+    def start(self):
+        thread = threading.Thread(target=self.run_forever, name='scheduler', daemon=True)
+        thread.start()
+        return thread
+
+    def stop(self, wait=True):
+        with self._cond:
+            self._stopped = True
+            self._cond.notify()
+        self._executor.shutdown(wait=wait)
+        self._long_executor.shutdown(wait=wait)
@@ -0,0 +1,303 @@
+"""
+Seekable backup archives (.mcsa).
+
+A .tar.gz is one compressed stream, so getting a single player file back
+means inflating everything in front of it. A seekable archive compresses
+every member in independent blocks and ends with an index, so listing takes
+one read of the index and extracting a member reads only its own blocks;
+several members can be extracted in parallel.
+
+Layout:
+
+    block, block, ...     members cut into BLOCK_SIZE pieces, each compressed
+                          on its own with the member's codec (see codec.py)
+    index                 zlib-compressed JSON: for every member its size,
+                          mtime, mode, SHA-256 and [offset, stored length,
+                          raw length, codec tag] per block
+    footer                magic, version, index offset, index length and the
+                          SHA-256 of the index
+
+Blocks are compressed on a thread pool and written in order, like
+pipeline.py does for .tar.gz. Members are read with readinto() into a fixed
+pool of reusable blocks (pipeline.BufferPool), so memory does not grow with
+the size of a member.
+"""
+
+import argparse
+import collections
+import hashlib
+import json
+import os
+import stat
+import struct
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+import codec
+import pipeline
+import regionpack
+from throttle import open_source
+
+MAGIC = b'MCSA'
+VERSION = 1
+SUFFIX = '.mcsa'
+BLOCK_SIZE = 4 * 2**20
+
+_FOOTER = struct.Struct('>4sBQQ32s')
+
+
+class ArchiveError(Exception):
+    pass
+
+
+def _compress_block(data, chosen, gate):
+    if chosen is codec.STORE:
+        return data, codec.TAG_STORE
+    if gate is None:
+        packed = chosen.compress(data)
+    else:
+        with gate():
+            packed = chosen.compress(data)
+    if len(packed) >= len(data):
+        return data, codec.TAG_STORE
+    return packed, chosen.tag
+
+
+class SeekableWriter:
+    """Write a seekable archive; the file appears under path on close()."""
+
+    def __init__(self, path, workers=None, gate=None, block_size=BLOCK_SIZE,
+                 default_codec=codec.CODECS['zlib-6']):
+        """gate, if given, returns a context manager every block is compressed in."""
+        self.path = Path(path)
+        self.tmp_path = self.path.with_name(self.path.name + '.partial')
+        self.workers = workers or os.cpu_count() or 1
+        self.gate = gate
+        self.block_size = block_size
+        self.default_codec = default_codec
+        self.members = []
+        self.bytes_in = 0
+        self._f = open(self.tmp_path, 'wb')
+        self._offset = 0
+        self._pending = collections.deque()
+        # One block per pending compression plus the one being read.
+        self._blocks = pipeline.BufferPool(block_size, 2 * self.workers + 1)
+        self._executor = ThreadPoolExecutor(self.workers, thread_name_prefix='mcsa')
+        self._closed = False
+
+    def _submit(self, blocks, block, size, chosen):
+        data = memoryview(block)[:size]
+        self._pending.append((blocks, self._executor.submit(_compress_block, data, chosen, self.gate),
+                              block, size))
+        while len(self._pending) > 2 * self.workers:
+            self._write_next()
+
+    def _write_next(self):
+        blocks, future, block, raw_length = self._pending.popleft()
+        packed, tag = future.result()
+        self._f.write(packed)
+        # A stored block is a view of the pooled block, so it goes back only now.
+        self._blocks.release(block)
+        blocks.append([self._offset, len(packed), raw_length, tag])
+        self._offset += len(packed)
+
+    def add_stream(self, rel, f, mtime_ns, mode=0o644, chosen=None):
+        """Add the contents of file object f as member rel; return its size.
+
+        A failure aborts the whole archive: the blocks already written
+        belong to no member.
+        """
+        chosen = chosen or self.default_codec
+        digest = hashlib.sha256()
+        blocks = []
+        size = 0
+        try:
+            while True:
+                block = self._blocks.acquire()
+                n = pipeline.read_into(f, memoryview(block))
+                if not n:
+                    self._blocks.release(block)
+                    break
+                digest.update(memoryview(block)[:n])
+                size += n
+                self._submit(blocks, block, n, chosen)
+                if n < len(block):
+                    break
+        except BaseException:
+            self.abort()
+            raise
+        self.members.append({
+            'name': rel,
+            'size': size,
+            'mtime_ns': mtime_ns,
+            'mode': mode,
+            'codec': chosen.name,
+            'sha256': digest.hexdigest(),
+            'blocks': blocks,
+        })
+        self.bytes_in += size
+        return size
+
+    def add_file(self, path, rel, selector=None):
+        """Add a file, compressed with the codec selector picks for it."""
+        with open_source(path) as f:
+            st = os.fstat(f.fileno())
+            chosen = selector.choose(rel, f, st.st_size) if selector is not None else None
+            return self.add_stream(rel, f, st.st_mtime_ns, stat.S_IMODE(st.st_mode), chosen)
+
+    def close(self):
+        if self._closed:
+            return
+        self._closed = True
+        try:
+            while self._pending:
+                self._write_next()
+            index = zlib.compress(json.dumps({'members': self.members},
+                                             separators=(',', ':')).encode('utf-8'), 6)
+            self._f.write(index)
+            self._f.write(_FOOTER.pack(MAGIC, VERSION, self._offset, len(index),
+                                       hashlib.sha256(index).digest()))
+            self._f.close()
+            os.replace(self.tmp_path, self.path)
+        except BaseException:
+            self._f.close()
+            self.tmp_path.unlink(missing_ok=True)
+            raise
+        finally:
+            self._executor.shutdown(cancel_futures=True)
+            if not self._f.closed:
+                self._f.close()
+
+    def abort(self):
+        self._closed = True
+        self._executor.shutdown(cancel_futures=True)
+        self._f.close()
+        self.tmp_path.unlink(missing_ok=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, *exc):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+
+class SeekableArchive:
+    """Random access to the members of a seekable archive."""
+
+    def __init__(self, path):
+        self.path = Path(path)
+        self._fd = os.open(self.path, os.O_RDONLY)
+        try:
+            self.members = self._read_index()
+        except Exception:
+            os.close(self._fd)
+            raise
+
+    def _read_index(self):
+        size = os.fstat(self._fd).st_size
+        if size < _FOOTER.size:
+            raise ArchiveError(f'{self.path.name} is too short to be a seekable archive')
+        magic, version, offset, length, digest = _FOOTER.unpack(
+            os.pread(self._fd, _FOOTER.size, size - _FOOTER.size))
+        if magic != MAGIC or version != VERSION:
+            raise ArchiveError(f'{self.path.name} is not a seekable archive')
+        index = os.pread(self._fd, length, offset)
+        if hashlib.sha256(index).digest() != digest:
+            raise ArchiveError(f'{self.path.name}: index is damaged')
+        members = json.loads(zlib.decompress(index))['members']
+        return {member['name']: member for member in members}
+
+    def close(self):
+        os.close(self._fd)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def names(self):
+        return list(self.members)
+
+    def iter_blocks(self, name):
+        """Yield the decompressed blocks of a member."""
+        try:
+            member = self.members[name]
+        except KeyError:
+            raise ArchiveError(f'{name} is not in {self.path.name}') from None
+        for offset, length, raw_length, tag in member['blocks']:
+            data = codec.decode(tag, os.pread(self._fd, length, offset))
+            if len(data) != raw_length:
+                raise ArchiveError(f'{name}: block at {offset} is damaged')
+            yield data
+
+    def read(self, name):
+        return b''.join(self.iter_blocks(name))
+
+    def extract(self, name, target_dir):
+        """Write member name under target_dir, verifying its hash; return the path."""
+        member = self.members.get(name)
+        if member is None:
+            raise ArchiveError(f'{name} is not in {self.path.name}')
+        target = Path(target_dir) / name
+        target.parent.mkdir(parents=True, exist_ok=True)
+        tmp = target.with_name(target.name + '.partial')
+        digest = hashlib.sha256()
+        with open(tmp, 'wb') as f:
+            for data in self.iter_blocks(name):
+                digest.update(data)
+                f.write(data)
+        if digest.hexdigest() != member['sha256']:
+            tmp.unlink()
+            raise ArchiveError(f'{name}: checksum mismatch')
+        os.chmod(tmp, member['mode'])
+        os.utime(tmp, ns=(member['mtime_ns'], member['mtime_ns']))
+        os.replace(tmp, target)
+        return target
+
+    def extract_many(self, names, target_dir, workers=None):
+        """Extract several members in parallel and return their paths."""
+        with ThreadPoolExecutor(workers or os.cpu_count() or 1, thread_name_prefix='extract') as pool:
+            return list(pool.map(lambda name: self.extract(name, target_dir), names))
+
+    def select(self, paths):
+        """Member names equal to or under any of the given paths; regions match packed ones too."""
+        names = []
+        for name in self.members:
+            for path in paths:
+                path = path.rstrip('/')
+                if name in (path, path + regionpack.PACKED_SUFFIX) or name.startswith(path + '/'):
+                    names.append(name)
+                    break
+        return names
+
+
+def main():
+    parser = argparse.ArgumentParser(description='List and extract seekable backup archives.')
+    parser.add_argument('archive', type=Path)
+    commands = parser.add_subparsers(dest='command', required=True)
+    commands.add_parser('list', help='list members')
+    extract = commands.add_parser('extract', help='extract members (all by default)')
+    extract.add_argument('target', type=Path)
+    extract.add_argument('paths', nargs='*', help='files or directories inside the archive')
+    extract.add_argument('--workers', type=int, default=None)
+    args = parser.parse_args()
+
+    with SeekableArchive(args.archive) as archive:
+        if args.command == 'list':
+            for member in archive.members.values():
+                print(f"{member['size']:>12} {member['codec']:>8} {member['name']}")
+            return
+        names = archive.select(args.paths) if args.paths else archive.names()
+        for path in archive.extract_many(names, args.target, args.workers):
+            if path.name.endswith(regionpack.PACKED_SUFFIX):
+                path = regionpack.unpack_file(path)
+            print(path)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,41 @@
+"""
+Small in-process metrics used in the per-run metrics records.
+"""
+
+import bisect
+import threading
+
+LATENCY_BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+class Histogram:
+    """
+    Fixed-bucket histogram. counts[i] is the number of observations in
+    (bounds[i-1], bounds[i]]; the last bucket collects everything larger.
+    """
+
+    def __init__(self, bounds=LATENCY_BUCKETS):
+        self.bounds = tuple(bounds)
+        self.counts = [0] * (len(self.bounds) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+        self._lock = threading.Lock()
+
+    def observe(self, value):
+        with self._lock:
+            self.counts[bisect.bisect_left(self.bounds, value)] += 1
+            self.count += 1
+            self.sum += value
+            self.max = max(self.max, value)
+
+    def snapshot(self):
+        with self._lock:
+            buckets = {str(b): n for b, n in zip(self.bounds, self.counts)}
+            buckets['+Inf'] = self.counts[-1]
+            return {
+                'count': self.count,
+                'sum': round(self.sum, 6),
+                'max': round(self.max, 6),
+                'buckets': buckets,
+            }
@@ -0,0 +1,429 @@
+"""
+Sidecar indexes for existing .tar.gz backups.
+
+tarfile has to inflate a .tar.gz from the beginning to list it or to reach
+one member. The indexer reads every archive once and writes a sidecar
+<archive>.tidx with the member list (offsets into the uncompressed tar) and
+gzip access points in the style of zlib's examples/zran.c: roughly every
+span bytes of output it records the compressed offset of a deflate block
+boundary, the bit offset inside that byte and the 32 KiB of output before
+it. Extraction starts from the closest access point in front of a member,
+primes a raw inflater with those bits and the window, and inflates only
+from there.
+
+Archives written by pipeline.py consist of many gzip members; the start of
+a member needs no window at all, so those access points cost nothing.
+
+Python's zlib module does not expose Z_BLOCK, inflatePrime() or
+inflateSetDictionary() for raw streams, so libz is used through ctypes.
+
+Sidecar layout (like seekable.py): zlib-compressed windows, then a
+zlib-compressed JSON index, then a footer with the index offset and length.
+The index remembers the archive size and mtime; a changed archive is
+indexed again.
+"""
+
+import argparse
+import bisect
+import ctypes
+import ctypes.util
+import hashlib
+import json
+import logging
+import os
+import struct
+import tarfile
+import zlib
+from pathlib import Path
+
+import reader
+
+logger = logging.getLogger(__name__)
+
+MAGIC = b'MCTI'
+VERSION = 1
+SUFFIX = '.tidx'
+DEFAULT_SPAN = 8 * 2**20
+WINDOW_SIZE = 32768
+READ_SIZE = 2**20
+OUT_SIZE = 256 * 2**10
+
+Z_OK = 0
+Z_STREAM_END = 1
+Z_BUF_ERROR = -5
+Z_NO_FLUSH = 0
+Z_BLOCK = 5
+GZIP_WBITS = 15 + 32
+RAW_WBITS = -15
+GZIP_TRAILER_SIZE = 8
+
+_FOOTER = struct.Struct('>4sBQQ32s')
+
+
+class TarIndexError(Exception):
+    pass
+
+
+class _ZStream(ctypes.Structure):
+    _fields_ = [
+        ('next_in', ctypes.c_void_p),
+        ('avail_in', ctypes.c_uint),
+        ('total_in', ctypes.c_ulong),
+        ('next_out', ctypes.c_void_p),
+        ('avail_out', ctypes.c_uint),
+        ('total_out', ctypes.c_ulong),
+        ('msg', ctypes.c_char_p),
+        ('state', ctypes.c_void_p),
+        ('zalloc', ctypes.c_void_p),
+        ('zfree', ctypes.c_void_p),
+        ('opaque', ctypes.c_void_p),
+        ('data_type', ctypes.c_int),
+        ('adler', ctypes.c_ulong),
+        ('reserved', ctypes.c_ulong),
+    ]
+
+
+def _load_libz():
+    name = ctypes.util.find_library('z')
+    if name is None:
+        return None
+    libz = ctypes.CDLL(name)
+    libz.zlibVersion.restype = ctypes.c_char_p
+    stream = ctypes.POINTER(_ZStream)
+    libz.inflateInit2_.argtypes = [stream, ctypes.c_int, ctypes.c_char_p, ctypes.c_int]
+    libz.inflate.argtypes = [stream, ctypes.c_int]
+    libz.inflateEnd.argtypes = [stream]
+    libz.inflateReset.argtypes = [stream]
+    libz.inflatePrime.argtypes = [stream, ctypes.c_int, ctypes.c_int]
+    libz.inflateSetDictionary.argtypes = [stream, ctypes.c_char_p, ctypes.c_uint]
+    return libz
+
+
+_libz = _load_libz()
+
+
+class _Inflater:
+    """Thin wrapper around a libz inflate stream."""
+
+    def __init__(self, wbits):
+        if _libz is None:
+            raise TarIndexError('libz is not available')
+        self.strm = _ZStream()
+        self._input = None
+        self._output = ctypes.create_string_buffer(OUT_SIZE)
+        self._check(_libz.inflateInit2_(ctypes.byref(self.strm), wbits, _libz.zlibVersion(),
+                                        ctypes.sizeof(_ZStream)))
+
+    def _check(self, ret):
+        if ret != Z_OK:
+            msg = self.strm.msg.decode() if self.strm.msg else f'zlib error {ret}'
+            raise TarIndexError(msg)
+
+    @property
+    def avail_in(self):
+        return self.strm.avail_in
+
+    @property
+    def data_type(self):
+        return self.strm.data_type
+
+    def feed(self, data):
+        self._input = ctypes.create_string_buffer(data, len(data))
+        self.strm.next_in = ctypes.addressof(self._input)
+        self.strm.avail_in = len(data)
+
+    def unconsumed(self):
+        if not self.strm.avail_in:
+            return b''
+        return ctypes.string_at(self.strm.next_in, self.strm.avail_in)
+
+    def prime(self, bits, value):
+        self._check(_libz.inflatePrime(ctypes.byref(self.strm), bits, value))
+
+    def set_dictionary(self, window):
+        self._check(_libz.inflateSetDictionary(ctypes.byref(self.strm), window, len(window)))
+
+    def reset(self):
+        self._check(_libz.inflateReset(ctypes.byref(self.strm)))
+
+    def inflate(self, flush=Z_NO_FLUSH):
+        """Run inflate once and return (return code, output)."""
+        self.strm.next_out = ctypes.addressof(self._output)
+        self.strm.avail_out = OUT_SIZE
+        ret = _libz.inflate(ctypes.byref(self.strm), flush)
+        if ret not in (Z_OK, Z_STREAM_END, Z_BUF_ERROR):
+            msg = self.strm.msg.decode() if self.strm.msg else f'zlib error {ret}'
+            raise TarIndexError(f'corrupt gzip stream: {msg}')
+        produced = OUT_SIZE - self.strm.avail_out
+        return ret, self._output.raw[:produced]
+
+    def close(self):
+        _libz.inflateEnd(ctypes.byref(self.strm))
+
+
+class _IndexingStream:
+    """Inflate a .tar.gz for tarfile while recording access points."""
+
+    def __init__(self, f, span):
+        self.f = f
+        self.span = span
+        self.inflater = _Inflater(GZIP_WBITS)
+        self.total_in = 0
+        self.total_out = 0
+        self.points = []
+        self.windows = []
+        self._window = b''
+        self._buffer = bytearray()
+        self._member_start = True
+        self._eof = False
+
+    def _add_point(self, bits, window):
+        if self.points and self.total_out - self.points[-1][0] < self.span:
+            return
+        if window is not None:
+            self.windows.append(window)
+        self.points.append([self.total_out, self.total_in, bits,
+                            len(self.windows) - 1 if window is not None else None])
+
+    def _step(self):
+        if self._member_start:
+            # The start of a gzip member needs no history.
+            self._add_point(0, None)
+            self._member_start = False
+        if not self.inflater.avail_in:
+            data = self.f.read(READ_SIZE)
+            if not data:
+                self._eof = True
+                return
+            self.inflater.feed(data)
+        before = self.inflater.avail_in
+        ret, out = self.inflater.inflate(Z_BLOCK)
+        self.total_in += before - self.inflater.avail_in
+        if out:
+            self.total_out += len(out)
+            self._window = (self._window + out)[-WINDOW_SIZE:]
+            self._buffer += out
+        if ret == Z_STREAM_END:
+            self.inflater.reset()
+            self._member_start = True
+            return
+        data_type = self.inflater.data_type
+        if data_type & 128 and not data_type & 64:
+            self._add_point(data_type & 7, self._window)
+
+    def read(self, size=-1):
+        while (size < 0 or len(self._buffer) < size) and not self._eof:
+            self._step()
+        if size < 0:
+            size = len(self._buffer)
+        data = bytes(self._buffer[:size])
+        del self._buffer[:size]
+        return data
+
+    def close(self):
+        self.inflater.close()
+
+
+def sidecar_path(archive_path):
+    archive_path = Path(archive_path)
+    return archive_path.with_name(archive_path.name + SUFFIX)
+
+
+def build_index(archive_path, span=DEFAULT_SPAN):
+    """Read archive_path once and write its sidecar index; return the index."""
+    archive_path = Path(archive_path)
+    st = archive_path.stat()
+    members = []
+    with reader.open_source(archive_path) as f:
+        stream = _IndexingStream(f, span)
+        try:
+            with tarfile.open(fileobj=stream, mode='r|') as tar:
+                for info in tar:
+                    members.append({
+                        'name': info.name,
+                        'offset': info.offset_data,
+                        'size': info.size,
+                        'mtime': info.mtime,
+                        'mode': info.mode,
+                        'type': info.type.decode('ascii'),
+                        'linkname': info.linkname,
+                    })
+        finally:
+            stream.close()
+
+    path = sidecar_path(archive_path)
+    tmp = path.with_name(path.name + '.partial')
+    offsets = []
+    with open(tmp, 'wb') as out:
+        for window in stream.windows:
+            packed = zlib.compress(window, 6)
+            offsets.append([out.tell(), len(packed)])
+            out.write(packed)
+        index = {
+            'version': VERSION,
+            'archive_size': st.st_size,
+            'archive_mtime_ns': st.st_mtime_ns,
+            'members': members,
+            'points': stream.points,
+            'windows': offsets,
+        }
+        data = zlib.compress(json.dumps(index, separators=(',', ':')).encode('utf-8'), 6)
+        offset = out.tell()
+        out.write(data)
+        out.write(_FOOTER.pack(MAGIC, VERSION, offset, len(data), hashlib.sha256(data).digest()))
+    os.replace(tmp, path)
+    logger.info('Indexed %s: %d members, %d access points', archive_path.name,
+                len(members), len(stream.points))
+    return index
+
+
+def load_index(archive_path):
+    """The sidecar index of archive_path, or None if it is missing or stale."""
+    archive_path = Path(archive_path)
+    path = sidecar_path(archive_path)
+    try:
+        with open(path, 'rb') as f:
+            f.seek(-_FOOTER.size, os.SEEK_END)
+            magic, version, offset, length, digest = _FOOTER.unpack(f.read(_FOOTER.size))
+            if magic != MAGIC or version != VERSION:
+                return None
+            f.seek(offset)
+            data = f.read(length)
+        st = archive_path.stat()
+    except (OSError, struct.error):
+        return None
+    if hashlib.sha256(data).digest() != digest:
+        return None
+    index = json.loads(zlib.decompress(data))
+    if index['archive_size'] != st.st_size or index['archive_mtime_ns'] != st.st_mtime_ns:
+        return None
+    return index
+
+
+def _read_window(archive_path, index, number):
+    offset, length = index['windows'][number]
+    with open(sidecar_path(archive_path), 'rb') as f:
+        f.seek(offset)
+        return zlib.decompress(f.read(length))
+
+
+def iter_member(archive_path, index, name):
+    """Yield the contents of member name, inflating from the nearest access point."""
+    member = next((m for m in index['members'] if m['name'] == name), None)
+    if member is None:
+        raise TarIndexError(f'{name} is not in {Path(archive_path).name}')
+    start, end = member['offset'], member['offset'] + member['size']
+    points = index['points']
+    out_offset, in_offset, bits, window = points[bisect.bisect_right([p[0] for p in points], start) - 1]
+
+    with open(archive_path, 'rb') as f:
+        raw = window is not None
+        if raw:
+            inflater = _Inflater(RAW_WBITS)
+            f.seek(in_offset - (1 if bits else 0))
+            if bits:
+                inflater.prime(bits, f.read(1)[0] >> (8 - bits))
+            inflater.set_dictionary(_read_window(archive_path, index, window))
+        else:
+            inflater = _Inflater(GZIP_WBITS)
+            f.seek(in_offset)
+        try:
+            position = out_offset
+            while position < end:
+                if not inflater.avail_in:
+                    data = f.read(READ_SIZE)
+                    if not data:
+                        raise TarIndexError(f'{Path(archive_path).name} ended inside {name}')
+                    inflater.feed(data)
+                ret, out = inflater.inflate()
+                if out:
+                    lo, hi = max(start - position, 0), min(end - position, len(out))
+                    if lo < hi:
+                        yield out[lo:hi]
+                    position += len(out)
+                if ret == Z_STREAM_END:
+                    rest = inflater.unconsumed()
+                    if raw:
+                        # A raw inflater stops before the gzip trailer of its member.
+                        rest += f.read(max(0, GZIP_TRAILER_SIZE - len(rest)))
+                        rest = rest[GZIP_TRAILER_SIZE:]
+                        inflater.close()
+                        inflater = _Inflater(GZIP_WBITS)
+                        raw = False
+                    else:
+                        inflater.reset()
+                    if rest:
+                        inflater.feed(rest)
+        finally:
+            inflater.close()
+
+
+def extract(archive_path, index, names, target_dir):
+    """Extract regular-file members under target_dir and return their paths."""
+    by_name = {m['name']: m for m in index['members']}
+    paths = []
+    for name in names:
+        member = by_name.get(name)
+        if member is None or member['type'] not in ('0', '\0'):
+            raise TarIndexError(f'{name} is not a regular file in {Path(archive_path).name}')
+        target = Path(target_dir) / name
+        target.parent.mkdir(parents=True, exist_ok=True)
+        with open(target, 'wb') as f:
+            for data in iter_member(archive_path, index, name):
+                f.write(data)
+        os.chmod(target, member['mode'])
+        os.utime(target, (member['mtime'], member['mtime']))
+        paths.append(target)
+    return paths
+
+
+def index_archives(root, span=DEFAULT_SPAN, busy=None):
+    """
+    Index every .tar.gz under root that has no valid sidecar and remove
+    sidecars of deleted archives. busy() is checked between archives;
+    returning True stops the pass early.
+    """
+    root = Path(root)
+    built = 0
+    for path in sorted(root.rglob('*' + SUFFIX)):
+        if not path.with_name(path.name[:-len(SUFFIX)]).exists():
+            path.unlink()
+    for path in sorted(root.rglob('*.tar.gz')):
+        if busy is not None and busy():
+            break
+        if load_index(path) is not None:
+            continue
+        try:
+            build_index(path, span)
+            built += 1
+        except (TarIndexError, tarfile.TarError, OSError) as e:
+            logger.warning('Could not index %s: %s', path.name, e)
+    return built
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Index .tar.gz backups for fast listing and extraction.')
+    parser.add_argument('archive', type=Path)
+    commands = parser.add_subparsers(dest='command', required=True)
+    build = commands.add_parser('build', help='(re)build the sidecar index')
+    build.add_argument('--span-mb', type=float, default=DEFAULT_SPAN / 2**20)
+    commands.add_parser('list', help='list members')
+    extract_cmd = commands.add_parser('extract', help='extract single members')
+    extract_cmd.add_argument('target', type=Path)
+    extract_cmd.add_argument('names', nargs='+')
+    args = parser.parse_args()
+
+    if args.command == 'build':
+        build_index(args.archive, int(args.span_mb * 2**20))
+        return
+    index = load_index(args.archive) or build_index(args.archive)
+    if args.command == 'list':
+        for member in index['members']:
+            print(f"{member['size']:>12} {member['name']}")
+    else:
+        for path in extract(args.archive, index, args.names, args.target):
+            print(path)
+
+
+if __name__ == '__main__':
+    main()
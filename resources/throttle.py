@@ -0,0 +1,208 @@
+"""
+Backup I/O throttling driven by server tick times.
+
+While a backup runs, TpsSampler polls `forge tps` over RCON at monitoring
+priority and feeds the overall mean tick time (MSPT) to an IoGovernor. The
+governor owns a token bucket for bytes read from the world and adjusts its
+rate with an AIMD controller: the rate is cut when MSPT climbs above the high
+mark and grows again while the server has headroom.
+
+The governor is also told about kernel pressure (see pressure.py): while
+the host or our cgroup reports I/O or memory stalls, reads drop to the
+minimum rate and only one compressor thread may run at a time.
+
+Backup code opens source files with open_source() (see reader.py), which
+pays for every read from the active governor's bucket, and compressors run
+inside compress_gate(). Without an active governor both are no-ops.
+"""
+
+import logging
+import re
+import threading
+import time
+from contextlib import contextmanager, nullcontext
+
+import reader
+from ratelimit import TokenBucket
+
+logger = logging.getLogger(__name__)
+
+_OVERALL = re.compile(r'Overall\s*:\s*Mean tick time:\s*([\d.]+)\s*ms\.?\s*Mean TPS:\s*([\d.]+)')
+_DIMENSION = re.compile(r'Mean tick time:\s*([\d.]+)\s*ms\.?\s*Mean TPS:\s*([\d.]+)')
+
+
+def parse_forge_tps(text):
+    """Return (mspt, tps) from `forge tps` output, or None if it has no tick times."""
+    match = _OVERALL.search(text)
+    if match:
+        return float(match.group(1)), float(match.group(2))
+    # Without an "Overall" line use the slowest dimension.
+    samples = [(float(m.group(1)), float(m.group(2))) for m in _DIMENSION.finditer(text)]
+    return max(samples) if samples else None
+
+
+class IoGovernor:
+    """Read-rate limiter whose rate follows the server's tick time.
+
+    Lag is logged once when MSPT climbs above the high mark and once when it
+    is back below the low mark; the rate steps in between go to debug.
+    """
+
+    def __init__(self, min_rate, max_rate, mspt_low=25.0, mspt_high=40.0,
+                 decrease=0.5, increase=1.25):
+        self.min_rate = min_rate
+        self.max_rate = max_rate
+        self.mspt_low = mspt_low
+        self.mspt_high = mspt_high
+        self.decrease = decrease
+        self.increase = increase
+        self.rate = max_rate
+        self.bucket = TokenBucket(max_rate, max_rate / 4)
+        self.bytes_read = 0
+        self.throttled_seconds = 0.0
+        self.under_pressure = False
+        self.lagging = False
+        self._lock = threading.Lock()
+        self._compress_lock = threading.Lock()
+
+    def update(self, mspt):
+        """Adjust the read rate for a new MSPT sample."""
+        rate = self.rate
+        if mspt > self.mspt_high:
+            rate = max(self.min_rate, rate * self.decrease)
+            if not self.lagging:
+                self.lagging = True
+                logger.warning('Server is lagging (MSPT %.1f ms above %.1f ms), slowing the backup down',
+                               mspt, self.mspt_high)
+        elif mspt < self.mspt_low:
+            rate = min(self.max_rate, rate * self.increase)
+            if self.lagging:
+                self.lagging = False
+                logger.info('Server recovered (MSPT %.1f ms), backup speeding up again', mspt)
+        if rate != self.rate:
+            logger.debug('MSPT %.1f ms: backup read rate %.1f -> %.1f MiB/s',
+                        mspt, self.rate / 2**20, rate / 2**20)
+            self.rate = rate
+            if not self.under_pressure:
+                self.bucket.set_rate(rate, rate / 4)
+
+    def set_pressure(self, reasons):
+        """Enter or leave the minimum-rate mode; reasons lists the crossed PSI thresholds."""
+        stalled = bool(reasons)
+        if stalled == self.under_pressure:
+            return
+        self.under_pressure = stalled
+        if stalled:
+            logger.info('Kernel pressure (%s): backup slowed down to %.1f MiB/s',
+                        ', '.join(reasons), self.min_rate / 2**20)
+            self.bucket.set_rate(self.min_rate, self.min_rate / 4)
+        else:
+            logger.info('Kernel pressure cleared, backup read rate back to %.1f MiB/s', self.rate / 2**20)
+            self.bucket.set_rate(self.rate, self.rate / 4)
+
+    @contextmanager
+    def compress_slot(self):
+        """Serialize compressor threads while under pressure."""
+        if not self.under_pressure:
+            yield
+            return
+        with self._compress_lock:
+            yield
+
+    def throttle(self, nbytes):
+        """Account for nbytes read, sleeping if the budget is exhausted."""
+        wait = self.bucket.reserve(nbytes)
+        with self._lock:
+            self.bytes_read += nbytes
+            self.throttled_seconds += wait
+        if wait:
+            time.sleep(wait)
+
+    def stats(self):
+        return {
+            'read_rate': round(self.rate),
+            'bytes_read': self.bytes_read,
+            'throttled_seconds': round(self.throttled_seconds, 3),
+        }
+
+
+_active = None
+
+
+@contextmanager
+def governed(governor):
+    """Make governor throttle every file opened with open_source()."""
+    global _active
+    _active = governor
+    try:
+        yield governor
+    finally:
+        _active = None
+
+
+def open_source(path):
+    return reader.open_source(path, _active)
+
+
+def compress_gate():
+    return _active.compress_slot() if _active is not None else nullcontext()
+
+
+class TpsSampler:
+    """Background thread that polls tick times over RCON."""
+
+    def __init__(self, command, interval=5.0, governor=None):
+        """command(text) runs an RCON command and returns its response."""
+        self.command = command
+        self.interval = interval
+        self.governor = governor
+        self.samples = []
+        # Failures are logged once until sampling works again.
+        self.failing = False
+        self._stop = threading.Event()
+        self._thread = None
+
+    def sample(self):
+        try:
+            result = parse_forge_tps(self.command('forge tps'))
+        except Exception as e:
+            self._failed('Could not sample TPS: %s', e)
+            return None
+        if result is None:
+            self._failed('Unexpected `forge tps` output, throttling by TPS is disabled')
+            return None
+        if self.failing:
+            self.failing = False
+            logger.info('TPS sampling works again')
+        self.samples.append(result[0])
+        if self.governor is not None:
+            self.governor.update(result[0])
+        return result
+
+    def _failed(self, message, *args):
+        if not self.failing:
+            self.failing = True
+            logger.warning(message, *args)
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self.sample()
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name='tps-sampler', daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+
+    def stats(self):
+        if not self.samples:
+            return {}
+        return {
+            'mspt_mean': round(sum(self.samples) / len(self.samples), 2),
+            'mspt_max': round(max(self.samples), 2),
+            'mspt_samples': len(self.samples),
+        }
@@ -0,0 +1,80 @@
+"""
+Parallel directory tree walker.
+
+os.walk lists one directory at a time and the caller then stats every file
+one after another on a single thread; on a network-backed volume each of
+those calls is a round trip. This walker lists directories with os.scandir,
+whose entries already know from the directory listing whether they are
+directories, so only files are stat'ed, and spreads the work over a thread
+pool (scandir and stat release the GIL): every directory is listed in its own
+task and its files are stat'ed in batches of STAT_BATCH, so one directory
+with thousands of chunks or player files is stat'ed in parallel too.
+
+Records are yielded as soon as their batch is done, in no particular order.
+Entries that disappear during the walk are skipped.
+"""
+
+import os
+import stat
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+# Threads used by walk() when the caller does not say; set from
+# BACKUP_WALK_WORKERS by resource_script.py.
+WORKERS = 8
+STAT_BATCH = 256
+
+
+def _list(path, rel_dir, exclude):
+    """(subdirectory rels, [(rel, DirEntry)] of other entries) of one directory."""
+    subdirs, files = [], []
+    try:
+        with os.scandir(path) as entries:
+            for entry in entries:
+                rel = rel_dir + entry.name
+                if rel in exclude:
+                    continue
+                try:
+                    is_dir = entry.is_dir(follow_symlinks=False)
+                except OSError:
+                    continue
+                if is_dir:
+                    subdirs.append(rel)
+                else:
+                    files.append((rel, entry))
+    except (FileNotFoundError, NotADirectoryError, PermissionError):
+        pass
+    return subdirs, files
+
+
+def _stat(batch):
+    found = []
+    for rel, entry in batch:
+        try:
+            st = entry.stat(follow_symlinks=False)
+        except FileNotFoundError:
+            continue
+        if stat.S_ISREG(st.st_mode):
+            found.append((rel, st))
+    return found
+
+
+def walk(root, exclude=(), workers=None):
+    """Yield (relative posix path, stat) for every regular file under root."""
+    root = os.fspath(root)
+    exclude = set(exclude)
+    executor = ThreadPoolExecutor(workers or WORKERS, thread_name_prefix='walk')
+    try:
+        pending = {executor.submit(_list, root, '', exclude): 'list'}
+        while pending:
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                if pending.pop(future) == 'stat':
+                    yield from future.result()
+                    continue
+                subdirs, files = future.result()
+                for rel in subdirs:
+                    pending[executor.submit(_list, os.path.join(root, rel), rel + '/', exclude)] = 'list'
+                for start in range(0, len(files), STAT_BATCH):
+                    pending[executor.submit(_stat, files[start:start + STAT_BATCH])] = 'stat'
+    finally:
+        executor.shutdown(wait=True, cancel_futures=True)
@@ -0,0 +1,118 @@
+import hashlib
+import os
+
+import pytest
+
+import anvil
+import catalog
+import incremental
+import objstore
+import worlds
+
+
+def _touch(path, seconds):
+    os.utime(path, (seconds, seconds))
+
+
+@pytest.fixture
+def world(tmp_path):
+    source = tmp_path / 'data'
+    contents = worlds.make_world(source)
+    return source, contents
+
+
+def _edit(source, contents, index=None):
+    """Change one chunk of r.0.0 and level.dat; return the changed chunk index."""
+    rel = 'world/region/r.0.0.mca'
+    region = dict(contents[rel])
+    index = min(region) if index is None else index
+    region[index] = (region[index][0] + 1, region[index][1])
+    worlds.write_region(source / rel, region)
+    _touch(source / rel, 2_000_000_000)
+    contents[rel] = region
+    (source / 'world/level.dat').write_bytes(b'edited')
+    _touch(source / 'world/level.dat', 2_000_000_000)
+    contents['world/level.dat'] = b'edited'
+    return index
+
+
+def _chain(tmp_path, source, contents):
+    """A full and an incremental backup; returns the changed chunk index."""
+    archive_dir = tmp_path / 'backups' / 'chain'
+    first = incremental.create_backup(source, archive_dir, '20260101-000000')
+    index = _edit(source, contents)
+    incremental.create_backup(source, archive_dir, '20260101-010000', first)
+    return index
+
+
+def test_chain_rows_have_hashes_and_changes(tmp_path, world):
+    source, contents = world
+    index = _chain(tmp_path, source, contents)
+    with catalog.Catalog(tmp_path / 'catalog.db') as cat:
+        assert cat.sync(tmp_path / 'backups', source) == 2
+        assert [row[1:3] for row in cat.snapshots('chain')] == [
+            ('20260101-000000', 'full'), ('20260101-010000', 'incremental')]
+
+        history = cat.file_history('chain', 'world/level.dat')
+        assert [(since, until) for since, until, *_ in history] == [
+            ('20260101-000000', '20260101-010000'), ('20260101-010000', None)]
+        assert history[-1][4] == hashlib.sha256(b'edited').hexdigest()
+        player = cat.file_history('chain', 'world/playerdata/a.dat')
+        assert len(player) == 1
+        assert player[0][4] == hashlib.sha256(contents['world/playerdata/a.dat']).hexdigest()
+        assert all(row[4] for row in cat.file_history('chain', 'world/region/r.1.0.mca'))
+
+        changes = cat.changes('chain', '20260101-000000')
+        assert changes['files'] == ['world/level.dat', 'world/region/r.0.0.mca']
+        assert changes['removed'] == []
+        x, z = anvil.chunk_coords(index, 0, 0)
+        assert changes['chunks'] == {'world/region/r.0.0.mca': [(x, z)]}
+
+        chunk = cat.chunk_history('chain', x, z)
+        assert [(row[1], row[2], row[4]) for row in chunk] == [
+            ('20260101-000000', '20260101-010000', incremental.archive_name('20260101-000000', 'full')),
+            ('20260101-010000', None, incremental.archive_name('20260101-010000', 'incremental'))]
+        assert cat.sync(tmp_path / 'backups', source) == 0
+
+
+def test_files_at_and_forgetting_snapshots(tmp_path, world):
+    source, contents = world
+    size = len(contents['world/level.dat'])
+    _chain(tmp_path, source, contents)
+    archive_dir = tmp_path / 'backups' / 'chain'
+    with catalog.Catalog(tmp_path / 'catalog.db') as cat:
+        cat.sync(tmp_path / 'backups', source)
+        first = cat.files_at('chain', '20260101-000000')
+        assert first['world/level.dat'][0] == size
+        assert cat.files_at('chain', '20260101-010000')['world/level.dat'][0] == len(b'edited')
+
+        (archive_dir / incremental.manifest_name('20260101-010000', 'incremental')).unlink()
+        cat.sync(tmp_path / 'backups', source)
+        assert cat.latest('chain') == '20260101-000000'
+        assert [row[:2] for row in cat.file_history('chain', 'world/level.dat')] == [
+            ('20260101-000000', '20260101-010000')]
+        assert cat.files_at('chain', '20260101-000000') == first
+
+
+def test_store_rows_use_object_ids(tmp_path, world):
+    source, contents = world
+    store = objstore.ObjectStore(tmp_path / 'backups' / 'store')
+    try:
+        store.create_snapshot(source, '20260101-000000')
+        index = _edit(source, contents)
+        manifest = store.create_snapshot(source, '20260101-010000')
+    finally:
+        store.close()
+    with catalog.Catalog(tmp_path / 'catalog.db') as cat:
+        assert cat.sync(tmp_path / 'backups', source) == 2
+        rel = 'world/level.dat'
+        assert cat.file_history('store', rel)[-1][4] == ','.join(manifest['files'][rel][2])
+        assert cat.changes('store', '20260101-000000')['files'] == ['world/level.dat', 'world/region/r.0.0.mca']
+
+        store = objstore.ObjectStore(tmp_path / 'backups' / 'store')
+        try:
+            _, hashes = store.read_table(manifest['regions']['world/region/r.0.0.mca'][2])
+        finally:
+            store.close()
+        x, z = anvil.chunk_coords(index, 0, 0)
+        assert cat.chunk_history('store', x, z)[-1][4] == hashes[index]
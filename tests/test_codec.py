@@ -0,0 +1,77 @@
+import collections
+import io
+import json
+import random
+
+import pytest
+
+import codec
+
+
+def _json(seed, size):
+    rng = random.Random(seed)
+    stats = {f'minecraft:{rng.choice(["mined", "used", "crafted"])}/{i}': rng.randint(0, 999) for i in range(size)}
+    return json.dumps(stats, indent=2).encode()
+
+
+def _selector(**kwargs):
+    return codec.CodecSelector(codec.available(['zlib-1', 'zlib-6', 'xz-6']), **kwargs)
+
+
+def test_known_compressed_files_are_stored_without_a_probe():
+    selector = _selector()
+    for rel in ('world/region/r.0.0.mca', 'mods/Create.JAR', 'logs/2026-10-18.log.gz'):
+        assert selector.choose(rel, None, 1000) is codec.STORE
+    assert selector.probes == 0
+    assert selector.stats()['codecs'] == {'store': {'files': 3, 'bytes': 3000}}
+
+
+def test_probe_picks_compression_for_text_and_store_for_noise():
+    selector = _selector()
+    data = _json(1, 3000)
+    assert selector.choose('world/stats/a.json', io.BytesIO(data), len(data)) is not codec.STORE
+    noise = random.Random(2).randbytes(100_000)
+    assert selector.choose('world/data/noise.bin', io.BytesIO(noise), len(noise)) is codec.STORE
+    assert selector.probes == 2
+
+
+def test_cpu_cost_can_outweigh_the_savings():
+    selector = codec.CodecSelector([codec.get('xz-6')], cpu_cost=1e15)
+    data = _json(3, 3000)
+    assert selector.choose('a.json', io.BytesIO(data), len(data)) is codec.STORE
+
+
+def test_choice_is_remembered_per_extension():
+    selector = _selector(probes_per_type=3)
+    chosen = []
+    for i in range(6):
+        data = _json(i, 2000)
+        chosen.append(selector.choose(f'world/stats/{i}.JSON', io.BytesIO(data), len(data)).name)
+    assert selector.probes == 3
+    decided = collections.Counter(chosen[:3]).most_common(1)[0][0]
+    assert chosen[3:] == [decided] * 3
+    assert sum(entry['files'] for entry in selector.stats()['codecs'].values()) == 6
+
+
+def test_read_sample_spreads_over_large_files_and_rewinds():
+    data = bytes(range(256)) * 4096
+    f = io.BytesIO(data)
+    sample = codec.read_sample(f, len(data), sample_size=1000, samples=3)
+    step = (len(data) - 1000) // 2
+    assert sample == data[:1000] + data[step:step + 1000] + data[2 * step:2 * step + 1000]
+    assert f.tell() == 0
+    assert codec.read_sample(io.BytesIO(b'small'), 5) == b'small'
+
+
+@pytest.mark.parametrize('name', sorted(codec.CODECS))
+def test_every_codec_decodes_by_tag(name):
+    data = _json(4, 500)
+    chosen = codec.get(name)
+    assert codec.decode(chosen.tag, chosen.compress(data)) == data
+
+
+def test_gzip_compatible_and_unknown_codecs():
+    names = [c.name for c in codec.gzip_compatible(codec.available(['store', 'zlib-6', 'xz-6', 'no-such']))]
+    assert names == ['store', 'zlib-6']
+    with pytest.raises(codec.CodecError):
+        codec.get('no-such')
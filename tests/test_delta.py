@@ -0,0 +1,108 @@
+import io
+import random
+
+import pytest
+
+import delta
+
+
+def _versions():
+    """An old file and a newer one with in-place edits, an insertion and a cut."""
+    rng = random.Random(19)
+    old = rng.randbytes(600 * 1024)
+    new = bytearray(old)
+    new[5000:5100] = rng.randbytes(100)
+    new[200 * 1024:200 * 1024] = rng.randbytes(777)
+    del new[400 * 1024:400 * 1024 + 3000]
+    new += rng.randbytes(1234)
+    return old, bytes(new)
+
+
+def _delta(signature, data, max_literal=None):
+    out = io.BytesIO()
+    stats = delta.make_delta(signature, io.BytesIO(data), out, max_literal)
+    return stats, out.getvalue()
+
+
+def _apply(old, patch):
+    out = io.BytesIO()
+    written = delta.apply_delta(io.BytesIO(old), io.BytesIO(patch), out)
+    assert written == len(out.getvalue())
+    return out.getvalue()
+
+
+def test_round_trip():
+    old, new = _versions()
+    signature = delta.signature_of(io.BytesIO(old), len(old), workers=2)
+    stats, patch = _delta(signature, new)
+    assert stats['size'] == len(new)
+    assert stats['copied'] > len(new) // 2
+    assert len(patch) < len(new) // 4
+    assert _apply(old, patch) == new
+
+
+@pytest.mark.parametrize('new', [b'', b'short', None])
+def test_edge_cases(new):
+    old, _ = _versions()
+    new = old if new is None else new
+    signature = delta.signature_of(io.BytesIO(old), len(old))
+    _, patch = _delta(signature, new)
+    assert _apply(old, patch) == new
+
+
+def test_empty_base():
+    _, new = _versions()
+    signature = delta.signature_of(io.BytesIO(b''), 0)
+    _, patch = _delta(signature, new)
+    assert _apply(b'', patch) == new
+
+
+def test_max_literal():
+    old, new = _versions()
+    signature = delta.signature_of(io.BytesIO(old), len(old))
+    assert _delta(signature, new, max_literal=100)[0] is None
+
+
+def test_saved_signatures(tmp_path):
+    old, new = _versions()
+    signatures = {'world/region/r.0.0.mca': delta.signature_of(io.BytesIO(old), len(old)),
+                  'world/level.dat': delta.signature_of(io.BytesIO(b'level'), 5)}
+    path = tmp_path / 'signatures'
+    delta.save_signatures(path, signatures)
+    loaded = delta.load_signatures(path)
+    assert loaded.keys() == signatures.keys()
+    for rel, signature in signatures.items():
+        copy = loaded[rel]
+        assert (copy.size, copy.block_size, list(copy.weak), copy.strong) == \
+            (signature.size, signature.block_size, list(signature.weak), signature.strong)
+    _, patch = _delta(loaded['world/region/r.0.0.mca'], new)
+    assert _apply(old, patch) == new
+
+
+def test_truncated_signatures(tmp_path):
+    old, _ = _versions()
+    path = tmp_path / 'signatures'
+    delta.save_signatures(path, {'r.0.0.mca': delta.signature_of(io.BytesIO(old), len(old))})
+    path.write_bytes(path.read_bytes()[:-10])
+    with pytest.raises(delta.DeltaError):
+        delta.load_signatures(path)
+
+
+def test_wrong_base():
+    old, new = _versions()
+    signature = delta.signature_of(io.BytesIO(old), len(old))
+    _, patch = _delta(signature, new)
+    other = bytearray(old)
+    other[300 * 1024] ^= 0xFF
+    with pytest.raises(delta.DeltaError):
+        _apply(bytes(other), patch)
+
+
+def test_damaged_delta():
+    old, new = _versions()
+    signature = delta.signature_of(io.BytesIO(old), len(old))
+    _, patch = _delta(signature, new)
+    with pytest.raises(delta.DeltaError):
+        _apply(old, patch[:len(patch) // 2])
+    with pytest.raises(delta.DeltaError):
+        _apply(old, b'XXXX' + patch[4:])
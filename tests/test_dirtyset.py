@@ -0,0 +1,114 @@
+import os
+import time
+
+import pytest
+
+import dirtyset
+import incremental
+import worlds
+
+
+@pytest.fixture
+def tracker(tmp_path):
+    source = tmp_path / 'data'
+    worlds.make_world(source)
+    (source / 'logs').mkdir()
+    tracker = dirtyset.DirtyTracker(source, exclude={'logs'})
+    if not tracker.start():
+        pytest.skip('inotify is not available')
+    with tracker.pending() as dirty:
+        # Nothing is known right after the start.
+        assert dirty is None
+    yield tracker
+    tracker.stop()
+
+
+def _wait(condition):
+    deadline = time.monotonic() + 5
+    while not condition() and time.monotonic() < deadline:
+        time.sleep(0.01)
+
+
+def _seen(tracker, *paths):
+    _wait(lambda: all(rel in tracker._files | tracker._dirs for rel in paths))
+
+
+def _write(path, data):
+    path.parent.mkdir(parents=True, exist_ok=True)
+    path.write_bytes(data)
+
+
+def test_changed_files_and_new_directories_are_collected(tracker):
+    root = tracker.root
+    _write(root / 'world/level.dat', b'changed')
+    _write(root / 'logs/latest.log', b'ignored')
+    (root / 'world/playerdata/a.dat').unlink()
+    (root / 'world/DIM-1').mkdir()
+    _seen(tracker, 'world/DIM-1')
+    _write(root / 'world/DIM-1/region/r.0.0.mca', b'')
+    _seen(tracker, 'world/DIM-1/region')
+    with tracker.pending() as (files, dirs):
+        assert {'world/level.dat', 'world/playerdata/a.dat'} <= files
+        assert not any(rel.startswith('logs') for rel in files | dirs)
+        assert 'world/DIM-1' in dirs
+    with tracker.pending() as (files, dirs):
+        assert not files and not dirs
+
+
+def test_a_failed_backup_gives_its_paths_back(tracker):
+    _write(tracker.root / 'world/level.dat', b'changed')
+    _seen(tracker, 'world/level.dat')
+    with pytest.raises(RuntimeError):
+        with tracker.pending() as dirty:
+            assert 'world/level.dat' in dirty[0]
+            raise RuntimeError('backup failed')
+    with tracker.pending() as (files, _):
+        assert 'world/level.dat' in files
+
+
+def test_overflow_falls_back_to_a_full_scan(tracker, tmp_path):
+    root = tracker.root
+    archive_dir = tmp_path / 'chain'
+    first = incremental.create_backup(root, archive_dir, '20260101-000000')
+    _write(root / 'world/level.dat', b'seen')
+    _seen(tracker, 'world/level.dat')
+    # A change the queue dropped, then the overflow event that reports it.
+    tracker._files.clear()
+    _write(root / 'world/data/raids.dat', b'lost event')
+    tracker._handle(-1, dirtyset.IN_Q_OVERFLOW, '')
+    assert tracker.stats['overflows'] == 1
+    with tracker.pending() as dirty:
+        assert dirty is None
+        second = incremental.create_backup(root, archive_dir, '20260101-010000', first, dirty=dirty)
+    assert set(second['changes']['files']) == {'world/level.dat', 'world/data/raids.dat'}
+    with tracker.pending() as dirty:
+        assert dirty == (set(), set())
+
+
+def test_moved_directory_falls_back_to_a_full_scan(tracker):
+    root = tracker.root
+    os.rename(root / 'world/playerdata', root / 'world/players')
+    _wait(lambda: tracker._full_scan)
+    with tracker.pending() as dirty:
+        assert dirty is None
+    # The moved directory is watched under its new path.
+    _write(root / 'world/players/b.dat', b'new')
+    _seen(tracker, 'world/players/b.dat')
+    assert 'world/players/b.dat' in tracker._files
+
+
+def test_dirty_backup_matches_a_walk(tracker, tmp_path):
+    root = tracker.root
+    archive_dir = tmp_path / 'chain'
+    first = incremental.create_backup(root, archive_dir, '20260101-000000')
+    _write(root / 'world/level.dat', b'changed')
+    (root / 'world/playerdata/a.dat').unlink()
+    _write(root / 'world/data/new.dat', b'new')
+    _seen(tracker, 'world/level.dat', 'world/playerdata/a.dat', 'world/data/new.dat')
+    with tracker.pending() as dirty:
+        tracked = incremental.create_backup(root, archive_dir, '20260101-010000', first, dirty=dirty)
+    walked = incremental.create_backup(root, tmp_path / 'walked', '20260101-010000', first)
+    assert tracked['files'] == walked['files']
+    assert tracked['regions'] == walked['regions']
+    assert {key: sorted(value) for key, value in tracked['changes'].items()} == \
+        {key: sorted(value) for key, value in walked['changes'].items()}
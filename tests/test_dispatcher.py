@@ -0,0 +1,91 @@
+import asyncio
+import time
+
+import dispatcher
+from dispatcher import CRITICAL, MONITORING, NORMAL
+
+
+class FakeClient:
+    """Records the order commands reach the connection; a command with a gate waits for it."""
+
+    def __init__(self):
+        self.started = []
+        self.gates = {}
+
+    async def command(self, command, timeout=None):
+        self.started.append(command)
+        if command in self.gates:
+            await self.gates[command].wait()
+        return f'ok {command}'
+
+
+async def _settle():
+    for _ in range(10):
+        await asyncio.sleep(0)
+
+
+def test_highest_priority_goes_first_and_critical_has_a_reserved_slot():
+    async def main():
+        client = FakeClient()
+        rcon = dispatcher.RconDispatcher(client, max_in_flight=2)
+        client.gates = {name: asyncio.Event() for name in ('poll-0', 'save-off', 'say')}
+        sent = [asyncio.ensure_future(rcon.command('poll-0', MONITORING))]
+        await _settle()
+        for command, priority in (('poll-1', MONITORING), ('say', NORMAL), ('save-off', CRITICAL),
+                                  ('save-all', CRITICAL)):
+            sent.append(asyncio.ensure_future(rcon.command(command, priority)))
+        await _settle()
+        # One slot is left for CRITICAL only; save-all waits until a slot frees.
+        assert client.started == ['poll-0', 'save-off']
+        client.gates['save-off'].set()
+        await _settle()
+        assert client.started == ['poll-0', 'save-off', 'save-all']
+        client.gates['poll-0'].set()
+        await _settle()
+        assert client.started == ['poll-0', 'save-off', 'save-all', 'say']
+        client.gates['say'].set()
+        results = await asyncio.gather(*sent)
+        assert client.started[-1] == 'poll-1'
+        assert results == ['ok poll-0', 'ok poll-1', 'ok say', 'ok save-off', 'ok save-all']
+        assert {name: h['count'] for name, h in rcon.latency_snapshot().items()} == {
+            'critical': 2, 'normal': 1, 'monitoring': 2}
+        await rcon.close()
+
+    asyncio.run(main())
+
+
+def test_rate_limit_applies_per_class():
+    async def main():
+        client = FakeClient()
+        rcon = dispatcher.RconDispatcher(client, max_in_flight=4, rates={MONITORING: 4})
+        started = time.monotonic()
+        polls = [asyncio.ensure_future(rcon.command(f'poll-{i}', MONITORING)) for i in range(6)]
+        await _settle()
+        assert await rcon.command('save-off', CRITICAL) == 'ok save-off'
+        # The burst of four goes out at once; CRITICAL is not held back by the monitoring limit.
+        assert client.started[:5] == ['poll-0', 'poll-1', 'poll-2', 'poll-3', 'save-off']
+        await asyncio.gather(*polls)
+        assert time.monotonic() - started >= 0.4
+        await rcon.close()
+
+    asyncio.run(main())
+
+
+def test_cancelled_commands_are_dropped_from_the_queue():
+    async def main():
+        client = FakeClient()
+        rcon = dispatcher.RconDispatcher(client, max_in_flight=2)
+        client.gates['busy'] = asyncio.Event()
+        busy = asyncio.ensure_future(rcon.command('busy', NORMAL))
+        await _settle()
+        try:
+            await asyncio.wait_for(rcon.command('late', NORMAL), 0.05)
+        except asyncio.TimeoutError:
+            pass
+        client.gates['busy'].set()
+        await busy
+        assert await rcon.command('next', NORMAL) == 'ok next'
+        assert client.started == ['busy', 'next']
+        await rcon.close()
+
+    asyncio.run(main())
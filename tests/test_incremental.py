@@ -0,0 +1,68 @@
+import os
+import random
+import tarfile
+
+import incremental
+import restore
+import worlds
+
+REL = 'world/region/r.0.0.mca'
+
+
+def _members(path):
+    with tarfile.open(path) as tar:
+        return {info.name: tar.extractfile(info).read() for info in tar if info.isfile()}
+
+
+def _touch(path, seconds):
+    os.utime(path, (seconds, seconds))
+
+
+def test_incremental_stores_only_chunks_with_new_timestamps(tmp_path):
+    source = tmp_path / 'data'
+    archive_dir = tmp_path / 'backups' / 'chain'
+    contents = worlds.make_world(source)
+    first = incremental.create_backup(source, archive_dir, '20260101-000000')
+
+    rng = random.Random(1)
+    region = dict(contents[REL])
+    changed, rewritten_only, deleted = sorted(region)[:3]
+    region[changed] = (region[changed][0] + 5, worlds.chunk(rng))
+    # Saved again without a new timestamp: the header says nothing changed.
+    region[rewritten_only] = (region[rewritten_only][0], worlds.chunk(rng))
+    del region[deleted]
+    added = next(i for i in range(1024) if i not in region)
+    region[added] = (4000, worlds.chunk(rng))
+    worlds.write_region(source / REL, region)
+    _touch(source / REL, 2_000_000_000)
+
+    second = incremental.create_backup(source, archive_dir, '20260101-010000', first)
+    assert second['changes']['chunks'] == {REL: sorted([changed, added])}
+    assert second['changes']['deleted_chunks'] == {REL: [deleted]}
+    assert second['changes']['files'] == []
+    members = _members(archive_dir / second['archive'])
+    assert set(members) == {f'{incremental.CHUNK_DIR}/{REL}/{changed}', f'{incremental.CHUNK_DIR}/{REL}/{added}'}
+    assert members[f'{incremental.CHUNK_DIR}/{REL}/{added}'] == region[added][1]
+    # The untouched region is carried over from the manifest without reading it.
+    assert second['regions']['world/region/r.1.0.mca'] == first['regions']['world/region/r.1.0.mca']
+
+    snap = restore.open_snapshot(tmp_path / 'backups', '20260101-010000')
+    try:
+        chunks = snap.read_chunks(REL, range(1024))
+    finally:
+        snap.close()
+    expected = dict(region)
+    expected[rewritten_only] = contents[REL][rewritten_only]
+    assert chunks == expected
+
+
+def test_unchanged_tree_makes_an_empty_incremental(tmp_path):
+    source = tmp_path / 'data'
+    archive_dir = tmp_path / 'backups' / 'chain'
+    worlds.make_world(source)
+    first = incremental.create_backup(source, archive_dir, '20260101-000000')
+    second = incremental.create_backup(source, archive_dir, '20260101-010000', first)
+    assert second['files'] == first['files']
+    assert second['regions'] == first['regions']
+    assert second['changes'] == {'files': [], 'chunks': {}, 'deleted_chunks': {}, 'removed': []}
+    assert _members(archive_dir / second['archive']) == {}
@@ -0,0 +1,158 @@
+import os
+import random
+import zlib
+
+import pytest
+
+import anvil
+import journal
+import regionpack
+
+REGION = 'world/region/r.0.0.mca'
+
+
+def _chunk(rng):
+    return bytes([regionpack.CHUNK_ZLIB]) + zlib.compress(rng.randbytes(rng.randint(100, 9000)))
+
+
+class World:
+    """A server directory whose every version is remembered for comparison."""
+
+    def __init__(self, root):
+        self.root = root
+        self.rng = random.Random(17)
+        self.chunks = {}
+        self.files = {}
+        self.mtime_ns = 1_700_000_000 * 10**9
+
+    def _touch(self, path):
+        self.mtime_ns += 10**9
+        os.utime(path, ns=(self.mtime_ns, self.mtime_ns))
+
+    def set_chunk(self, index, timestamp):
+        self.chunks[index] = (timestamp, _chunk(self.rng))
+
+    def write_region(self):
+        path = self.root / REGION
+        path.parent.mkdir(parents=True, exist_ok=True)
+        timestamps = [0] * anvil.CHUNKS_PER_REGION
+        for index, (timestamp, _) in self.chunks.items():
+            timestamps[index] = timestamp
+        with open(path, 'wb') as f:
+            anvil.write_region(f, timestamps, {i: payload for i, (_, payload) in self.chunks.items()})
+        self._touch(path)
+
+    def write_file(self, rel, data):
+        path = self.root / rel
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.write_bytes(data)
+        self._touch(path)
+        self.files[rel] = (data, self.mtime_ns)
+
+    def remove_file(self, rel):
+        (self.root / rel).unlink()
+        del self.files[rel]
+
+    def snapshot(self):
+        return dict(self.chunks), dict(self.files)
+
+
+def _read_back(target):
+    chunks = {}
+    path = target / REGION
+    if path.exists():
+        with open(path, 'rb') as f:
+            locations, timestamps = anvil.read_header(f)
+            for index, location in enumerate(locations):
+                if location[0]:
+                    chunks[index] = (timestamps[index], anvil.read_chunk(f, location))
+    files = {}
+    for path in target.rglob('*'):
+        rel = path.relative_to(target).as_posix()
+        if path.is_file() and rel != REGION:
+            files[rel] = (path.read_bytes(), path.stat().st_mtime_ns)
+    return chunks, files
+
+
+def _materialize(root, at, target):
+    with journal.open_state(root, at) as state:
+        assert state.time_ns == at
+        state.materialize(target)
+    return _read_back(target)
+
+
+@pytest.fixture
+def history(tmp_path):
+    """Three polls of a changing world, each in its own segment; returns (root, {point: snapshot})."""
+    world = World(tmp_path / 'server')
+    root = tmp_path / 'journal'
+    capture = journal.Journal(root, world.root, segment_size=1)
+    snapshots = {}
+
+    def poll():
+        assert capture.poll()['recorded']
+        snapshots[journal.recovery_points(root)[-1]] = world.snapshot()
+
+    try:
+        for index in (0, 1, 31, 1023):
+            world.set_chunk(index, 1000 + index)
+        world.write_region()
+        world.write_file('world/level.dat', b'level one')
+        world.write_file('world/playerdata/a.dat', b'player a')
+        poll()
+
+        world.set_chunk(1, 2001)
+        world.set_chunk(500, 2500)
+        del world.chunks[31]
+        world.write_region()
+        world.write_file('world/level.dat', b'level two')
+        world.write_file('world/playerdata/b.dat', b'player b')
+        poll()
+
+        world.set_chunk(0, 3000)
+        world.write_region()
+        world.remove_file('world/playerdata/a.dat')
+        poll()
+    finally:
+        capture.close()
+    return root, snapshots
+
+
+def test_every_point_round_trips(tmp_path, history):
+    root, snapshots = history
+    assert journal.recovery_points(root) == sorted(snapshots)
+    for number, (point, expected) in enumerate(sorted(snapshots.items())):
+        assert _materialize(root, point, tmp_path / f'point{number}') == expected
+
+
+def test_compaction_keeps_the_recent_points(tmp_path, history):
+    root, snapshots = history
+    points = sorted(snapshots)
+    assert journal.compact(root, 0) == 2
+    assert len(journal.list_segments(root)) == 2
+    assert journal.recovery_points(root) == points[1:]
+    for number, point in enumerate(points[1:]):
+        assert _materialize(root, point, tmp_path / f'point{number}') == snapshots[point]
+    with pytest.raises(journal.JournalError):
+        journal.open_state(root, points[0])
+
+
+def test_torn_tail_is_ignored(tmp_path, history):
+    root, snapshots = history
+    last = journal.list_segments(root)[-1]
+    with open(last, 'ab') as f:
+        f.write(journal._RECORD.pack(journal.CHUNK, len(REGION), 7, 4096, 0, 1) + REGION.encode() + b'torn')
+    point = max(snapshots)
+    assert journal.recovery_points(root) == sorted(snapshots)
+    assert _materialize(root, point, tmp_path / 'restored') == snapshots[point]
+
+
+def test_damaged_record(tmp_path, history):
+    root, snapshots = history
+    first = journal.list_segments(root)[0]
+    data = bytearray(first.read_bytes())
+    chunks, _ = snapshots[min(snapshots)]
+    data[data.index(chunks[0][1]) + 50] ^= 0xFF
+    first.write_bytes(data)
+    with pytest.raises(journal.JournalError):
+        _materialize(root, min(snapshots), tmp_path / 'restored')
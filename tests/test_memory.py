@@ -0,0 +1,71 @@
+"""
+Peak resident memory of the archive writers on a file much larger than
+their buffers. Each case runs in a fresh interpreter so that the kernel's
+high-water mark (VmHWM) belongs to it alone.
+"""
+
+import json
+import subprocess
+import sys
+from pathlib import Path
+
+import pytest
+
+import memlimit
+
+RESOURCES = Path(__file__).resolve().parent.parent / 'resources'
+FILE_SIZE = 256 * 2**20
+
+_RUN = '''
+import json, sys
+sys.path.insert(0, {resources!r})
+import memlimit, objstore, pipeline, seekable
+source, target = {source!r}, {target!r}
+baseline = memlimit.rss()
+memlimit.reset_peak()
+{body}
+print(json.dumps(memlimit.peak_rss() - baseline))
+'''
+
+
+@pytest.fixture(scope='module')
+def source(tmp_path_factory):
+    root = tmp_path_factory.mktemp('world')
+    with open(root / 'huge.dat', 'wb') as f:
+        f.truncate(FILE_SIZE)
+    return root
+
+
+def _peak_growth(source, target, body):
+    code = _RUN.format(resources=str(RESOURCES), source=str(source), target=str(target), body=body)
+    result = subprocess.run([sys.executable, '-c', code], capture_output=True, text=True, check=True)
+    return json.loads(result.stdout)
+
+
+pytestmark = pytest.mark.skipif(not memlimit.reset_peak(), reason='needs /proc/self/clear_refs')
+
+
+def test_pipeline(source, tmp_path):
+    growth = _peak_growth(source, tmp_path / 'a.tar.gz', '''
+pipeline.MEMORY_BUDGET = 16 * 2**20
+with pipeline.open_tar(target, workers=2) as tar:
+    tar.add(source + '/huge.dat', arcname='huge.dat')
+''')
+    assert growth < 32 * 2**20
+
+
+def test_seekable(source, tmp_path):
+    growth = _peak_growth(source, tmp_path / 'a.mcsa', '''
+with seekable.SeekableWriter(target, workers=1) as archive:
+    archive.add_file(source + '/huge.dat', 'huge.dat')
+''')
+    assert growth < 32 * 2**20
+
+
+def test_store(source, tmp_path):
+    growth = _peak_growth(source, tmp_path / 'store', '''
+store = objstore.ObjectStore(target)
+store.create_snapshot(source, 's1')
+store.close()
+''')
+    assert growth < 16 * 2**20
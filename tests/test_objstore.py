@@ -0,0 +1,215 @@
+import os
+import random
+import zlib
+
+import pytest
+
+import objstore
+import regionpack
+import worlds
+
+
+def _objects(store):
+    return {path.parent.name + path.name for path in store.objects_dir.glob('*/*')}
+
+
+def _live(store):
+    return {row[0] for row in store.db.execute('SELECT hash FROM objects')}
+
+
+def _restored(store, snapshot_id, target, contents):
+    store.restore_snapshot(snapshot_id, target)
+    return worlds.read_world(target, contents)
+
+
+def _touch(path, seconds):
+    os.utime(path, (seconds, seconds))
+
+
+@pytest.fixture
+def store(tmp_path):
+    store = objstore.ObjectStore(tmp_path / 'store')
+    yield store
+    store.close()
+
+
+def _edit(source, contents):
+    """Change one chunk and level.dat; return the new contents."""
+    rng = random.Random(1)
+    edited = dict(contents)
+    rel = 'world/region/r.0.0.mca'
+    region = dict(contents[rel])
+    index = min(region)
+    region[index] = (region[index][0] + 1, worlds.chunk(rng))
+    worlds.write_region(source / rel, region)
+    _touch(source / rel, 2_000_000_000)
+    edited[rel] = region
+    edited['world/level.dat'] = b'edited'
+    (source / 'world/level.dat').write_bytes(b'edited')
+    _touch(source / 'world/level.dat', 2_000_000_000)
+    return edited
+
+
+def test_put_deduplicates(store):
+    data = b'block' * 1000
+    digest, stored = store.put(data)
+    assert stored > 0
+    assert store.put(data) == (digest, 0)
+    assert store.get(digest) == data
+    assert _objects(store) == {digest}
+
+
+def test_snapshots_round_trip_and_share_objects(tmp_path, store):
+    source = tmp_path / 'server'
+    first = worlds.make_world(source)
+    store.create_snapshot(source, 's1')
+    objects = _objects(store)
+    second = _edit(source, first)
+    store.create_snapshot(source, 's2')
+    # The changed chunk, the new table of its region and level.dat.
+    assert len(_objects(store) - objects) == 3
+    assert _objects(store) == _live(store)
+    assert _restored(store, 's1', tmp_path / 'r1', first) == first
+    assert _restored(store, 's2', tmp_path / 'r2', second) == second
+
+
+def test_prune_drops_only_unshared_objects(tmp_path, store):
+    source = tmp_path / 'server'
+    first = worlds.make_world(source)
+    store.create_snapshot(source, 's1')
+    second = _edit(source, first)
+    store.create_snapshot(source, 's2')
+    objects = _objects(store)
+    store.db.execute("UPDATE snapshots SET created = '2000-01-01T00:00:00' WHERE id = 's1'")
+    store.db.commit()
+    store.prune(1)
+    assert store.snapshot_ids() == ['s2']
+    # The old version of the chunk, its region's table and level.dat.
+    assert len(objects - _objects(store)) == 3
+    assert _objects(store) == _live(store)
+    assert all(refs == 1 for refs, in store.db.execute('SELECT refs FROM objects'))
+    assert _restored(store, 's2', tmp_path / 'r2', second) == second
+
+
+def test_prune_keeps_the_newest_snapshot(tmp_path, store):
+    source = tmp_path / 'server'
+    worlds.make_world(source)
+    store.create_snapshot(source, 's1')
+    store.db.execute("UPDATE snapshots SET created = '2000-01-01T00:00:00'")
+    store.db.commit()
+    store.prune(1)
+    assert store.snapshot_ids() == ['s1']
+
+
+class _FailingSelector:
+    def choose(self, rel, f, size):
+        if rel == 'world/playerdata/a.dat':
+            raise OSError('disk on fire')
+        return objstore.DEFAULT_CODEC
+
+
+def test_failed_snapshot_removes_its_objects(tmp_path, store):
+    source = tmp_path / 'server'
+    first = worlds.make_world(source)
+    store.create_snapshot(source, 's1')
+    objects = _objects(store)
+    _edit(source, first)
+    (source / 'world/playerdata/a.dat').write_bytes(b'changed')
+    with pytest.raises(OSError):
+        store.create_snapshot(source, 's2', selector=_FailingSelector())
+    assert store.snapshot_ids() == ['s1']
+    assert _objects(store) == objects
+    assert not (store.root / objstore.WRITING_MARKER).exists()
+    assert list(store.snapshots_dir.iterdir()) == [store.snapshots_dir / 's1.json.gz']
+
+
+def test_crash_is_swept_before_the_next_snapshot(tmp_path, store):
+    source = tmp_path / 'server'
+    worlds.make_world(source)
+    store.create_snapshot(source, 's1')
+    objects = _objects(store)
+    # What a crash in the middle of s2 leaves behind.
+    stray, _ = store.put(b'stray object')
+    (store.snapshots_dir / 's2.json.gz.partial').write_bytes(b'half a manifest')
+    (store.root / objstore.WRITING_MARKER).write_text('s2')
+    store.prune(30)
+    assert stray in _objects(store)
+    store.create_snapshot(source, 's3')
+    assert stray not in _objects(store)
+    assert _objects(store) == objects
+    assert sorted(path.name for path in store.snapshots_dir.iterdir()) == ['s1.json.gz', 's3.json.gz']
+
+
+def test_readers_opening_the_store_keep_a_snapshot_being_written(tmp_path, store, monkeypatch):
+    source = tmp_path / 'server'
+    contents = worlds.make_world(source)
+    add_refs = store._add_refs
+
+    def open_meanwhile(refs):
+        objstore.ObjectStore(store.root).close()
+        add_refs(refs)
+        objstore.ObjectStore(store.root).close()
+
+    monkeypatch.setattr(store, '_add_refs', open_meanwhile)
+    store.create_snapshot(source, 's1')
+    assert _restored(store, 's1', tmp_path / 'restored', contents) == contents
+
+
+def test_manifest_committed_before_a_crash_is_published(tmp_path, store):
+    source = tmp_path / 'server'
+    contents = worlds.make_world(source)
+    store.create_snapshot(source, 's1')
+    manifest = store.snapshots_dir / 's1.json.gz'
+    manifest.rename(manifest.with_name('s1.json.gz.partial'))
+    reopened = objstore.ObjectStore(store.root)
+    try:
+        assert _restored(reopened, 's1', tmp_path / 'restored', contents) == contents
+    finally:
+        reopened.close()
+
+
+def _versions(count):
+    """Payloads of one chunk where a few bytes change between versions."""
+    rng = random.Random(5)
+    raw = bytearray(zlib.decompress(worlds.chunk(rng, 20000)[1:]))
+    payloads = []
+    for _ in range(count):
+        for _ in range(4):
+            raw[rng.randrange(len(raw))] = rng.randrange(256)
+        payloads.append(bytes([regionpack.CHUNK_ZLIB]) + zlib.compress(bytes(raw)))
+    return payloads
+
+
+def _depth(store, digest):
+    encoded = store._read_object(digest)
+    return objstore._DELTA_HEADER.unpack_from(encoded)[3] if encoded[0] == objstore.DELTA_TAG else 0
+
+
+def test_chunk_deltas_are_rebased_at_the_depth_limit(tmp_path):
+    store = objstore.ObjectStore(tmp_path / 'store', chunk_delta_depth=3)
+    try:
+        base, depths = None, []
+        payloads = _versions(9)
+        digests = []
+        for payload in payloads:
+            base, stored = store.put_chunk(payload, base)
+            assert stored > 0
+            digests.append(base)
+            depths.append(_depth(store, base))
+        assert depths == [0, 1, 2, 3, 0, 1, 2, 3, 0]
+        assert store.delta_chunks == 6
+        delta_size = os.path.getsize(store._object_path(digests[1]))
+        assert delta_size < len(payloads[1]) * objstore.CHUNK_DELTA_MAX_RATIO
+        # The NBT is deflated again at the server's level, which here gives the original bytes.
+        assert [store.get(digest) for digest in digests] == payloads
+    finally:
+        store.close()
+
+
+def test_chunk_deltas_are_off_by_default(tmp_path, store):
+    payloads = _versions(3)
+    base = None
+    for payload in payloads:
+        base, _ = store.put_chunk(payload, base)
+        assert _depth(store, base) == 0
+    assert store.delta_chunks == 0
@@ -0,0 +1,81 @@
+import gzip
+import io
+import random
+import shutil
+import subprocess
+import tarfile
+import zlib
+
+import pytest
+
+import parallel_gzip
+import pipeline
+
+BLOCK = 64 * 1024
+
+
+def _data(seed, size):
+    rng = random.Random(seed)
+    words = [rng.randbytes(rng.randint(2, 9)) for _ in range(256)]
+    return b''.join(rng.choice(words) for _ in range(size // 5))[:size]
+
+
+def _members(raw):
+    """Decompressed gzip members of raw, in order."""
+    members = []
+    while raw:
+        d = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        members.append(d.decompress(raw) + d.flush())
+        raw = d.unused_data
+    return members
+
+
+def _compress(data, workers, levels=()):
+    out = io.BytesIO()
+    with pipeline.PipelineWriter(out, workers=workers, block_size=BLOCK) as writer:
+        for offset in range(0, len(data), 100_000):
+            if offset in levels:
+                writer.set_level(levels[offset])
+            writer.write(data[offset:offset + 100_000])
+    return out.getvalue()
+
+
+def test_blocks_are_independent_gzip_members():
+    data = _data(1, 10 * BLOCK + 123)
+    raw = _compress(data, workers=4)
+    members = _members(raw)
+    assert len(members) == 11
+    assert b''.join(members) == data
+    assert gzip.decompress(raw) == data
+
+
+def test_output_does_not_depend_on_the_worker_count():
+    data = _data(2, 20 * BLOCK)
+    levels = {0: 1, 500_000: 0, 1_000_000: 9}
+    assert _compress(data, 1, levels) == _compress(data, 4, levels)
+
+
+def test_compress_block_is_one_member():
+    data = _data(3, 5000)
+    member = parallel_gzip.compress_block(data, 9)
+    assert gzip.decompress(member + parallel_gzip.compress_block(b'tail', 0)) == data + b'tail'
+    assert len(parallel_gzip.compress_block(data, 0)) > len(data)
+
+
+@pytest.mark.skipif(shutil.which('gzip') is None, reason='gzip is not installed')
+def test_gzip_and_tarfile_read_a_multi_member_archive(tmp_path):
+    files = {f'world/data/{i}.dat': _data(i, 40_000) for i in range(8)}
+    for rel, data in files.items():
+        (tmp_path / 'src' / rel).parent.mkdir(parents=True, exist_ok=True)
+        (tmp_path / 'src' / rel).write_bytes(data)
+    archive = tmp_path / 'backup.tar.gz'
+    with pipeline.open_tar(archive, workers=3, block_size=BLOCK) as tar:
+        for rel in files:
+            tar.add(tmp_path / 'src' / rel, arcname=rel)
+    assert len(_members(archive.read_bytes())) > 1
+    subprocess.run(['gzip', '-t', str(archive)], check=True)
+    plain = subprocess.run(['gzip', '-dc', str(archive)], check=True, capture_output=True).stdout
+    with tarfile.open(fileobj=io.BytesIO(plain)) as tar:
+        assert {m.name: tar.extractfile(m).read() for m in tar if m.isfile()} == files
+    with tarfile.open(archive, 'r:gz') as tar:
+        assert {m.name: tar.extractfile(m).read() for m in tar if m.isfile()} == files
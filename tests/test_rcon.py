@@ -0,0 +1,116 @@
+import asyncio
+import struct
+
+import pytest
+
+import rcon
+
+PASSWORD = 'secret'
+
+
+class FakeServer:
+    """
+    Answers like the vanilla RCON handler: one packet is parsed per socket
+    read and whatever else the read returned is dropped; long responses are
+    split into 4096-byte packets.
+    """
+
+    def __init__(self):
+        self.connections = 0
+        self.commands = []
+
+    async def start(self):
+        self.server = await asyncio.start_server(self._handle, '127.0.0.1', 0)
+        return self.server.sockets[0].getsockname()[1]
+
+    def close(self):
+        self.server.close()
+
+    async def _handle(self, reader, writer):
+        self.connections += 1
+
+        def send(request_id, packet_type, payload):
+            body = struct.pack('<ii', request_id, packet_type) + payload.encode() + b'\0\0'
+            writer.write(struct.pack('<i', len(body)) + body)
+
+        while True:
+            data = await reader.read(4096)
+            if not data:
+                break
+            size, request_id, packet_type = struct.unpack_from('<iii', data)
+            payload = data[12:4 + size - 2].decode()
+            if packet_type == rcon.SERVERDATA_AUTH:
+                send(request_id if payload == PASSWORD else -1, rcon.SERVERDATA_EXECCOMMAND, '')
+            elif packet_type == rcon.SERVERDATA_EXECCOMMAND:
+                self.commands.append(payload)
+                if payload == 'die':
+                    break
+                if payload.startswith('sleep'):
+                    await asyncio.sleep(float(payload.split()[1]))
+                text = 'x' * 10000 if payload == 'big' else f'ran {payload}'
+                for start in range(0, len(text), 4096):
+                    send(request_id, rcon.SERVERDATA_RESPONSE_VALUE, text[start:start + 4096])
+            else:
+                send(request_id, rcon.SERVERDATA_RESPONSE_VALUE, f'Unknown request {packet_type:x}')
+            await writer.drain()
+        writer.close()
+
+
+def run(test):
+    async def main():
+        server = FakeServer()
+        port = await server.start()
+        client = rcon.RconClient('127.0.0.1', port, PASSWORD, timeout=2.0)
+        try:
+            await test(server, client)
+        finally:
+            await client.close()
+            server.close()
+    asyncio.run(main())
+
+
+def test_multi_packet_response():
+    async def test(server, client):
+        assert await client.command('big') == 'x' * 10000
+        assert await client.command('list') == 'ran list'
+    run(test)
+
+
+def test_concurrent_commands_get_their_own_response():
+    async def test(server, client):
+        commands = [f'say {i}' for i in range(8)] + ['big']
+        responses = await asyncio.gather(*(client.command(c) for c in commands))
+        assert responses == [f'ran say {i}' for i in range(8)] + ['x' * 10000]
+        assert sorted(server.commands) == sorted(commands)
+    run(test)
+
+
+def test_timeout_does_not_mix_responses():
+    async def test(server, client):
+        with pytest.raises(rcon.RconError):
+            await client.command('sleep 0.5', timeout=0.2)
+        assert await client.command('list') == 'ran list'
+        assert await client.command('sleep 0.1', timeout=2) == 'ran sleep 0.1'
+        assert server.commands.count('sleep 0.5') == 1
+    run(test)
+
+
+def test_reconnect_after_connection_loss():
+    async def test(server, client):
+        assert await client.command('list') == 'ran list'
+        with pytest.raises(rcon.RconConnectionError):
+            await client.command('die')
+        assert await client.command('list') == 'ran list'
+        assert server.connections == 2
+        assert server.commands.count('die') == 1
+    run(test)
+
+
+def test_wrong_password():
+    async def test(server, client):
+        client.password = 'wrong'
+        client.max_reconnect_delay = 0
+        with pytest.raises(rcon.RconConnectionError):
+            await client.command('list', retries=0)
+        assert server.commands == []
+    run(test)
@@ -0,0 +1,120 @@
+import io
+import os
+import random
+import zlib
+
+import pytest
+
+import anvil
+import codec
+import regionpack
+import worlds
+
+
+def _pack(data, tag=codec.TAG_XZ):
+    packed = io.BytesIO()
+    stats = regionpack.pack_region(io.BytesIO(data), packed, tag)
+    packed.seek(0)
+    return packed, stats
+
+
+def _unpack(packed):
+    out = io.BytesIO()
+    chunks = regionpack.unpack_region(packed, out)
+    return out.getvalue(), chunks
+
+
+def _entries(packed):
+    """{index: flags} of a packed region."""
+    packed.seek(regionpack._HEADER.size)
+    reader = regionpack._stream_reader(packed, codec.TAG_XZ)
+    regionpack._read_exact(reader, anvil.HEADER_SIZE)
+    flags = {}
+    while entry := regionpack._read_exact(reader, regionpack._ENTRY.size):
+        index, _, flag, length = regionpack._ENTRY.unpack(entry)
+        regionpack._read_exact(reader, length)
+        flags[index] = flag
+    packed.seek(0)
+    return flags
+
+
+def _region(tmp_path, chunks):
+    path = tmp_path / 'r.0.0.mca'
+    worlds.write_region(path, chunks)
+    return path.read_bytes()
+
+
+def test_exact_chunks_come_back_byte_for_byte(tmp_path):
+    rng = random.Random(0)
+    chunks = {index: (1000 + index, worlds.chunk(rng)) for index in rng.sample(range(1024), 60)}
+    data = _region(tmp_path, chunks)
+    packed, stats = _pack(data)
+    assert stats == {'chunks': 60, 'exact': 60, 'raw_bytes': stats['raw_bytes']}
+    assert len(packed.getvalue()) < len(data)
+    assert all(flags & regionpack.FLAG_EXACT and flags & regionpack.FLAG_INFLATED
+               for flags in _entries(packed).values())
+    assert _unpack(packed) == (data, 60)
+
+
+def test_inexact_and_unknown_chunks_keep_their_content(tmp_path):
+    rng = random.Random(1)
+    raw = worlds.chunk(rng, 20000)
+    raw = zlib.decompress(raw[1:])
+    chunks = {
+        0: (10, worlds.chunk(rng)),
+        # Compressed at a level the packer does not reproduce.
+        1: (11, bytes([regionpack.CHUNK_ZLIB]) + zlib.compress(raw, 1)),
+        2: (12, bytes([regionpack.CHUNK_GZIP]) + regionpack.deflate_chunk(regionpack.CHUNK_GZIP, raw, 6)),
+        # Uncompressed NBT is kept as it is.
+        3: (13, bytes([3]) + raw[:5000]),
+        5: (15, worlds.chunk(rng)),
+    }
+    data = _region(tmp_path, chunks)
+    packed, stats = _pack(data)
+    flags = _entries(packed)
+    assert not flags[1] & regionpack.FLAG_EXACT
+    assert flags[2] & regionpack.FLAG_EXACT
+    assert flags[3] == 0
+    assert stats['chunks'] == 5 and stats['exact'] == 3
+
+    path = tmp_path / 'restored.mca'
+    out, count = _unpack(packed)
+    path.write_bytes(out)
+    assert count == 5
+    restored = worlds.read_region(path)
+    assert restored.keys() == chunks.keys()
+    for index, (timestamp, payload) in chunks.items():
+        assert restored[index][0] == timestamp
+        if index == 1:
+            # Recompressed at level 6: other bytes, the same NBT.
+            assert zlib.decompress(restored[index][1][1:]) == raw
+        else:
+            assert restored[index][1] == payload
+    with open(path, 'rb') as f:
+        locations, _ = anvil.read_header(f)
+    sectors = [set(range(s, s + n)) for s, n in locations if s]
+    assert sum(map(len, sectors)) == len(set().union(*sectors))
+    assert len(out) % anvil.SECTOR_SIZE == 0
+
+
+def test_unpack_file_restores_the_region_and_mtime(tmp_path):
+    rng = random.Random(2)
+    data = _region(tmp_path, {i: (i + 1, worlds.chunk(rng)) for i in range(8)})
+    packed_path = tmp_path / 'world' / 'region' / ('r.0.0.mca' + regionpack.PACKED_SUFFIX)
+    packed_path.parent.mkdir(parents=True)
+    packed_path.write_bytes(_pack(data)[0].getvalue())
+    os.utime(packed_path, (1_700_000_000, 1_700_000_000))
+    target = regionpack.unpack_file(packed_path)
+    assert target.name == 'r.0.0.mca'
+    assert target.read_bytes() == data
+    assert target.stat().st_mtime == 1_700_000_000
+    assert not packed_path.exists()
+
+
+def test_damaged_packed_regions_are_rejected(tmp_path):
+    data = _region(tmp_path, {0: (1, worlds.chunk(random.Random(3)))})
+    with pytest.raises(regionpack.PackError):
+        _unpack(io.BytesIO(b'NOPE' + data))
+    packed = _pack(data)[0].getvalue()
+    with pytest.raises((regionpack.PackError, EOFError, OSError)):
+        _unpack(io.BytesIO(packed[:len(packed) // 2]))
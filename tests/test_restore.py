@@ -0,0 +1,90 @@
+import random
+
+import pytest
+
+import anvil
+import regionpack
+import restore
+import worlds
+
+REL = 'world/region/r.0.0.mca'
+
+
+class _Snapshot:
+    """A backup holding some chunks of REL, {index: (timestamp, payload)}."""
+
+    id = 'test'
+
+    def __init__(self, chunks):
+        self.chunks = chunks
+
+    def read_chunks(self, rel, indices):
+        return {i: self.chunks[i] for i in indices if rel == REL and i in self.chunks}
+
+
+@pytest.fixture
+def region(tmp_path):
+    rng = random.Random(0)
+    chunks = {index: (1000 + index, worlds.chunk(rng, 6000)) for index in (0, 1, 2, 40, 41)}
+    path = tmp_path / REL
+    worlds.write_region(path, chunks)
+    return path, chunks
+
+
+def _header(path):
+    with open(path, 'rb') as f:
+        return anvil.read_header(f)
+
+
+def test_write_in_place_keeps_the_sector_map(region):
+    path, chunks = region
+    locations, _ = _header(path)
+    size = path.stat().st_size
+    smaller = bytes([regionpack.CHUNK_ZLIB]) + b'x' * 100
+    restore._write_in_place(path, {1: (7, smaller), 40: (8, chunks[40][1])})
+    assert _header(path)[0] == locations
+    assert path.stat().st_size == size
+    expected = {**chunks, 1: (7, smaller), 40: (8, chunks[40][1])}
+    assert worlds.read_region(path) == expected
+
+
+def test_rewrite_region_moves_grown_chunks_and_drops_removed(region):
+    path, chunks = region
+    rng = random.Random(1)
+    grown = worlds.chunk(rng, 20000)
+    restore._rewrite_region(path, {2: (9, grown), 100: (10, chunks[0][1])}, {41})
+    expected = {0: chunks[0], 1: chunks[1], 2: (9, grown), 40: chunks[40], 100: (10, chunks[0][1])}
+    assert worlds.read_region(path) == expected
+    assert not path.with_name(path.name + '.partial').exists()
+
+
+def test_rewrite_region_creates_a_missing_region(tmp_path):
+    path = tmp_path / REL
+    payload = worlds.chunk(random.Random(2))
+    restore._rewrite_region(path, {5: (11, payload)}, set())
+    assert worlds.read_region(path) == {5: (11, payload)}
+
+
+def test_restore_chunks_online_refuses_chunks_that_do_not_fit(tmp_path, region):
+    path, chunks = region
+    before = path.read_bytes()
+    grown = worlds.chunk(random.Random(3), 20000)
+    with pytest.raises(restore.RestoreError, match='does not fit'):
+        restore.restore_chunks(_Snapshot({0: (5, grown)}), tmp_path, 'world/region', 0, 0, 1, 0)
+    assert path.read_bytes() == before
+
+    restored = restore.restore_chunks(_Snapshot({0: (5, grown)}), tmp_path, 'world/region', 0, 0, 1, 0,
+                                      offline=True)
+    assert restored == {REL: [0]}
+    # Offline, chunks missing from the backup are deleted.
+    assert worlds.read_region(path) == {0: (5, grown), 2: chunks[2], 40: chunks[40], 41: chunks[41]}
+
+
+def test_save_control_lock_is_exclusive(tmp_path):
+    first = restore.SaveControlLock(tmp_path)
+    second = restore.SaveControlLock(tmp_path)
+    assert first.acquire()
+    assert not second.acquire()
+    first.release()
+    assert second.acquire()
+    second.release()
@@ -0,0 +1,105 @@
+import json
+import threading
+import time
+from datetime import datetime
+
+import pytest
+
+import scheduler
+
+
+def _next(expression, after):
+    return scheduler.CronExpression(expression).next_after(datetime.fromisoformat(after)).isoformat()
+
+
+def test_cron_fields():
+    cron = scheduler.CronExpression('*/15 2-4,22 * * 1-5')
+    assert cron.minutes == {0, 15, 30, 45}
+    assert cron.hours == {2, 3, 4, 22}
+    # Cron counts weekdays from Sunday = 0, datetime from Monday = 0.
+    assert cron.weekdays == {0, 1, 2, 3, 4}
+    assert scheduler.CronExpression('0 0 * * 0').weekdays == scheduler.CronExpression('0 0 * * 7').weekdays == {6}
+    assert scheduler.CronExpression('5/20 * * * *').minutes == {5, 25, 45}
+
+
+def test_cron_next_after():
+    assert _next('0 */2 * * *', '2026-10-18T10:00:00') == '2026-10-18T12:00:00'
+    assert _next('0 */2 * * *', '2026-10-18T10:59:59') == '2026-10-18T12:00:00'
+    assert _next('30 3 * * *', '2026-12-31T04:00:00') == '2027-01-01T03:30:00'
+    assert _next('0 0 29 2 *', '2026-03-01T00:00:00') == '2028-02-29T00:00:00'
+    # 2026-10-18 is a Sunday; a restricted day and weekday match either way.
+    assert _next('0 12 * * 1', '2026-10-18T13:00:00') == '2026-10-19T12:00:00'
+    assert _next('0 12 20 * 0', '2026-10-18T13:00:00') == '2026-10-20T12:00:00'
+
+
+@pytest.mark.parametrize('expression', ['* * * *', '60 * * * *', '* 24 * * *', '* * 0 * *',
+                                        '*/0 * * * *', '5-1 * * * *', '0 0 31 2 *'])
+def test_cron_rejects_bad_expressions(expression):
+    with pytest.raises(scheduler.CronError):
+        scheduler.CronExpression(expression).next_after(datetime(2026, 1, 1))
+
+
+def _due(jobs, name):
+    return [entry for entry in jobs._heap if entry[4].name == name]
+
+
+def test_missed_run_catches_up_once(tmp_path):
+    state = tmp_path / 'scheduler.json'
+    now = time.time()
+    state.write_text(json.dumps({'missed': now - 10 * 3600, 'recent': now - 600}))
+    jobs = scheduler.Scheduler(state)
+    try:
+        jobs.add_job('missed', lambda: None, interval=3600)
+        jobs.add_job('recent', lambda: None, interval=3600)
+        jobs.add_job('new', lambda: None, interval=3600)
+        (run_at, _, _, _, _), = _due(jobs, 'missed')
+        assert run_at <= time.time()
+        (run_at, _, _, _, _), = _due(jobs, 'recent')
+        assert run_at == pytest.approx(now + 3000, abs=1)
+        (run_at, _, _, _, _), = _due(jobs, 'new')
+        assert run_at == pytest.approx(now + 3600, abs=1)
+    finally:
+        jobs.stop()
+
+
+def test_retry_later_defers_without_recording_a_run(tmp_path):
+    state = tmp_path / 'scheduler.json'
+
+    def busy():
+        raise scheduler.RetryLater(300, 'busy')
+
+    jobs = scheduler.Scheduler(state)
+    try:
+        job = jobs.add_job('busy', busy, interval=3600)
+        jobs._heap.clear()
+        job.running = True
+        jobs._run_job(job)
+        assert not job.running
+        assert job.last_run is None
+        assert not state.exists()
+        (run_at, _, due, retry, _), = jobs._heap
+        assert retry and run_at == due
+        assert run_at == pytest.approx(time.time() + 300, abs=1)
+
+        job.func = lambda: None
+        jobs._run_job(job)
+        assert json.loads(state.read_text())['busy'] == job.last_run
+    finally:
+        jobs.stop()
+
+
+def test_long_jobs_do_not_hold_up_short_ones(tmp_path):
+    release = threading.Event()
+    polls = []
+    jobs = scheduler.Scheduler(max_workers=1, long_workers=1)
+    jobs.add_job('backup', lambda: release.wait(5), interval=0.01, long=True)
+    jobs.add_job('poll', lambda: polls.append(time.monotonic()), interval=0.02)
+    jobs.start()
+    try:
+        deadline = time.monotonic() + 5
+        while len(polls) < 3 and time.monotonic() < deadline:
+            time.sleep(0.01)
+        assert len(polls) >= 3
+    finally:
+        release.set()
+        jobs.stop()
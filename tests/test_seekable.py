@@ -0,0 +1,65 @@
+import io
+import random
+
+import pytest
+
+import codec
+import seekable
+
+
+class _Failing(io.RawIOBase):
+    """A stream that breaks after a few blocks."""
+
+    def __init__(self, size):
+        self.left = size
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        if self.left <= 0:
+            raise OSError('read failed')
+        n = min(len(b), self.left)
+        b[:n] = bytes(n)
+        self.left -= n
+        return n
+
+
+def _partials(tmp_path):
+    return list(tmp_path.glob('*.partial'))
+
+
+def test_members_round_trip(tmp_path):
+    rng = random.Random(0)
+    data = {'world/level.dat': rng.randbytes(3000), 'world/data/big.dat': bytes(10_000) + rng.randbytes(5000)}
+    path = tmp_path / ('a' + seekable.SUFFIX)
+    with seekable.SeekableWriter(path, workers=2, block_size=4096) as archive:
+        for rel, content in data.items():
+            archive.add_stream(rel, io.BytesIO(content), 1_700_000_000 * 10**9, chosen=codec.get('zlib-6'))
+    assert not _partials(tmp_path)
+    with seekable.SeekableArchive(path) as archive:
+        assert archive.names() == list(data)
+        for rel, content in data.items():
+            assert archive.read(rel) == content
+        assert archive.select(['world/data']) == ['world/data/big.dat']
+
+
+def test_a_failing_stream_leaves_no_partial(tmp_path):
+    path = tmp_path / ('a' + seekable.SUFFIX)
+    archive = seekable.SeekableWriter(path, workers=2, block_size=4096)
+    archive.add_stream('ok.dat', io.BytesIO(b'fine'), 0)
+    with pytest.raises(OSError):
+        archive.add_stream('broken.dat', _Failing(20_000), 0)
+    assert not _partials(tmp_path)
+    archive.close()
+    assert not path.exists()
+
+
+def test_a_failing_close_leaves_no_partial(tmp_path):
+    # A directory in the way of the final rename.
+    path = tmp_path / ('a' + seekable.SUFFIX)
+    (path / 'occupied').mkdir(parents=True)
+    with pytest.raises(OSError):
+        with seekable.SeekableWriter(path, workers=1) as archive:
+            archive.add_stream('ok.dat', io.BytesIO(b'fine'), 0)
+    assert not _partials(tmp_path)
@@ -0,0 +1,82 @@
+import os
+import random
+import tarfile
+
+import incremental
+import worlds
+
+DELTA_MIN = 64 * 1024
+
+
+def _touch(path, seconds):
+    os.utime(path, (seconds, seconds))
+
+
+def _extract(archive, target):
+    with tarfile.open(archive, 'r:gz') as tar:
+        tar.extractall(target, filter='data')
+    return {path.relative_to(target).as_posix() for path in target.rglob('*') if path.is_file()}
+
+
+def _edit_region(source, rel, contents, rng, change=(), delete=(), seconds=2_000_000_000):
+    region = dict(contents[rel])
+    for index in change:
+        region[index] = (region[index][0] + 1, worlds.chunk(rng))
+    for index in delete:
+        del region[index]
+    worlds.write_region(source / rel, region)
+    _touch(source / rel, seconds)
+    contents[rel] = region
+
+
+def _write(source, rel, data, seconds):
+    (source / rel).parent.mkdir(parents=True, exist_ok=True)
+    (source / rel).write_bytes(data)
+    _touch(source / rel, seconds)
+
+
+def test_synthetic_full_matches_a_fresh_full_backup(tmp_path):
+    rng = random.Random(0)
+    source = tmp_path / 'data'
+    archive_dir = tmp_path / 'chain'
+    big = rng.randbytes(400 * 1024)
+    contents = worlds.make_world(source, files={
+        'world/level.dat': rng.randbytes(3000),
+        'world/playerdata/a.dat': rng.randbytes(500),
+        'world/data/big.dat': big,
+    })
+    previous = incremental.create_backup(source, archive_dir, '20260101-000000', delta_min_size=DELTA_MIN)
+
+    r0, r1 = 'world/region/r.0.0.mca', 'world/region/r.1.0.mca'
+    _edit_region(source, r0, contents, rng, change=sorted(contents[r0])[:3])
+    _edit_region(source, r1, contents, rng, delete=sorted(contents[r1])[:2])
+    new_region = 'world/region/r.2.0.mca'
+    worlds.write_region(source / new_region, {7: (5000, worlds.chunk(rng))})
+    _write(source, 'world/level.dat', b'level 1', 2_000_000_000)
+    _write(source, 'world/data/big.dat', big[:1000] + b'changed in place' + big[1016:], 2_000_000_000)
+    (source / 'world/playerdata/a.dat').unlink()
+    _write(source, 'world/playerdata/b.dat', b'new player', 2_000_000_000)
+    previous = incremental.create_backup(source, archive_dir, '20260101-010000', previous,
+                                         delta_min_size=DELTA_MIN)
+    assert previous['changes']['deltas'] == ['world/data/big.dat']
+
+    _edit_region(source, r0, contents, rng, change=sorted(contents[r0])[1:5], seconds=2_000_000_100)
+    _write(source, 'world/level.dat', b'level 2', 2_000_000_100)
+    incremental.create_backup(source, archive_dir, '20260101-020000', previous, delta_min_size=DELTA_MIN)
+
+    synthetic = incremental.synthesize_full(archive_dir, delta_min_size=DELTA_MIN)
+    fresh = incremental.create_backup(source, tmp_path / 'fresh', '20260101-020000')
+    assert synthetic['kind'] == 'synthetic' and synthetic['id'] == fresh['id']
+    assert synthetic['files'] == fresh['files']
+    assert {rel: entry[2] for rel, entry in synthetic['regions'].items()} == \
+        {rel: entry[2] for rel, entry in fresh['regions'].items()}
+
+    names = _extract(archive_dir / synthetic['archive'], tmp_path / 'from-synthetic')
+    assert names == _extract(tmp_path / 'fresh' / fresh['archive'], tmp_path / 'from-fresh')
+    for rel in names:
+        if rel.endswith('.mca'):
+            assert worlds.read_region(tmp_path / 'from-synthetic' / rel) == worlds.read_region(source / rel)
+        else:
+            assert (tmp_path / 'from-synthetic' / rel).read_bytes() == (source / rel).read_bytes()
+    assert (archive_dir / incremental.signatures_name(synthetic['id'], 'synthetic')).exists()
+    assert incremental.synthesize_full(archive_dir) is None
@@ -0,0 +1,92 @@
+import os
+import random
+import tarfile
+
+import pytest
+
+import pipeline
+import tarindex
+
+SPAN = 64 * 1024
+
+
+def _payload(seed, size):
+    """Compressible but not trivially repetitive data."""
+    rng = random.Random(seed)
+    words = [rng.randbytes(rng.randint(3, 12)) for _ in range(512)]
+    data = bytearray()
+    while len(data) < size:
+        data += rng.choice(words)
+    return bytes(data[:size])
+
+
+@pytest.fixture
+def source(tmp_path):
+    root = tmp_path / 'world'
+    sizes = {'level.dat': 1500, 'region/r.0.0.mca': 700 * 1024, 'region/r.0.-1.mca': 300 * 1024,
+             'empty.json': 0, 'playerdata/a.dat': 90 * 1024}
+    for number, (rel, size) in enumerate(sizes.items()):
+        path = root / rel
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.write_bytes(_payload(number, size))
+    return root
+
+
+def _check_round_trip(archive, span=SPAN):
+    index = tarindex.build_index(archive, span)
+    assert tarindex.sidecar_path(archive).exists()
+    assert len(index['points']) > 1
+    loaded = tarindex.load_index(archive)
+    assert loaded is not None
+    with tarfile.open(archive, 'r:gz') as tar:
+        members = tar.getmembers()
+        assert [m['name'] for m in loaded['members']] == [m.name for m in members]
+        for member in filter(tarfile.TarInfo.isfile, members):
+            expected = tar.extractfile(member).read()
+            assert b''.join(tarindex.iter_member(archive, loaded, member.name)) == expected
+
+
+def test_single_stream_archive(tmp_path, source):
+    archive = tmp_path / 'backup.tar.gz'
+    with tarfile.open(archive, 'w:gz') as tar:
+        tar.add(source, arcname='world')
+    _check_round_trip(archive)
+
+
+def test_pipeline_archive(tmp_path, source):
+    archive = tmp_path / 'backup.tar.gz'
+    with pipeline.open_tar(archive, workers=2, block_size=128 * 1024) as tar:
+        tar.add(source, arcname='world')
+    _check_round_trip(archive)
+
+
+def test_extract(tmp_path, source):
+    archive = tmp_path / 'backup.tar.gz'
+    with tarfile.open(archive, 'w:gz') as tar:
+        tar.add(source, arcname='world')
+    index = tarindex.build_index(archive, SPAN)
+    names = ['world/region/r.0.-1.mca', 'world/level.dat']
+    tarindex.extract(archive, index, names, tmp_path / 'out')
+    for name in names:
+        assert (tmp_path / 'out' / name).read_bytes() == (source / name.split('/', 1)[1]).read_bytes()
+
+
+def test_stale_index_is_ignored(tmp_path, source):
+    archive = tmp_path / 'backup.tar.gz'
+    with tarfile.open(archive, 'w:gz') as tar:
+        tar.add(source / 'level.dat', arcname='world/level.dat')
+    tarindex.build_index(archive, SPAN)
+    with tarfile.open(archive, 'w:gz') as tar:
+        tar.add(source, arcname='world')
+    os.utime(archive, ns=(0, 0))
+    assert tarindex.load_index(archive) is None
+    _check_round_trip(archive)
+
+
+def test_unknown_member(tmp_path, source):
+    archive = tmp_path / 'backup.tar.gz'
+    with tarfile.open(archive, 'w:gz') as tar:
+        tar.add(source / 'level.dat', arcname='world/level.dat')
+    index = tarindex.build_index(archive, SPAN)
+    with pytest.raises(tarindex.TarIndexError):
+        list(tarindex.iter_member(archive, index, 'world/missing.dat'))
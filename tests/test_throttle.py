@@ -0,0 +1,57 @@
+import logging
+
+import throttle
+
+
+def _forge_tps(mspt):
+    return f'Overall : Mean tick time: {mspt:.3f} ms. Mean TPS: {min(20.0, 1000 / mspt):.3f}'
+
+
+def _sampler(responses, governor=None):
+    responses = iter(responses)
+
+    def command(text):
+        assert text == 'forge tps'
+        response = next(responses)
+        if isinstance(response, Exception):
+            raise response
+        return response
+
+    return throttle.TpsSampler(command, governor=governor)
+
+
+def _messages(caplog, level):
+    return [r.getMessage() for r in caplog.records if r.name == 'throttle' and r.levelno == level]
+
+
+def test_parse_forge_tps():
+    text = ('Dim  0 (overworld) : Mean tick time: 12.500 ms. Mean TPS: 20.000\n'
+            'Dim -1 (the_nether) : Mean tick time: 61.000 ms. Mean TPS: 16.393\n')
+    assert throttle.parse_forge_tps(text) == (61.0, 16.393)
+    assert throttle.parse_forge_tps(text + _forge_tps(30)) == (30.0, 20.0)
+    assert throttle.parse_forge_tps('Unknown command') is None
+
+
+def test_lag_is_logged_when_it_starts_and_when_it_ends(caplog):
+    caplog.set_level(logging.DEBUG, 'throttle')
+    governor = throttle.IoGovernor(2**20, 64 * 2**20, mspt_low=25, mspt_high=40)
+    sampler = _sampler(map(_forge_tps, [20, 45, 60, 55, 30, 45, 20, 10, 50]), governor)
+    for _ in range(9):
+        sampler.sample()
+    assert len(_messages(caplog, logging.WARNING)) == 2
+    assert len(_messages(caplog, logging.INFO)) == 1
+    assert governor.lagging
+    assert sampler.samples == [20, 45, 60, 55, 30, 45, 20, 10, 50]
+
+
+def test_sampling_failures_are_logged_once(caplog):
+    caplog.set_level(logging.INFO, 'throttle')
+    sampler = _sampler([OSError('connection refused'), 'Unknown command', OSError('timed out'),
+                        _forge_tps(20), 'Unknown command'])
+    results = [sampler.sample() for _ in range(5)]
+    assert results == [None, None, None, (20.0, 20.0), None]
+    assert _messages(caplog, logging.WARNING) == [
+        'Could not sample TPS: connection refused',
+        'Unexpected `forge tps` output, throttling by TPS is disabled',
+    ]
+    assert _messages(caplog, logging.INFO) == ['TPS sampling works again']
@@ -0,0 +1,66 @@
+import os
+import stat
+
+import pytest
+
+import walker
+
+
+def _reference(root, exclude=()):
+    """What os.walk and lstat report for the same tree."""
+    found = {}
+    for dirpath, dirnames, filenames in os.walk(root):
+        base = os.path.relpath(dirpath, root).replace(os.sep, '/')
+        base = '' if base == '.' else base + '/'
+        dirnames[:] = [d for d in dirnames if base + d not in exclude]
+        for name in filenames + dirnames:
+            rel = base + name
+            st = os.lstat(os.path.join(dirpath, name))
+            if rel not in exclude and stat.S_ISREG(st.st_mode):
+                found[rel] = (st.st_size, st.st_mtime_ns, st.st_ino)
+    return found
+
+
+def _walked(root, exclude=(), workers=None):
+    records = list(walker.walk(root, exclude, workers))
+    assert len(records) == len({rel for rel, _ in records})
+    return {rel: (st.st_size, st.st_mtime_ns, st.st_ino) for rel, st in records}
+
+
+@pytest.fixture
+def tree(tmp_path):
+    root = tmp_path / 'data'
+    region = root / 'world' / 'region'
+    region.mkdir(parents=True)
+    for i in range(walker.STAT_BATCH * 2 + 17):
+        (region / f'r.{i}.0.mca').write_bytes(b'x' * (i % 7))
+    for rel in ('world/level.dat', 'world/DIM-1/region/r.0.0.mca', 'world/playerdata/a.dat',
+                'logs/latest.log', 'world/logs/debug.log', 'mods/a.jar', 'empty/deep/deeper/file'):
+        (root / rel).parent.mkdir(parents=True, exist_ok=True)
+        (root / rel).write_bytes(rel.encode())
+    (root / 'world' / 'empty-dir').mkdir()
+    os.symlink(root / 'world' / 'level.dat', root / 'world' / 'link.dat')
+    os.symlink(root / 'mods', root / 'world' / 'mods-link')
+    return root
+
+
+def test_walk_matches_os_walk(tree):
+    expected = _reference(tree)
+    assert len(expected) == walker.STAT_BATCH * 2 + 17 + 7
+    assert _walked(tree) == expected
+    assert _walked(tree, workers=1) == expected
+
+
+def test_excluded_paths_are_not_entered(tree):
+    exclude = {'logs', 'world/logs', 'world/level.dat'}
+    walked = _walked(tree, exclude)
+    assert walked == _reference(tree, exclude)
+    assert not any(rel.startswith(('logs/', 'world/logs/')) for rel in walked)
+    assert 'world/level.dat' not in walked
+
+
+def test_stopping_early_and_missing_roots(tree, tmp_path):
+    records = walker.walk(tree)
+    assert next(records)[0]
+    records.close()
+    assert list(walker.walk(tmp_path / 'missing')) == []
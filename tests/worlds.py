@@ -0,0 +1,59 @@
+"""Small Anvil worlds for tests."""
+
+import random
+import zlib
+
+import anvil
+import regionpack
+
+
+def chunk(rng, size=None):
+    """A zlib chunk payload; the NBT is stand-in random, mildly compressible bytes."""
+    size = size or rng.randint(200, 9000)
+    words = [rng.randbytes(rng.randint(2, 9)) for _ in range(64)]
+    data = b''.join(rng.choice(words) for _ in range(size // 5))
+    return bytes([regionpack.CHUNK_ZLIB]) + zlib.compress(data[:size])
+
+
+def write_region(path, chunks):
+    """Write {index: (timestamp, payload)} as a region file."""
+    path.parent.mkdir(parents=True, exist_ok=True)
+    timestamps = [0] * anvil.CHUNKS_PER_REGION
+    for index, (timestamp, _) in chunks.items():
+        timestamps[index] = timestamp
+    with open(path, 'wb') as f:
+        anvil.write_region(f, timestamps, {i: payload for i, (_, payload) in chunks.items()})
+
+
+def read_region(path):
+    """{index: (timestamp, payload)} of a region file."""
+    chunks = {}
+    with open(path, 'rb') as f:
+        locations, timestamps = anvil.read_header(f)
+        for index, location in enumerate(locations):
+            if location[0]:
+                chunks[index] = (timestamps[index], anvil.read_chunk(f, location))
+    return chunks
+
+
+def make_world(root, seed=0, regions=2, chunks=40, files=None):
+    """A world under root/world; returns {rel: region chunks or file bytes}."""
+    rng = random.Random(seed)
+    contents = {}
+    for number in range(regions):
+        rel = f'world/region/r.{number}.0.mca'
+        region = {index: (1000 + index, chunk(rng)) for index in rng.sample(range(anvil.CHUNKS_PER_REGION), chunks)}
+        write_region(root / rel, region)
+        contents[rel] = region
+    for rel, data in (files or {'world/level.dat': rng.randbytes(3000),
+                                'world/playerdata/a.dat': rng.randbytes(500)}).items():
+        (root / rel).parent.mkdir(parents=True, exist_ok=True)
+        (root / rel).write_bytes(data)
+        contents[rel] = data
+    return contents
+
+
+def read_world(root, contents):
+    """The same shape as make_world's result, read back from root."""
+    return {rel: read_region(root / rel) if rel.endswith('.mca') else (root / rel).read_bytes()
+            for rel in contents}